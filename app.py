@@ -1,43 +1,151 @@
 import os
 import json
+import asyncio
+import concurrent.futures
+import contextvars
+import difflib
+import hashlib
+import importlib
+import importlib.machinery
+import importlib.util
+import threading
 import yaml
 import random
+import sys
+import re
+import sqlite3
+import time
+import unicodedata
+import uuid
 from datetime import datetime, timedelta
+from types import MappingProxyType
 from typing import Dict, List, Optional
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 
-# Visualization & graph libs
-import plotly.express as px
 from io import StringIO
+from collections import OrderedDict, deque
+
+_IMPORT_LOCK = threading.Lock()
+
+
+@st.cache_resource
+def get_import_report() -> Dict:
+    """Process-wide record of lazy imports: {"started": perf_counter at first run, "entries": [...]}."""
+    return {"started": time.perf_counter(), "entries": []}
+
+
+class LazyImport:
+    """
+    Stand-in for an optional module (or one of its attributes) that imports it
+    on first attribute access or call. First loads in the process are recorded
+    in the import report with their duration and when they happened.
+    """
+
+    def __init__(self, module: str, attr: Optional[str] = None):
+        self._module = module
+        self._attr = attr
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            with _IMPORT_LOCK:
+                if self._target is None:
+                    already_loaded = self._module in sys.modules
+                    started = time.perf_counter()
+                    target = importlib.import_module(self._module)
+                    if self._attr:
+                        target = getattr(target, self._attr)
+                    if not already_loaded:
+                        report = get_import_report()
+                        report["entries"].append(
+                            {
+                                "module": self._module,
+                                "seconds": round(time.perf_counter() - started, 3),
+                                "after_start_s": round(started - report["started"], 3),
+                                "thread": threading.current_thread().name,
+                            }
+                        )
+                    self._target = target
+        return self._target
+
+    def __getattr__(self, name: str):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self._target is not None else "not loaded"
+        return f"<lazy {self._module}{'.' + self._attr if self._attr else ''} ({state})>"
+
+
+def module_available(module: str) -> bool:
+    """
+    Whether the full dotted `module` is installed, without executing any of it.
+
+    Each level is looked up on its parent's search path (as find_spec would),
+    but parent packages are not imported: `google` is a namespace package that
+    protobuf always installs, and `pyvis/__init__` imports networkx.
+    """
+    path = None
+    parts = module.split(".")
+    for depth in range(1, len(parts) + 1):
+        name = ".".join(parts[:depth])
+        try:
+            if name in sys.modules:
+                spec = sys.modules[name].__spec__
+            elif path is None:
+                spec = importlib.util.find_spec(name)
+            else:
+                spec = importlib.machinery.PathFinder.find_spec(name, path)
+        except (ImportError, ValueError):
+            return False
+        if spec is None:
+            return False
+        path = spec.submodule_search_locations
+        if depth < len(parts) and path is None:
+            return False
+    return True
+
+
+def lazy_import(module: str, attr: Optional[str] = None) -> Optional[LazyImport]:
+    """A LazyImport if the full dotted `module` is installed, else None, so `x is None` availability checks keep working."""
+    return LazyImport(module, attr) if module_available(module) else None
+
+
+get_import_report()
+
+# Provider SDKs and graph / plot libraries are the slow imports; load them on first use.
+openai = lazy_import("openai")
+Anthropic = lazy_import("anthropic", "Anthropic")
+genai = lazy_import("google.generativeai")
+requests = lazy_import("requests")
+tiktoken = lazy_import("tiktoken")
+px = lazy_import("plotly.express")
+nx = lazy_import("networkx")
+Network = lazy_import("pyvis.network", "Network")
 
 try:
-    import openai
-except ImportError:
-    openai = None
-
-try:
-    from anthropic import Anthropic
-except ImportError:
-    Anthropic = None
-
-try:
-    import google.generativeai as genai
-except ImportError:
-    genai = None
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 try:
-    import requests
-except ImportError:
-    requests = None
+    import fcntl
+except ImportError:  # not available on Windows; manifest updates are then only serialized in-process
+    fcntl = None
 
 try:
-    import networkx as nx
-    from pyvis.network import Network
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.feather as feather
 except ImportError:
-    nx = None
-    Network = None
+    pa = None
+    pc = None
+    feather = None
 
 import streamlit.components.v1 as components
 
@@ -80,7 +188,11 @@ UI_TEXT = {
         "agent_usage_stats": "代理使用統計",
         "recent_activity": "最近活動",
         "supply_chain_analytics": "供應鏈分析",
-        "upload_csv": "上傳 Packing List CSV (或使用內建範例)",
+        "upload_csv": "上傳 Packing List CSV（可多檔，或使用內建範例）",
+        "dataset_store": "資料集倉庫",
+        "dataset_store_window": "倉庫查詢日期區間",
+        "dataset_store_append": "附加至資料集倉庫",
+        "dataset_store_done": "這些上傳檔案皆已在資料集倉庫中。",
         "summary_tables": "📋 數據摘要表",
         "dist_charts": "📈 分佈圖與關聯圖",
         "agent_hq_intro": "逐一執行代理，調整提示與模型，並將輸出串接為下一個代理的輸入。",
@@ -98,6 +210,45 @@ UI_TEXT = {
         "agent_hq_use_as_next": "➡️ 將上方內容作為下一個代理輸入",
         "skills_header": "技能說明（來自 SKILL.md）",
         "usage_log_tab": "📝 使用日誌",
+        "agent_hq_mode": "執行模式",
+        "agent_hq_mode_single": "單一代理",
+        "agent_hq_mode_fan_out": "多代理並行",
+        "agent_hq_fan_out_agents": "選擇要並行執行的代理",
+        "agent_hq_fan_out_defaults": "使用各代理預設模型",
+        "agent_hq_use_cache": "使用回應快取（相同提示直接回傳）",
+        "agent_hq_hedged": "對沖請求（{seconds:g} 秒未回應即同時詢問備援模型）",
+        "agent_hq_running": "代理執行中…",
+        "queue_next": "下一個送出",
+        "routing_label": "自動路由",
+        "recall_trace_tab": "🔎 回收追溯",
+        "anomaly_engine": "🚨 本地異常偵測引擎",
+        "anomaly_engine_run": "執行異常偵測",
+        "anomaly_engine_send": "➡️ 只將標記列送至 anomaly_detector（Agent HQ）",
+        "anomaly_engine_sent": "已設定為 Agent HQ 輸入，並預選 anomaly_detector。",
+        "duplicate_engine": "👥 本地重複紀錄偵測引擎",
+        "duplicate_engine_run": "執行重複偵測",
+        "duplicate_engine_variants": "DeviceName / licenseID 拼寫變體",
+        "duplicate_engine_send": "➡️ 將重複群組送至 duplicate_checker（Agent HQ）",
+        "duplicate_engine_sent": "已設定為 Agent HQ 輸入，並預選 duplicate_checker。",
+        "udi_quality": "🏷️ GS1 UDI 品質檢核",
+        "udi_quality_send": "➡️ 將 UDI 問題摘要送至 udi_quality_checker（Agent HQ）",
+        "udi_quality_sent": "已設定為 Agent HQ 輸入，並預選 udi_quality_checker。",
+        "recall_trace_column": "查詢欄位",
+        "recall_trace_values": "批號 / UDI / 序號 / 許可證（每行一筆，或以逗號分隔）",
+        "recall_trace_run": "執行追溯",
+        "recall_trace_backfill": "將 {n} 個已儲存資料集加入追溯索引",
+        "routing_alternatives": "其他候選",
+        "routing_fallback": "無明確相符，使用預設代理",
+        "queue_ahead": "前方尚有 {n} 個請求",
+        "agent_hq_mode_pipeline": "代理管線 (pipelines.yaml)",
+        "data_context": "🧮 代理資料脈絡（依 token 預算壓縮）",
+        "data_context_model": "目標模型",
+        "data_context_budget": "Token 預算",
+        "data_context_build": "產生資料脈絡",
+        "data_context_send": "➡️ 送至 Agent HQ 輸入",
+        "data_context_sent": "已設定為 Agent HQ 的使用者輸入。",
+        "agent_hq_pipeline": "選擇管線",
+        "agent_hq_pipeline_reset": "🔄 重設管線進度",
     },
     "en": {
         "app_title": "🏥 GUDID Agentic AI — WOW Supply Chain Analytics",
@@ -132,7 +283,11 @@ UI_TEXT = {
         "agent_usage_stats": "Agent usage statistics",
         "recent_activity": "Recent activity",
         "supply_chain_analytics": "Supply Chain Analytics",
-        "upload_csv": "Upload Packing List CSV (or use built-in sample)",
+        "upload_csv": "Upload Packing List CSVs (one or more, or use built-in sample)",
+        "dataset_store": "Dataset store",
+        "dataset_store_window": "Store date window",
+        "dataset_store_append": "Append to dataset store",
+        "dataset_store_done": "These uploads are already in the dataset store.",
         "summary_tables": "📋 Summary Tables",
         "dist_charts": "📈 Distribution & Relation Graphs",
         "agent_hq_intro": "Run agents one by one, tune prompts/models, and chain outputs into the next agent.",
@@ -150,6 +305,45 @@ UI_TEXT = {
         "agent_hq_use_as_next": "➡️ Use above content as next agent input",
         "skills_header": "Skills (from SKILL.md)",
         "usage_log_tab": "📝 Usage Log",
+        "agent_hq_mode": "Run mode",
+        "agent_hq_mode_single": "Single agent",
+        "agent_hq_mode_fan_out": "Fan-out (parallel agents)",
+        "agent_hq_fan_out_agents": "Agents to run in parallel",
+        "agent_hq_fan_out_defaults": "Use each agent's default model",
+        "agent_hq_use_cache": "Use response cache (identical prompts return instantly)",
+        "agent_hq_hedged": "Hedged requests (also ask a fallback model after {seconds:g}s without an answer)",
+        "agent_hq_running": "Running agent…",
+        "queue_next": "next in line",
+        "routing_label": "Auto-routed",
+        "recall_trace_tab": "🔎 Recall trace",
+        "anomaly_engine": "🚨 Local anomaly engine",
+        "anomaly_engine_run": "Run anomaly detection",
+        "anomaly_engine_send": "➡️ Send only flagged rows to anomaly_detector (Agent HQ)",
+        "anomaly_engine_sent": "Set as the Agent HQ input with anomaly_detector preselected.",
+        "duplicate_engine": "👥 Local duplicate engine",
+        "duplicate_engine_run": "Run duplicate detection",
+        "duplicate_engine_variants": "DeviceName / licenseID spelling variants",
+        "duplicate_engine_send": "➡️ Send duplicate groups to duplicate_checker (Agent HQ)",
+        "duplicate_engine_sent": "Set as the Agent HQ input with duplicate_checker preselected.",
+        "udi_quality": "🏷️ GS1 UDI quality",
+        "udi_quality_send": "➡️ Send UDI problem summary to udi_quality_checker (Agent HQ)",
+        "udi_quality_sent": "Set as the Agent HQ input with udi_quality_checker preselected.",
+        "recall_trace_column": "Look up by",
+        "recall_trace_values": "Lots / UDIs / SNs / licenses (one per line, or comma-separated)",
+        "recall_trace_run": "Run trace",
+        "recall_trace_backfill": "Add {n} saved dataset(s) to the trace index",
+        "routing_alternatives": "alternatives",
+        "routing_fallback": "no confident match, default agent",
+        "queue_ahead": "{n} request(s) ahead",
+        "agent_hq_mode_pipeline": "Pipeline (pipelines.yaml)",
+        "data_context": "🧮 Agent data context (token-budgeted)",
+        "data_context_model": "Target model",
+        "data_context_budget": "Token budget",
+        "data_context_build": "Build data context",
+        "data_context_send": "➡️ Send to Agent HQ input",
+        "data_context_sent": "Set as the Agent HQ user input.",
+        "agent_hq_pipeline": "Pipeline",
+        "agent_hq_pipeline_reset": "🔄 Reset pipeline progress",
     },
 }
 
@@ -440,6 +634,32 @@ B00079,45943,C06034,衛部醫器輸字第033951號,E.3610植入式心律器之
 """
 
 
+EXCEL_EPOCH = pd.Timestamp(1899, 12, 30)
+
+# Serial-day bounds that still fit into a nanosecond pandas Timestamp.
+EXCEL_SERIAL_MIN = (pd.Timestamp.min.ceil("D").to_pydatetime() - EXCEL_EPOCH.to_pydatetime()).days
+EXCEL_SERIAL_MAX = (pd.Timestamp.max.floor("D").to_pydatetime() - EXCEL_EPOCH.to_pydatetime()).days
+
+# Rows parsed per chunk when streaming a packing list.
+INGEST_CHUNK_ROWS = 200_000
+
+# Explicit column types so low-cardinality codes stay compact and UDI / lot
+# identifiers keep their leading zeros.
+PACKING_LIST_DTYPES = {
+    "Suppliername": "category",
+    "customer": "category",
+    "licenseID": "category",
+    "DeviceCategory": "category",
+    "UDI": "string",
+    "LotNumber": "string",
+    "SN": "string",
+    "ModelNum": "string",
+}
+
+CURLY_QUOTES = ("“", "”")
+CURLY_QUOTES_PATTERN = "[" + "".join(CURLY_QUOTES) + "]"
+
+
 def excel_serial_to_date(val):
     try:
         serial_int = int(float(val))
@@ -449,20 +669,642 @@ def excel_serial_to_date(val):
         return pd.NaT
 
 
+def excel_serials_to_datetimes(values: pd.Series) -> pd.Series:
+    """Vectorized excel_serial_to_date: one timedelta offset from 1899-12-30."""
+    serials = pd.to_numeric(values, errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+    days = np.trunc(serials)
+    days[(days < EXCEL_SERIAL_MIN) | (days > EXCEL_SERIAL_MAX)] = np.nan
+    return pd.Series(EXCEL_EPOCH + pd.to_timedelta(days, unit="D"), index=values.index)
+
+
+def _strip_curly_quotes(chunk: pd.DataFrame) -> pd.DataFrame:
+    """Remove curly quotes from headers and text columns of one parsed chunk."""
+    chunk.columns = [str(c).replace(CURLY_QUOTES[0], "").replace(CURLY_QUOTES[1], "") for c in chunk.columns]
+    for col in chunk.columns:
+        s = chunk[col]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            cats = s.cat.categories
+            if not pd.api.types.is_string_dtype(cats.dtype):
+                continue
+            cleaned = cats.astype(str).str.replace(CURLY_QUOTES_PATTERN, "", regex=True)
+            if cleaned.equals(cats):
+                continue
+            if cleaned.has_duplicates:
+                chunk[col] = s.astype("string").str.replace(CURLY_QUOTES_PATTERN, "", regex=True).astype("category")
+            else:
+                chunk[col] = s.cat.rename_categories(cleaned)
+        elif pd.api.types.is_string_dtype(s.dtype):
+            chunk[col] = s.str.replace(CURLY_QUOTES_PATTERN, "", regex=True)
+    return chunk
+
+
+def _prepare_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+    chunk = _strip_curly_quotes(chunk)
+    if "deliverdate" in chunk.columns:
+        chunk["deliverdate_dt"] = excel_serials_to_datetimes(chunk["deliverdate"])
+    if "Numbers" in chunk.columns:
+        chunk["Numbers"] = pd.to_numeric(chunk["Numbers"], errors="coerce").fillna(0).astype(int)
+    return chunk
+
+
+def _concat_chunks(chunks: List[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate parsed chunks, unifying categories so categorical columns survive."""
+    if len(chunks) == 1:
+        return chunks[0]
+    cat_cols = [c for c, dtype in chunks[0].dtypes.items() if isinstance(dtype, pd.CategoricalDtype)]
+    for col in cat_cols:
+        if not all(col in c.columns and isinstance(c[col].dtype, pd.CategoricalDtype) for c in chunks):
+            continue
+        union = pd.api.types.union_categoricals([c[col] for c in chunks], ignore_order=True).categories
+        for c in chunks:
+            c[col] = c[col].cat.set_categories(union)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def peak_rss_mb() -> Optional[float]:
+    """
+    Process peak resident set size in MB (None where `resource` is unavailable).
+
+    Read from getrusage rather than tracemalloc: tracing slows every allocation
+    in the process, for all sessions, and its peak counter is process-global.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+
+def ingest_packing_list(source, chunksize: int = INGEST_CHUNK_ROWS) -> pd.DataFrame:
+    """
+    Stream a packing list CSV into a typed DataFrame chunk by chunk.
+
+    `source` is a binary file-like object (e.g. a Streamlit upload) or a text
+    buffer. Ingestion statistics (rows, chunks, seconds, rows/sec and how far
+    the ingest raised the process peak RSS) are attached as `df.attrs["ingest_stats"]`. When a UDI
+    column is present, a `udi_quality` bitmask (see UDI_QUALITY_FLAGS) is added.
+    """
+    started = time.perf_counter()
+    # ru_maxrss is a process-lifetime high-water mark, so only its growth during
+    # this ingest says anything about it (0 when an earlier peak was higher).
+    peak_before = peak_rss_mb()
+
+    chunks: List[pd.DataFrame] = []
+    reader = pd.read_csv(source, dtype=PACKING_LIST_DTYPES, chunksize=chunksize, encoding="utf-8")
+    with reader:
+        for chunk in reader:
+            chunks.append(_prepare_chunk(chunk))
+    df = _concat_chunks(chunks) if chunks else pd.DataFrame()
+    if "UDI" in df.columns:
+        df["udi_quality"] = udi_quality_flags(df)
+
+    elapsed = time.perf_counter() - started
+    df.attrs["ingest_stats"] = {
+        "rows": len(df),
+        "chunks": len(chunks),
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": int(len(df) / elapsed) if elapsed > 0 else len(df),
+        "peak_rss_growth_mb": None if peak_before is None else round(peak_rss_mb() - peak_before, 1),
+        "frame_mb": round(float(df.memory_usage(deep=True).sum()) / 2**20, 1),
+    }
+    return df
+
+
 def load_packing_list(csv_file) -> pd.DataFrame:
     if csv_file is not None:
-        text = csv_file.read().decode("utf-8")
+        if hasattr(csv_file, "seek"):
+            csv_file.seek(0)
+        source = csv_file
     else:
-        text = SAMPLE_CSV
-    text = text.replace("“", "").replace("”", "")
-    df = pd.read_csv(StringIO(text))
-    if "deliverdate" in df.columns:
-        df["deliverdate_dt"] = df["deliverdate"].apply(excel_serial_to_date)
-    if "Numbers" in df.columns:
-        df["Numbers"] = pd.to_numeric(df["Numbers"], errors="coerce").fillna(0).astype(int)
+        source = StringIO(SAMPLE_CSV)
+    df = ingest_packing_list(source)
+    stats = df.attrs["ingest_stats"]
+    log_event(
+        "csv_ingest",
+        f"rows={stats['rows']}, chunks={stats['chunks']}, seconds={stats['seconds']}, "
+        f"rows_per_sec={stats['rows_per_sec']}, peak_rss_growth_mb={stats['peak_rss_growth_mb']}",
+    )
     return df
 
 
+# =========================
+# GS1 UDI VALIDATION (vectorized, at ingest)
+# =========================
+
+# Bit per problem in the `udi_quality` column (0 = clean).
+UDI_QUALITY_FLAGS = {
+    "missing": 1,
+    "not_gs1": 2,  # neither a bare GTIN nor a GS1 element string (e.g. HIBCC "+...", free text)
+    "bad_length": 4,  # digits only, but not a GTIN-8/12/13/14
+    "bad_check_digit": 8,
+    "ai_error": 16,  # GS1 element string with an unknown AI, malformed value or impossible date
+    "lot_mismatch": 32,  # AI (10) lot differs from the LotNumber column
+    "model_conflict": 64,  # same GTIN seen with several ModelNum values in the dataset
+    "license_conflict": 128,  # same GTIN seen with several licenseID values in the dataset
+}
+
+UDI_QUALITY_LABELS = {
+    "missing": "UDI is empty",
+    "not_gs1": "Not a GTIN or GS1 element string",
+    "bad_length": "Digits only, but not 8/12/13/14 long",
+    "bad_check_digit": "GTIN check digit does not match",
+    "ai_error": "Unknown GS1 AI, malformed value or invalid date",
+    "lot_mismatch": "AI (10) lot differs from LotNumber",
+    "model_conflict": "GTIN maps to several ModelNum values",
+    "license_conflict": "GTIN maps to several licenseID values",
+}
+
+GTIN_LENGTHS = (8, 12, 13, 14)
+GS1_DATE_PATTERN = r"\d{2}(?:0[1-9]|1[0-2])(?:[0-2]\d|3[01])"
+
+# Value formats for the application identifiers accepted in UDIs.
+GS1_AI_PATTERNS = {
+    "01": r"\d{14}",  # GTIN (device identifier)
+    "10": r"[!-~]{1,20}",  # lot
+    "11": GS1_DATE_PATTERN,  # production date
+    "17": GS1_DATE_PATTERN,  # expiry date
+    "21": r"[!-~]{1,20}",  # serial
+    "30": r"\d{1,8}",  # count
+    "240": r"[!-~]{1,30}",  # additional product id
+}
+GS1_AI_FIELDS = {"01": "gtin", "10": "lot", "11": "production", "17": "expiry", "21": "serial"}
+
+GS1_BRACKETED_PATTERN = r"(?:\(\d{2,4}\)[^()]+)+"
+# Predefined-length AIs; in unbracketed element strings every other AI runs to the next GS or the end.
+GS1_FIXED_LENGTH_AIS = {"01": 14, "11": 6, "17": 6}
+GS1_SEPARATOR = "\x1d"
+
+# Columns the quality pass reads.
+UDI_QUALITY_COLUMNS = ["UDI", "LotNumber", "ModelNum", "licenseID"]
+
+
+def gtin_check_digit_ok(gtins: np.ndarray) -> np.ndarray:
+    """Modulo-10 check for 14-digit GTIN strings, one matrix op over all of them."""
+    if len(gtins) == 0:
+        return np.zeros(0, dtype=bool)
+    digits = np.frombuffer("".join(gtins).encode("ascii"), dtype=np.uint8).reshape(-1, 14) - ord("0")
+    weights = np.tile([3, 1], 7)[:13]
+    expected = (10 - (digits[:, :13].astype(np.int64) @ weights) % 10) % 10
+    return expected == digits[:, 13]
+
+
+def split_gs1_element_string(text: str) -> Optional[List[tuple]]:
+    """
+    (ai, value) pairs of an unbracketed GS1 element string, read left to right:
+    predefined-length AIs take their fixed width, the rest end at GS or the end
+    of the string. None when an AI is not one of GS1_AI_PATTERNS.
+    """
+    elements, pos = [], 0
+    while pos < len(text):
+        ai = next((code for code in GS1_AI_PATTERNS if text.startswith(code, pos)), None)
+        if ai is None:
+            return None
+        pos += len(ai)
+        if ai in GS1_FIXED_LENGTH_AIS:
+            end = pos + GS1_FIXED_LENGTH_AIS[ai]
+            value, pos = text[pos:end], end + text.startswith(GS1_SEPARATOR, end)
+        else:
+            end = text.find(GS1_SEPARATOR, pos)
+            end = len(text) if end < 0 else end
+            value, pos = text[pos:end], end + 1
+        elements.append((ai, value))
+    return elements
+
+
+def parse_udi(values) -> pd.DataFrame:
+    """
+    Parse UDI strings into gtin (zero-padded GTIN-14) / lot / serial /
+    expiry / production plus the value-level `udi_quality` bits (see UDI_QUALITY_FLAGS).
+
+    Accepts bare GTIN-8/12/13/14, bracketed GS1 element strings
+    ("(01)…(17)…(10)…") and unbracketed ones in any AI order ("01…17…10…",
+    variable-length values ended by GS). Work is done with string/regex
+    kernels over the whole array, so pass unique values.
+    """
+    s = pd.Series(values, dtype="string").str.strip().fillna("").reset_index(drop=True)
+    n = len(s)
+    flags = np.zeros(n, dtype=np.uint8)
+    out = pd.DataFrame({field: pd.Series(pd.NA, index=s.index, dtype="string") for field in GS1_AI_FIELDS.values()})
+
+    length = s.str.len().to_numpy(dtype=np.int64)
+    digits_only = s.str.fullmatch(r"\d+").to_numpy(dtype=bool, na_value=False)
+    missing = length == 0
+    bare = digits_only & np.isin(length, GTIN_LENGTHS)
+    raw = ~bare & ~missing & s.str.match(r"01\d{14}").to_numpy(dtype=bool, na_value=False)
+    bracketed = s.str.startswith("(").to_numpy(dtype=bool, na_value=False)
+    flags[missing] |= UDI_QUALITY_FLAGS["missing"]
+    flags[digits_only & ~bare & ~raw] |= UDI_QUALITY_FLAGS["bad_length"]
+    flags[~missing & ~digits_only & ~raw & ~bracketed] |= UDI_QUALITY_FLAGS["not_gs1"]
+    out.loc[bare, "gtin"] = s[bare].str.zfill(14)
+
+    # Element strings → long (row, ai, value) frame, then one validation pass per AI.
+    long_parts = []
+    idx = np.flatnonzero(bracketed)
+    if len(idx):
+        sub = s.iloc[idx]
+        well_formed = sub.str.fullmatch(GS1_BRACKETED_PATTERN).to_numpy(dtype=bool, na_value=False)
+        flags[idx[~well_formed]] |= UDI_QUALITY_FLAGS["ai_error"]
+        pairs = sub[well_formed].str.extractall(r"\((?P<ai>\d{2,4})\)(?P<value>[^()]+)")
+        long_parts.append(pairs.reset_index(level="match", drop=True))
+    idx = np.flatnonzero(raw)
+    if len(idx):
+        sub = s.iloc[idx]
+        split = [split_gs1_element_string(text) for text in sub]
+        matched = np.array([elements is not None for elements in split], dtype=bool)
+        flags[idx[~matched]] |= UDI_QUALITY_FLAGS["ai_error"]
+        elements = [(row, ai, value) for row, parts in zip(sub.index, split) if parts for ai, value in parts]
+        frame = pd.DataFrame(elements, columns=["row", "ai", "value"]).astype({"row": np.int64})
+        long_parts.append(frame.set_index("row").astype({"value": "string"}))
+    if long_parts:
+        pairs = pd.concat(long_parts).rename_axis("row")
+        ai = pairs["ai"].to_numpy(dtype=object)
+        valid = np.zeros(len(pairs), dtype=bool)
+        for code, ai_pattern in GS1_AI_PATTERNS.items():
+            is_ai = ai == code
+            if is_ai.any():
+                valid[is_ai] = pairs["value"][is_ai].str.fullmatch(ai_pattern).to_numpy(dtype=bool, na_value=False)
+        repeated = pd.MultiIndex.from_arrays([pairs.index, ai]).duplicated()
+        rows = pairs.index.to_numpy(dtype=np.int64)
+        flags[rows[~valid | repeated]] |= UDI_QUALITY_FLAGS["ai_error"]
+        element_rows = np.flatnonzero(bracketed | raw)
+        flags[element_rows[~np.isin(element_rows, rows[ai == "01"])]] |= UDI_QUALITY_FLAGS["ai_error"]
+        known = pairs[np.isin(ai, list(GS1_AI_FIELDS)) & valid & ~repeated].reset_index()
+        wide = known.pivot(index="row", columns="ai", values="value")
+        for ai, field in GS1_AI_FIELDS.items():
+            if ai in wide.columns:
+                out.loc[wide.index, field] = wide[ai].astype("string")
+
+    gtin = out["gtin"]
+    checkable = gtin.str.fullmatch(r"\d{14}").to_numpy(dtype=bool, na_value=False)
+    ok = gtin_check_digit_ok(gtin[checkable].to_numpy(dtype=object))
+    flags[np.flatnonzero(checkable)[~ok]] |= UDI_QUALITY_FLAGS["bad_check_digit"]
+    out["udi_quality"] = flags
+    return out
+
+
+def _conflicting(keys: np.ndarray, values: pd.Series) -> np.ndarray:
+    """Rows whose key (>= 0) is seen with more than one distinct non-missing value."""
+    codes = pd.factorize(values, use_na_sentinel=True)[0].astype(float)
+    codes[codes < 0] = np.nan
+    valid = keys >= 0
+    distinct = pd.Series(codes[valid]).groupby(keys[valid]).nunique()
+    per_key = np.zeros(keys.max() + 1 if valid.any() else 0, dtype=np.int64)
+    per_key[distinct.index.to_numpy()] = distinct.to_numpy()
+    out = np.zeros(len(keys), dtype=bool)
+    out[valid] = per_key[keys[valid]] > 1
+    return out
+
+
+def udi_quality_flags(df: pd.DataFrame) -> np.ndarray:
+    """
+    Per-row `udi_quality` bitmask for a packing list.
+
+    Format checks run once per distinct UDI (parse_udi); the lot comparison
+    and the GTIN → ModelNum / licenseID consistency checks then run as array
+    ops over all rows via the factorized codes.
+    """
+    codes, uniques = pd.factorize(df["UDI"], use_na_sentinel=True)
+    parsed = parse_udi(uniques)
+    # Missing UDIs get their own slot at the end of the lookup tables.
+    codes = np.where(codes >= 0, codes, len(uniques))
+    flags = np.append(parsed["udi_quality"].to_numpy(), np.uint8(UDI_QUALITY_FLAGS["missing"]))[codes]
+
+    if "LotNumber" in df.columns:
+        has_lot = np.append(parsed["lot"].notna().to_numpy(), False)[codes]
+        if has_lot.any():
+            rows = np.flatnonzero(has_lot)
+            udi_lot = parsed["lot"].to_numpy(dtype=object)[codes[rows]]
+            lot = df["LotNumber"].astype("string").str.strip().to_numpy(dtype=object, na_value="")[rows]
+            flags[rows[udi_lot != lot]] |= UDI_QUALITY_FLAGS["lot_mismatch"]
+
+    gtin_codes = np.append(pd.factorize(parsed["gtin"], use_na_sentinel=True)[0], -1)[codes]
+    for col, flag in (("ModelNum", "model_conflict"), ("licenseID", "license_conflict")):
+        if col in df.columns:
+            flags[_conflicting(gtin_codes, df[col])] |= UDI_QUALITY_FLAGS[flag]
+    return flags
+
+
+def udi_quality_summary(df: pd.DataFrame) -> Dict:
+    """Rows per quality flag, and the distinct UDIs with problems (worst first)."""
+    flags = df["udi_quality"].to_numpy()
+    counts = {name: int(((flags & bit) > 0).sum()) for name, bit in UDI_QUALITY_FLAGS.items()}
+    flagged = df.loc[flags > 0, [c for c in ["udi_quality"] + UDI_QUALITY_COLUMNS if c in df.columns]]
+    by_udi = (
+        flagged.groupby(["UDI", "udi_quality"], observed=True, dropna=False)
+        .agg(
+            rows=("udi_quality", "size"),
+            **{f"{c}s": (c, "nunique") for c in ("ModelNum", "licenseID") if c in flagged.columns},
+        )
+        .reset_index()
+        .sort_values("rows", ascending=False, kind="stable")
+    )
+    parsed = parse_udi(by_udi["UDI"].to_numpy(dtype=object))
+    by_udi = pd.concat([by_udi.reset_index(drop=True), parsed.drop(columns="udi_quality")], axis=1)
+    by_udi["problems"] = [
+        ", ".join(name for name, bit in UDI_QUALITY_FLAGS.items() if f & bit) for f in by_udi["udi_quality"]
+    ]
+    return {"rows": len(df), "clean": int((flags == 0).sum()), "counts": counts, "by_udi": by_udi}
+
+
+def get_udi_quality(dataset_key: str, df: pd.DataFrame) -> Dict:
+    """udi_quality_summary for a dataset, computing the bitmask for frames ingested before it existed."""
+
+    def build():
+        frame = df if "udi_quality" in df.columns else df.assign(udi_quality=udi_quality_flags(df))
+        return udi_quality_summary(frame)
+
+    return get_ingest_cache().get_or_create(("udi_quality", dataset_key), build)
+
+
+def udi_agent_prompt(summary: Dict, model: str, budget_tokens: int) -> str:
+    """Compact prompt for udi_quality_checker: flag counts, then the most frequent problem UDIs within budget."""
+    packer = ContextBudget(model, budget_tokens)
+    packer.add(
+        f"# Local GS1 UDI validation: {summary['rows'] - summary['clean']:,} of {summary['rows']:,} "
+        "packing-list lines have UDI problems. Explain the likely root causes, the regulatory impact, and a "
+        "clean-up plan per problem type."
+    )
+    packer.add("\n## Problems (lines)")
+    for name, hits in summary["counts"].items():
+        packer.add(f"{name}: {hits:,} · {UDI_QUALITY_LABELS[name]}")
+    by_udi = summary["by_udi"]
+    columns = [c for c in ("UDI", "problems", "rows", "ModelNums", "licenseIDs", "gtin", "lot", "expiry") if c in by_udi]
+    included = packer.section("Problem UDIs (most lines first)", columns, _table_rows(by_udi[columns]))
+    if included < len(by_udi):
+        packer.add(f"... {len(by_udi) - included:,} more UDIs omitted for the token budget")
+    return packer.render()
+
+
+# =========================
+# INGEST CACHE (shared across sessions)
+# =========================
+
+# Bump whenever ingestion changes the parsed frame so stale cache entries are not reused.
+PARSER_VERSION = "4"
+
+INGEST_CACHE_BUDGET_MB = int(os.getenv("GUDID_INGEST_CACHE_MB", "1024"))
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by total size in bytes and/or entry count."""
+
+    def __init__(self, max_bytes: Optional[int] = None, max_items: Optional[int] = None, sizeof=None):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.sizeof = sizeof or (lambda value: 0)
+        self._entries: "OrderedDict[object, tuple]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._key_locks: Dict[object, threading.Lock] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, size: Optional[int] = None):
+        size = self.sizeof(value) if size is None else size
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.total_bytes += size
+            self._evict()
+
+    def get_or_create(self, key, factory):
+        """Return the cached value, building it once even when sessions race for it."""
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                        return self._entries[key][0]
+                value = factory()
+                self.put(key, value)
+        finally:
+            with self._lock:
+                self._key_locks.pop(key, None)
+        return value
+
+    def _evict(self):
+        # Always keep the most recent entry, even if it alone exceeds the budget.
+        while len(self._entries) > 1 and (
+            (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+            or (self.max_items is not None and len(self._entries) > self.max_items)
+        ):
+            _, (_, size) = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "mb": round(self.total_bytes / 2**20, 1),
+                "budget_mb": round(self.max_bytes / 2**20, 1) if self.max_bytes is not None else None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def frame_nbytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True).sum())
+
+
+def cache_entry_nbytes(value) -> int:
+    """Approximate size of an ingest-cache entry (frames and index objects)."""
+    if isinstance(value, pd.DataFrame):
+        return frame_nbytes(value)
+    return int(getattr(value, "nbytes", 0))
+
+
+@st.cache_resource
+def get_ingest_cache() -> LRUCache:
+    """Process-wide cache of parsed packing lists, keyed by content digest."""
+    return LRUCache(max_bytes=INGEST_CACHE_BUDGET_MB * 2**20, sizeof=cache_entry_nbytes)
+
+
+def packing_list_digest(csv_file) -> str:
+    """Content digest of an upload (or the built-in sample) plus the parser version."""
+    if csv_file is None:
+        payload = SAMPLE_CSV.encode("utf-8")
+    elif hasattr(csv_file, "getbuffer"):
+        payload = csv_file.getbuffer()
+    else:
+        csv_file.seek(0)
+        payload = csv_file.read()
+    h = hashlib.blake2b(payload, digest_size=16)
+    h.update(f"parser={PARSER_VERSION}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _session_digest(csv_file) -> str:
+    """Hash each upload once per session instead of on every rerun."""
+    file_id = getattr(csv_file, "file_id", None) if csv_file is not None else "__sample__"
+    if file_id is None:
+        return packing_list_digest(csv_file)
+    memo = st.session_state.setdefault("upload_digests", {})
+    if file_id not in memo:
+        memo[file_id] = packing_list_digest(csv_file)
+    return memo[file_id]
+
+
+def load_packing_list_cached(csv_file):
+    """
+    Return (dataset_key, DataFrame) for an upload, parsing it at most once per process.
+
+    The returned frame is shared between sessions and must be treated as read-only.
+    """
+    dataset_key = _session_digest(csv_file)
+
+    def ingest():
+        df = load_packing_list(csv_file)
+        if csv_file is not None:
+            index_packing_list(df, dataset_key, name=csv_file.name)
+        return df
+
+    df = get_ingest_cache().get_or_create(("packing_list", dataset_key), ingest)
+    return dataset_key, df
+
+
+# =========================
+# COLUMNAR PERSISTENCE (Arrow IPC)
+# =========================
+
+GUDID_DATA_DIR = os.getenv("GUDID_DATA_DIR", ".gudid_data")
+PERSISTED_DATASETS_DIR = os.path.join(GUDID_DATA_DIR, "datasets")
+
+# Text columns stored dictionary-encoded; they repeat heavily across rows.
+ARROW_DICTIONARY_COLUMNS = ["Suppliername", "customer", "licenseID", "DeviceName"]
+
+# Columns read by the dashboard tables and charts; persisted datasets are loaded
+# with this projection so untouched columns are never paged in.
+DASHBOARD_COLUMNS = [
+    "Suppliername",
+    "customer",
+    "licenseID",
+    "DeviceName",
+    "ModelNum",
+    "LotNumber",
+    "Numbers",
+    "deliverdate_dt",
+]
+
+
+def persisted_dataset_path(dataset_key: str) -> str:
+    return os.path.join(PERSISTED_DATASETS_DIR, f"{dataset_key}.arrow")
+
+
+def dictionary_encode_columns(table, columns: List[str]):
+    for col in columns:
+        idx = table.schema.get_field_index(col)
+        if idx >= 0 and not pa.types.is_dictionary(table.schema.field(idx).type):
+            table = table.set_column(idx, col, pc.dictionary_encode(table.column(idx)))
+    return table
+
+
+def persist_packing_list(df: pd.DataFrame, dataset_key: str, name: str = "") -> Optional[str]:
+    """
+    Write a parsed packing list as an uncompressed Arrow IPC file.
+
+    Uncompressed IPC can be memory-mapped and read into Arrow without decoding,
+    unlike Parquet. Returns the file path, or None when pyarrow is not installed.
+    """
+    if pa is None:
+        return None
+
+    table = dictionary_encode_columns(pa.Table.from_pandas(df, preserve_index=False), ARROW_DICTIONARY_COLUMNS)
+
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"gudid"] = json.dumps(
+        {
+            "name": name or dataset_key,
+            "rows": table.num_rows,
+            "parser_version": PARSER_VERSION,
+            "created": datetime.now().isoformat(timespec="seconds"),
+        },
+        ensure_ascii=False,
+    ).encode("utf-8")
+    table = table.replace_schema_metadata(metadata)
+
+    os.makedirs(PERSISTED_DATASETS_DIR, exist_ok=True)
+    path = persisted_dataset_path(dataset_key)
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    feather.write_feather(table, tmp_path, compression="uncompressed")
+    os.replace(tmp_path, path)
+    return path
+
+
+def list_persisted_datasets() -> List[Dict]:
+    """Describe persisted datasets from their schema metadata (no column data is read)."""
+    if pa is None or not os.path.isdir(PERSISTED_DATASETS_DIR):
+        return []
+    datasets = []
+    for fname in sorted(os.listdir(PERSISTED_DATASETS_DIR)):
+        if not fname.endswith(".arrow"):
+            continue
+        path = os.path.join(PERSISTED_DATASETS_DIR, fname)
+        try:
+            with pa.memory_map(path) as source:
+                schema = pa.ipc.open_file(source).schema
+            info = json.loads((schema.metadata or {}).get(b"gudid", b"{}"))
+        except Exception:
+            continue
+        info["key"] = fname[: -len(".arrow")]
+        datasets.append(info)
+    return sorted(datasets, key=lambda d: d.get("created", ""), reverse=True)
+
+
+def load_persisted_packing_list(dataset_key: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Memory-map a persisted dataset and materialize only the requested columns.
+
+    Reading the Arrow table is zero-copy, but converting to pandas copies the
+    projected columns into process memory; columns not requested are never read.
+    """
+    if pa is None:
+        raise RuntimeError("pyarrow not installed; columnar datasets unavailable")
+    path = persisted_dataset_path(dataset_key)
+    if columns is not None:
+        with pa.memory_map(path) as source:
+            available = set(pa.ipc.open_file(source).schema.names)
+        columns = [c for c in columns if c in available]
+    table = feather.read_table(path, columns=columns, memory_map=True)
+    # split_blocks skips consolidating same-dtype columns, which would copy them a second time.
+    return table.to_pandas(split_blocks=True)
+
+
+def load_persisted_packing_list_cached(dataset_key: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Shared, read-only projection of a persisted dataset (see load_packing_list_cached)."""
+    cache_key = ("persisted", dataset_key, tuple(columns) if columns is not None else None)
+    return get_ingest_cache().get_or_create(cache_key, lambda: load_persisted_packing_list(dataset_key, columns))
+
+
 # =========================
 # SIMPLE USAGE LOG
 # =========================
@@ -482,296 +1324,2929 @@ def log_event(event_type: str, detail: str):
 
 
 # =========================
-# SUPPLY CHAIN GRAPH BUILD & RENDER
+# SUMMARY CUBE
 # =========================
 
-def build_supply_chain_graph(
-    df: pd.DataFrame,
-    license_id_filter: Optional[str] = None,
-    lot_filter: Optional[str] = None,
-    max_nodes: int = 200,
-    max_edges: int = 400,
-    search_term: Optional[str] = None,
-):
-    """Build a Network (pyvis) from packing list with filters and limits."""
-    if nx is None or Network is None:
-        return None
+# Grain of the pre-aggregated cube behind the summary tables and charts.
+CUBE_DIMENSIONS = ["deliverdate_dt", "customer", "Suppliername", "DeviceName", "ModelNum", "licenseID"]
+
+
+def build_summary_cube(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Aggregate the packing list to (date, customer, supplier, device, model, license)
+    grain with `Units` (sum of Numbers, or line count when absent) and `Lines`.
+
+    Distinct lot counts cannot be rolled up from this grain and are computed
+    from the rows instead.
+    """
+    dims = [c for c in CUBE_DIMENSIONS if c in df.columns]
+    if not dims:
+        return pd.DataFrame(columns=["Units", "Lines"])
+    qty = df["Numbers"] if "Numbers" in df.columns else pd.Series(1, index=df.index)
+    cube = (
+        df[dims]
+        .assign(Units=qty)
+        .groupby(dims, observed=True, dropna=False, sort=False)
+        .agg(Units=("Units", "sum"), Lines=("Units", "size"))
+        .reset_index()
+    )
+    return cube
+
+
+def get_summary_cube(dataset_key: str, df: pd.DataFrame) -> pd.DataFrame:
+    """Summary cube for a dataset, built once per process and shared read-only."""
+    return get_ingest_cache().get_or_create(("summary_cube", dataset_key), lambda: build_summary_cube(df))
+
+
+def filter_summary_cube(cube: pd.DataFrame, selected_customers: List, date_range) -> pd.DataFrame:
+    """Apply the dashboard's customer and delivery-date filters at cube grain."""
+    mask = pd.Series(True, index=cube.index)
+    if selected_customers and "customer" in cube.columns:
+        mask &= cube["customer"].isin(selected_customers)
+    if date_range and "deliverdate_dt" in cube.columns:
+        start, end = pd.Timestamp(date_range[0]), pd.Timestamp(date_range[1]) + pd.Timedelta(days=1)
+        dt = cube["deliverdate_dt"]
+        mask &= dt.notna() & (dt >= start) & (dt < end)
+    return cube[mask]
+
+
+def rollup_cube(cube: pd.DataFrame, by, **aggs) -> pd.DataFrame:
+    """Roll the cube up to `by`, sorted by Total_Units descending."""
+    aggs = aggs or {"Total_Units": ("Units", "sum")}
+    return (
+        cube.groupby(by, observed=True)
+        .agg(**aggs)
+        .reset_index()
+        .sort_values("Total_Units", ascending=False)
+    )
 
-    df_g = df.copy()
 
-    if license_id_filter:
-        df_g = df_g[df_g["licenseID"] == license_id_filter]
+# =========================
+# ROW INDEXES (customer / delivery date)
+# =========================
 
-    if lot_filter:
-        df_g = df_g[df_g["LotNumber"] == lot_filter]
+# Row-level columns still needed after filtering (graph, lot counts, graph filters).
+FILTERED_ROW_COLUMNS = [
+    "Suppliername",
+    "DeviceName",
+    "customer",
+    "ModelNum",
+    "LotNumber",
+    "licenseID",
+    "Numbers",
+    "deliverdate_dt",
+]
 
-    G = nx.DiGraph()
 
-    search_lower = search_term.lower() if search_term else None
+class PackingListIndex:
+    """
+    Sorted-position indexes built once per dataset.
 
-    edge_count = 0
-    for _, row in df_g.iterrows():
-        supplier = str(row.get("Suppliername", "")).strip()
-        device = str(row.get("DeviceName", "")).strip()
-        customer = str(row.get("customer", "")).strip()
-        qty = int(row.get("Numbers", 0))
+    Rows are grouped by customer code (argsort + offsets) and ordered by
+    delivery day, so filter changes become slice lookups and bitmap ANDs
+    instead of per-row comparisons over the full frame.
+    """
 
-        if not supplier and not device and not customer:
-            continue
+    def __init__(self, df: pd.DataFrame):
+        self.n_rows = len(df)
 
-        # Add nodes with type
-        if supplier:
-            if supplier not in G:
-                if G.number_of_nodes() >= max_nodes:
-                    continue
-                G.add_node(supplier, type="supplier")
-        if device:
-            if device not in G:
-                if G.number_of_nodes() >= max_nodes:
-                    continue
-                G.add_node(device, type="device")
-        if customer:
-            if customer not in G:
-                if G.number_of_nodes() >= max_nodes:
-                    continue
-                G.add_node(customer, type="customer")
+        self.customers: List = []
+        self._customer_order = None
+        self._customer_offsets = None
+        self._customer_code = {}
+        self.has_missing_customer = False
+        if "customer" in df.columns:
+            codes, uniques = pd.factorize(df["customer"])
+            # Renumber codes so customers come out in lexical order for the filter widget.
+            lexical = sorted(range(len(uniques)), key=lambda i: str(uniques[i]))
+            remap = np.empty(len(uniques) + 1, dtype=np.intp)
+            remap[lexical] = np.arange(len(uniques))
+            remap[-1] = -1
+            codes = remap[codes]
+            order = np.argsort(codes, kind="stable")
+            self._customer_order = order
+            self._customer_offsets = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+            self.customers = [uniques[i] for i in lexical]
+            self._customer_code = {value: i for i, value in enumerate(self.customers)}
+            self.has_missing_customer = bool((codes < 0).any())
+
+        self._date_order = None
+        self._date_days = None
+        if "deliverdate_dt" in df.columns:
+            days = df["deliverdate_dt"].to_numpy(dtype="datetime64[ns]").astype("datetime64[D]")
+            valid = np.flatnonzero(~np.isnat(days))
+            order = valid[np.argsort(days[valid], kind="stable")]
+            self._date_order = order
+            self._date_days = days[order]
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [self._customer_order, self._customer_offsets, self._date_order, self._date_days]
+        return sum(a.nbytes for a in arrays if a is not None)
+
+    def date_bounds(self):
+        """(min, max) delivery date as datetime.date, or None when no valid dates exist."""
+        if self._date_days is None or len(self._date_days) == 0:
+            return None
+        return pd.Timestamp(self._date_days[0]).date(), pd.Timestamp(self._date_days[-1]).date()
+
+    def customer_positions(self, customers: List) -> np.ndarray:
+        codes = [self._customer_code[c] for c in customers if c in self._customer_code]
+        if not codes:
+            return np.empty(0, dtype=np.intp)
+        return np.concatenate(
+            [self._customer_order[self._customer_offsets[c] : self._customer_offsets[c + 1]] for c in codes]
+        )
 
-        # Highlight logic
-        def should_highlight(name: str) -> bool:
-            if not search_lower:
-                return False
-            return search_lower in name.lower()
-
-        if supplier and should_highlight(supplier):
-            G.nodes[supplier]["highlight"] = True
-        if device and should_highlight(device):
-            G.nodes[device]["highlight"] = True
-        if customer and should_highlight(customer):
-            G.nodes[customer]["highlight"] = True
-
-        # Add edges with limits
-        if supplier and device:
-            if edge_count >= max_edges:
-                break
-            if not G.has_edge(supplier, device):
-                G.add_edge(supplier, device, weight=qty)
-                edge_count += 1
+    def date_positions(self, start, end) -> np.ndarray:
+        lo = np.searchsorted(self._date_days, np.datetime64(start, "D"), side="left")
+        hi = np.searchsorted(self._date_days, np.datetime64(end, "D"), side="right")
+        return self._date_order[lo:hi]
 
-        if device and customer:
-            if edge_count >= max_edges:
-                break
-            if not G.has_edge(device, customer):
-                G.add_edge(device, customer, weight=qty)
-                edge_count += 1
+    def select(self, selected_customers: List, date_range) -> Optional[np.ndarray]:
+        """
+        Sorted row positions matching the dashboard filters, or None when every
+        row matches (callers can then skip the row gather).
+        """
+        mask = None
 
-    log_event(
-        "graph_build",
-        f"nodes={G.number_of_nodes()}, edges={G.number_of_edges()}, "
-        f"license={license_id_filter or 'All'}, lot={lot_filter or 'All'}, "
-        f"search={search_term or ''}, max_nodes={max_nodes}, max_edges={max_edges}",
-    )
+        def restrict(positions):
+            nonlocal mask
+            bits = np.zeros(self.n_rows, dtype=bool)
+            bits[positions] = True
+            mask = bits if mask is None else (mask & bits)
 
-    net = Network(height="100%", width="100%", directed=True, bgcolor="#0b1120", font_color="#e5e7eb")
-    net.from_nx(G)
+        if selected_customers and self._customer_order is not None:
+            if len(selected_customers) < len(self.customers) or self.has_missing_customer:
+                restrict(self.customer_positions(selected_customers))
 
-    # Apply node styling by type and highlight
-    for node in net.nodes:
-        n_type = node.get("type", "")
-        highlight = node.get("highlight", False)
+        if date_range and self._date_order is not None:
+            if len(self._date_order) < self.n_rows or (date_range[0], date_range[1]) != self.date_bounds():
+                restrict(self.date_positions(date_range[0], date_range[1]))
 
-        if n_type == "supplier":
-            base_color = "#38bdf8"  # sky blue
-        elif n_type == "device":
-            base_color = "#22c55e"  # green
-        elif n_type == "customer":
-            base_color = "#f97316"  # orange
-        else:
-            base_color = "#e5e7eb"
+        return None if mask is None else np.flatnonzero(mask)
 
-        if highlight:
-            node["color"] = {"background": "#facc15", "border": "#f97316"}
-            node["size"] = 28
-        else:
-            node["color"] = {"background": base_color, "border": "#e5e7eb"}
-            node["size"] = 18
 
-        node["shape"] = "dot"
+def get_packing_list_index(dataset_key: str, df: pd.DataFrame) -> PackingListIndex:
+    """Row indexes for a dataset, built once per process and shared read-only."""
+    return get_ingest_cache().get_or_create(
+        ("row_index", dataset_key),
+        lambda: PackingListIndex(df),
+    )
 
-    return net
 
+def filtered_rows(df: pd.DataFrame, positions: Optional[np.ndarray], columns: List[str]) -> pd.DataFrame:
+    """
+    `columns` of the rows at `positions` (all rows when None). The schema never
+    depends on whether a filter is active; without one the projection is a
+    copy-on-write view of the shared frame, so no row data is copied.
+    """
+    projected = df[[c for c in columns if c in df.columns]]
+    return projected if positions is None else projected.take(positions)
 
-def render_supply_chain_graph(net: Optional[Network], height: int = 520):
-    """Render supply chain graph safely in Streamlit / Hugging Face Space."""
-    if net is None:
-        st.warning("networkx / pyvis not installed; graph view unavailable.")
-        return
 
-    net.set_options(
-        """
-        var options = {
-          "nodes": {
-            "borderWidth": 1,
-            "size": 16,
-            "font": {"size": 16}
-          },
-          "edges": {
-            "arrows": {"to": {"enabled": true}},
-            "color": {"inherit": "from"},
-            "smooth": false
-          },
-          "physics": {
-            "enabled": true,
-            "stabilization": {"iterations": 500}
-          }
+# =========================
+# LOT / UDI TRACEABILITY INDEX
+# =========================
+
+TRACE_INDEX_DIR = os.path.join(GUDID_DATA_DIR, "trace_index")
+TRACE_INDEX_VERSION = "3"
+
+# Identifier columns with postings lists, and the row payload kept for recall answers.
+TRACE_KEY_COLUMNS = ["LotNumber", "UDI", "SN", "licenseID"]
+TRACE_ROW_COLUMNS = [
+    "deliverdate_dt",
+    "customer",
+    "Suppliername",
+    "DeviceName",
+    "ModelNum",
+    "LotNumber",
+    "UDI",
+    "SN",
+    "licenseID",
+    "Numbers",
+]
+
+TRACE_DICTIONARY_COLUMNS = ARROW_DICTIONARY_COLUMNS + ["ModelNum", "UDI"]
+
+
+def normalize_trace_keys(values) -> np.ndarray:
+    """
+    Identifier strings as compared by the index: stripped, NA → ''.
+
+    Integral floats (numeric serials read before SN was typed as text, e.g.
+    in older persisted datasets) are written without the trailing ".0".
+    """
+    s = pd.Series(values)
+    if pd.api.types.is_float_dtype(s.dtype) and (s.dropna() % 1 == 0).all():
+        s = s.astype("Int64")
+    return s.astype("string").str.strip().fillna("").to_numpy(dtype=object)
+
+
+def hash_trace_keys(keys: np.ndarray) -> np.ndarray:
+    return pd.util.hash_array(keys, categorize=True)
+
+
+def row_hashes(df: pd.DataFrame, columns: List[str]) -> np.ndarray:
+    """64-bit identity of each row over `columns`, hashed as text so dtypes do not matter."""
+    hashes = np.zeros(len(df), dtype=np.uint64)
+    for col in columns:
+        # Hash each distinct value once and gather by code.
+        codes, uniques = pd.factorize(df[col], use_na_sentinel=True)
+        value_hashes = pd.util.hash_array(np.append(pd.Index(uniques).astype(str).to_numpy(dtype=object), "\x00NA"))
+        hashes = (hashes ^ value_hashes[np.where(codes >= 0, codes, len(uniques))]) * np.uint64(0x100000001B3)
+    return hashes
+
+
+class TracePostings:
+    """
+    CSR postings for one identifier column: sorted unique key hashes, offsets
+    into `positions` (row numbers grouped by key). Stored as .npy files and
+    memory-mapped, so opening a segment reads no postings up front.
+    """
+
+    def __init__(self, keys: np.ndarray, offsets: np.ndarray, positions: np.ndarray):
+        self.keys = keys
+        self.offsets = offsets
+        self.positions = positions
+
+    @classmethod
+    def build(cls, values) -> "TracePostings":
+        keys = normalize_trace_keys(values)
+        rows = np.flatnonzero(keys != "")
+        hashes = hash_trace_keys(keys[rows])
+        order = np.argsort(hashes, kind="stable")
+        sorted_hashes = hashes[order]
+        unique, counts = np.unique(sorted_hashes, return_counts=True)
+        offsets = np.zeros(len(unique) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(unique, offsets, rows[order].astype(np.uint32))
+
+    def save(self, directory: str, column: str):
+        for part in ("keys", "offsets", "positions"):
+            np.save(os.path.join(directory, f"{column}.{part}.npy"), getattr(self, part))
+
+    @classmethod
+    def load(cls, directory: str, column: str) -> "TracePostings":
+        return cls(
+            *(
+                np.load(os.path.join(directory, f"{column}.{part}.npy"), mmap_mode="r")
+                for part in ("keys", "offsets", "positions")
+            )
+        )
+
+    def lookup(self, hashes: np.ndarray):
+        """(query index, row position) pairs for every row whose key hash matches a query hash."""
+        if len(self.keys) == 0 or len(hashes) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self.keys, hashes), len(self.keys) - 1)
+        hit = np.flatnonzero(self.keys[idx] == hashes)
+        starts = self.offsets[idx[hit]]
+        lengths = self.offsets[idx[hit] + 1] - starts
+        total = int(lengths.sum())
+        # Ragged gather: every position in [start, start + length) for each hit.
+        gather = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+        return np.repeat(hit, lengths), np.asarray(self.positions[gather], dtype=np.int64)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.keys.nbytes + self.offsets.nbytes + self.positions.nbytes)
+
+
+class TraceSegment:
+    """One ingested file: its trace rows (Arrow IPC, memory-mapped) plus postings per identifier column."""
+
+    def __init__(self, directory: str, meta: Dict):
+        self.directory = directory
+        self.meta = meta
+        self.dataset_key = meta["dataset_key"]
+        self.rows = feather.read_table(os.path.join(directory, "rows.arrow"), memory_map=True)
+        self.postings = {col: TracePostings.load(directory, col) for col in meta["columns"]}
+
+    @staticmethod
+    def write(directory: str, df: pd.DataFrame, dataset_key: str, name: str = "") -> Dict:
+        tmp_dir = f"{directory}.tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        rows = df[[c for c in TRACE_ROW_COLUMNS if c in df.columns]]
+        rows = rows.assign(row_hash=row_hashes(rows, list(rows.columns)))
+        feather.write_feather(
+            dictionary_encode_columns(pa.Table.from_pandas(rows, preserve_index=False), TRACE_DICTIONARY_COLUMNS),
+            os.path.join(tmp_dir, "rows.arrow"),
+            compression="uncompressed",
+        )
+        columns = [c for c in TRACE_KEY_COLUMNS if c in df.columns]
+        for col in columns:
+            TracePostings.build(df[col]).save(tmp_dir, col)
+        meta = {
+            "dataset_key": dataset_key,
+            "name": name or dataset_key,
+            "rows": len(df),
+            "columns": columns,
+            "version": TRACE_INDEX_VERSION,
+            "created": datetime.now().isoformat(timespec="seconds"),
         }
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_dir, directory)
+        return meta
+
+    def lookup(self, column: str, values: np.ndarray) -> pd.DataFrame:
+        """Rows whose `column` equals one of `values` (normalized keys), with the matched value."""
+        if column not in self.postings:
+            return pd.DataFrame()
+        query_idx, positions = self.postings[column].lookup(hash_trace_keys(values))
+        if len(positions) == 0:
+            return pd.DataFrame()
+        rows = self.rows.take(pa.array(positions)).to_pandas()
+        rows.insert(0, "matched_value", values[query_idx])
+        # Hash collisions are astronomically rare but cheap to rule out.
+        rows = rows[normalize_trace_keys(rows[column]) == rows["matched_value"].to_numpy(dtype=object)]
+        rows.insert(0, "row", positions[rows.index.to_numpy()])
+        rows.insert(0, "dataset", self.meta["name"])
+        return rows.reset_index(drop=True)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(p.nbytes for p in self.postings.values())
+
+
+class TraceIndex:
+    """
+    Persistent, append-only inverted index from UDI / LotNumber / SN / licenseID
+    to the rows that carry them, across every ingested file.
+
+    Each file becomes an immutable segment directory; manifest.json lists them,
+    so adding a file never rewrites existing segments. Processes sharing the
+    directory serialize manifest updates on manifest.lock.
+    """
+
+    def __init__(self, root: str = TRACE_INDEX_DIR):
+        self.root = root
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self._segments: "OrderedDict[str, TraceSegment]" = OrderedDict()
+        self._manifest_mtime: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        """Open segments listed in the manifest (e.g. added by another process)."""
+        mtime = file_mtime(self.manifest_path)
+        if mtime == self._manifest_mtime:
+            return
+        keys = []
+        if mtime is not None:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            # Segments from another index version are rebuilt as files are re-indexed.
+            if manifest.get("version") == TRACE_INDEX_VERSION:
+                keys = manifest.get("segments", [])
+        for key in keys:
+            if key not in self._segments:
+                directory = self._segment_dir(key)
+                with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+                    self._segments[key] = TraceSegment(directory, json.load(f))
+        self._manifest_mtime = mtime
+
+    def segments(self) -> List[TraceSegment]:
+        with self._lock:
+            self._refresh()
+            return list(self._segments.values())
+
+    def _segment_dir(self, dataset_key: str) -> str:
+        return os.path.join(self.root, f"{dataset_key}.v{TRACE_INDEX_VERSION}")
+
+    def has(self, dataset_key: str) -> bool:
+        return any(s.dataset_key == dataset_key for s in self.segments())
+
+    def add(self, df: pd.DataFrame, dataset_key: str, name: str = "") -> bool:
+        """Index a dataset as a new segment; returns False if it was already indexed."""
+        with self._lock:
+            self._refresh()
+            if dataset_key in self._segments:
+                return False
+            os.makedirs(self.root, exist_ok=True)
+            with open(os.path.join(self.root, "manifest.lock"), "a") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # Re-read under the lock (mtime can miss a write in the same tick) so
+                # segments another process added since our last refresh are kept.
+                self._manifest_mtime = None
+                self._refresh()
+                if dataset_key in self._segments:
+                    return False
+                directory = self._segment_dir(dataset_key)
+                if not os.path.isdir(directory):
+                    TraceSegment.write(directory, df, dataset_key, name)
+                with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+                    self._segments[dataset_key] = TraceSegment(directory, json.load(f))
+                tmp_path = f"{self.manifest_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"version": TRACE_INDEX_VERSION, "segments": list(self._segments)}, f)
+                os.replace(tmp_path, self.manifest_path)
+                self._manifest_mtime = file_mtime(self.manifest_path)
+            return True
+
+    def trace(self, column: str, values: List[str]) -> Dict:
         """
-    )
+        Batched recall trace: every row, across all segments, whose `column`
+        matches one of `values`.
 
-    try:
-        html = net.generate_html(notebook=False)
-    except Exception:
-        tmp_path = "supply_chain_graph.html"
-        net.write_html(tmp_path, notebook=False)
-        with open(tmp_path, "r", encoding="utf-8") as f:
-            html = f.read()
+        Returns {"rows", "by_customer", "unmatched", "seconds"}; by_customer has
+        Units / Lines / Lots / first and last delivery per customer.
+        """
+        started = time.perf_counter()
+        queries = np.unique(normalize_trace_keys(values))
+        queries = queries[queries != ""]
+        frames, seen = [], []
+        for segment in self.segments():
+            found = segment.lookup(column, queries)
+            if found.empty:
+                continue
+            # A row already traced in an earlier file (overlapping drops) counts once.
+            hashes = found.pop("row_hash").to_numpy(dtype=np.uint64)
+            if seen:
+                found = found[~np.isin(hashes, np.concatenate(seen))]
+            seen.append(hashes)
+            frames.append(found)
+        frames = [f for f in frames if not f.empty]
+        if frames:
+            rows = pd.concat(frames, ignore_index=True)
+        else:
+            rows = pd.DataFrame(columns=["dataset", "row", "matched_value"])
+        matched = set(rows["matched_value"]) if len(rows) else set()
+
+        by_customer = pd.DataFrame()
+        if len(rows) and "customer" in rows.columns:
+            qty = rows["Numbers"] if "Numbers" in rows.columns else pd.Series(1, index=rows.index)
+            aggs = {"Units": ("qty", "sum"), "Lines": ("qty", "size")}
+            if "LotNumber" in rows.columns:
+                aggs["Lots"] = ("LotNumber", "nunique")
+            if "deliverdate_dt" in rows.columns:
+                aggs["First_delivery"] = ("deliverdate_dt", "min")
+                aggs["Last_delivery"] = ("deliverdate_dt", "max")
+            by_customer = (
+                rows.assign(qty=qty)
+                .groupby("customer", observed=True)
+                .agg(**aggs)
+                .sort_values("Units", ascending=False)
+                .reset_index()
+            )
+        return {
+            "rows": rows,
+            "by_customer": by_customer,
+            "unmatched": [v for v in queries if v not in matched],
+            "seconds": round(time.perf_counter() - started, 4),
+        }
 
-    components.html(html, height=height, scrolling=True)
+    def stats(self) -> Dict:
+        segments = self.segments()
+        return {
+            "segments": len(segments),
+            "rows": sum(s.meta["rows"] for s in segments),
+            "postings_mb": round(sum(s.nbytes for s in segments) / 1e6, 1),
+        }
 
 
-# =========================
-# MODEL MAP
-# =========================
+@st.cache_resource
+def get_trace_index() -> TraceIndex:
+    return TraceIndex()
 
-MODEL_PROVIDER_MAP = {
-    "gpt-4o-mini": "openai",
-    "gpt-4.1-mini": "openai",
-    "gemini-2.5-flash": "gemini",
-    "gemini-2.5-flash-lite": "gemini",
-    "claude-3-5-sonnet-latest": "anthropic",
-    "claude-3-haiku-latest": "anthropic",
-    "grok-4-fast-reasoning": "grok",
-    "grok-3-mini": "grok",
-}
+
+def recall_trace(column: str, values: List[str]) -> Dict:
+    """Recall-trace API: affected rows and per-customer totals for a batch of lots / UDIs / SNs / licenses."""
+    return get_trace_index().trace(column, values)
+
+
+def index_packing_list(df: pd.DataFrame, dataset_key: str, name: str = "") -> bool:
+    """Add an ingested file to the trace index (no-op without pyarrow or when already indexed)."""
+    if pa is None:
+        return False
+    added = get_trace_index().add(df, dataset_key, name)
+    if added:
+        log_event("trace_index_segment", f"dataset={dataset_key}, rows={len(df)}")
+    return added
 
 
 # =========================
-# AGENT IMPLEMENTATION
+# PARTITIONED DATASET STORE (append-only, monthly partitions)
 # =========================
 
-class Agent:
-    """Individual agent for specific GUDID use case"""
+STORE_DIR = os.path.join(GUDID_DATA_DIR, "store")
+STORE_VERSION = "1"
+STORE_UNDATED_PARTITION = "undated"
+STORE_DEFAULT_WINDOW_DAYS = int(os.getenv("GUDID_STORE_WINDOW_DAYS", "90"))
+# Source-selector value for the store (persisted dataset keys are hex digests).
+STORE_CHOICE = "__store__"
+
+# Columns derived from the whole loaded frame; recomputed per window instead of stored.
+STORE_DERIVED_COLUMNS = ["udi_quality"]
+
+
+def store_row_hashes(df: pd.DataFrame) -> np.ndarray:
+    """Row identity over the source columns, used to drop rows already in the store."""
+    return row_hashes(df, sorted(c for c in df.columns if c not in STORE_DERIVED_COLUMNS + ["deliverdate_dt"]))
+
+
+def store_month(dates: pd.Series) -> np.ndarray:
+    """Partition name per row: "YYYY-MM", or STORE_UNDATED_PARTITION."""
+    months = dates.to_numpy(dtype="datetime64[ns]").astype("datetime64[M]")
+    codes, uniques = pd.factorize(months, use_na_sentinel=True)
+    names = np.array([str(m) for m in uniques] + [STORE_UNDATED_PARTITION], dtype=object)
+    return names[np.where(codes >= 0, codes, len(uniques))]
+
+
+class DatasetStore:
+    """
+    Append-only store of packing-list files, partitioned by delivery month.
+
+    Each appended file becomes one immutable part per month it touches
+    (rows, a summary cube and sorted row hashes); manifest.json lists files
+    and parts. Appending never rewrites existing parts, and date-window
+    queries only open the months they overlap.
+    """
+
+    def __init__(self, root: str = STORE_DIR):
+        self.root = root
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self._manifest: Dict = {"version": STORE_VERSION, "generation": 0, "files": {}, "partitions": {}}
+        self._manifest_mtime: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        """Reload the manifest when another session or process changed it."""
+        mtime = file_mtime(self.manifest_path)
+        if mtime is not None and mtime != self._manifest_mtime:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self._manifest = json.load(f)
+            self._manifest_mtime = mtime
+
+    def _write_manifest(self):
+        tmp_path = f"{self.manifest_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+        self._manifest_mtime = file_mtime(self.manifest_path)
+
+    def _path(self, partition: str, file_key: str, suffix: str) -> str:
+        return os.path.join(self.root, "parts", partition, f"{file_key}{suffix}")
+
+    def manifest(self) -> Dict:
+        with self._lock:
+            self._refresh()
+            return json.loads(json.dumps(self._manifest))
+
+    @property
+    def generation(self) -> int:
+        return self.manifest()["generation"]
+
+    def has(self, file_key: str) -> bool:
+        return file_key in self.manifest()["files"]
+
+    def append(self, df: pd.DataFrame, file_key: str, name: str = "") -> Dict:
+        """
+        Add one parsed file. Rows whose source columns match a row already in
+        the same month are skipped; the file is a no-op if it was appended
+        before. Returns {"rows", "added", "duplicates", "partitions", "skipped"}.
+        """
+        with self._lock:
+            self._refresh()
+            if file_key in self._manifest["files"]:
+                return {**self._manifest["files"][file_key], "skipped": True}
+            started = time.perf_counter()
+            df = df.drop(columns=[c for c in STORE_DERIVED_COLUMNS if c in df.columns])
+            hashes = store_row_hashes(df)
+            months = (
+                store_month(df["deliverdate_dt"])
+                if "deliverdate_dt" in df.columns
+                else np.full(len(df), STORE_UNDATED_PARTITION, dtype=object)
+            )
+            added, touched = 0, []
+            for partition in sorted(set(months)):
+                rows = np.flatnonzero(months == partition)
+                existing = [
+                    np.load(self._path(partition, part["file"], ".hashes.npy"), mmap_mode="r")
+                    for part in self._manifest["partitions"].get(partition, [])
+                ]
+                if existing:
+                    rows = rows[~np.isin(hashes[rows], np.concatenate(existing))]
+                if not len(rows):
+                    continue
+                part_df = df.iloc[rows].reset_index(drop=True)
+                self._write_part(partition, file_key, part_df, np.sort(hashes[rows]))
+                dates = part_df.get("deliverdate_dt", pd.Series(dtype="datetime64[ns]"))
+                self._manifest["partitions"].setdefault(partition, []).append(
+                    {
+                        "file": file_key,
+                        "rows": len(part_df),
+                        "min_date": str(dates.min().date()) if dates.notna().any() else None,
+                        "max_date": str(dates.max().date()) if dates.notna().any() else None,
+                    }
+                )
+                added += len(part_df)
+                touched.append(partition)
+            info = {
+                "name": name or file_key,
+                "rows": len(df),
+                "added": added,
+                "duplicates": len(df) - added,
+                "partitions": touched,
+                "seconds": round(time.perf_counter() - started, 3),
+                "ingested": datetime.now().isoformat(timespec="seconds"),
+            }
+            self._manifest["files"][file_key] = info
+            self._manifest["generation"] += 1
+            self._write_manifest()
+            return {**info, "skipped": False}
+
+    def _write_part(self, partition: str, file_key: str, part_df: pd.DataFrame, hashes: np.ndarray):
+        directory = os.path.dirname(self._path(partition, file_key, ""))
+        os.makedirs(directory, exist_ok=True)
+        suffix = f".tmp-{os.getpid()}-{threading.get_ident()}"
+        table = dictionary_encode_columns(pa.Table.from_pandas(part_df, preserve_index=False), ARROW_DICTIONARY_COLUMNS)
+        cube = pa.Table.from_pandas(build_summary_cube(part_df), preserve_index=False)
+        for table_, ext in ((table, ".arrow"), (cube, ".cube.arrow")):
+            path = self._path(partition, file_key, ext)
+            feather.write_feather(table_, path + suffix, compression="uncompressed")
+            os.replace(path + suffix, path)
+        path = self._path(partition, file_key, ".hashes.npy")
+        with open(path + suffix, "wb") as f:
+            np.save(f, hashes)
+        os.replace(path + suffix, path)
+
+    def _parts(self, start=None, end=None) -> List[tuple]:
+        """(partition, part) pairs whose dates overlap [start, end]; undated parts only for unbounded queries."""
+        lo = str(pd.Timestamp(start).date()) if start is not None else None
+        hi = str(pd.Timestamp(end).date()) if end is not None else None
+        selected = []
+        for partition, parts in sorted(self.manifest()["partitions"].items()):
+            for part in parts:
+                if part["min_date"] is None:
+                    if lo is None and hi is None:
+                        selected.append((partition, part))
+                    continue
+                if (hi is None or part["min_date"] <= hi) and (lo is None or part["max_date"] >= lo):
+                    selected.append((partition, part))
+        return selected
+
+    def _read(self, path: str, columns: Optional[List[str]], start, end) -> pd.DataFrame:
+        """Memory-map one part file, keep the requested columns and the rows inside the window."""
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+        if "deliverdate_dt" in table.schema.names and (start is not None or end is not None):
+            dates = table.column("deliverdate_dt")
+            mask = pc.is_valid(dates)
+            if start is not None:
+                mask = pc.and_(mask, pc.greater_equal(dates, pa.scalar(pd.Timestamp(start), dates.type)))
+            if end is not None:
+                end_exclusive = pd.Timestamp(end) + pd.Timedelta(days=1)
+                mask = pc.and_(mask, pc.less(dates, pa.scalar(end_exclusive, dates.type)))
+            table = table.filter(mask)
+        if columns is not None:
+            table = table.select([c for c in columns if c in table.schema.names])
+        return table.to_pandas()
+
+    def load(self, start=None, end=None, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Rows delivered in [start, end] (dates inclusive; None = unbounded) across all parts."""
+        frames = [
+            self._read(self._path(partition, part["file"], ".arrow"), columns, start, end)
+            for partition, part in self._parts(start, end)
+        ]
+        frames = [f for f in frames if len(f)]
+        if not frames:
+            return pd.DataFrame(columns=columns or [])
+        df = _concat_chunks(frames)
+        if "UDI" in df.columns:
+            df["udi_quality"] = udi_quality_flags(df)
+        return df
+
+    def cube(self, start=None, end=None) -> pd.DataFrame:
+        """Summary cube for the window, rolled up from the per-part cubes (no row data is read)."""
+        frames = [
+            self._read(self._path(partition, part["file"], ".cube.arrow"), None, start, end)
+            for partition, part in self._parts(start, end)
+        ]
+        frames = [f for f in frames if len(f)]
+        if not frames:
+            return pd.DataFrame(columns=["Units", "Lines"])
+        cube = _concat_chunks(frames)
+        dims = [c for c in CUBE_DIMENSIONS if c in cube.columns]
+        return cube.groupby(dims, observed=True, dropna=False, sort=False)[["Units", "Lines"]].sum().reset_index()
+
+    def date_bounds(self):
+        dated = [part for _, part in self._parts() if part["min_date"] is not None]
+        if not dated:
+            return None
+        return (
+            pd.Timestamp(min(p["min_date"] for p in dated)).date(),
+            pd.Timestamp(max(p["max_date"] for p in dated)).date(),
+        )
 
-    def __init__(self, name: str, config: Dict):
-        self.name = name
-        self.config = config
-        self.llm_provider = config.get("llm_provider", "openai")
-        self.model = config.get("model", "gpt-4o-mini")
-        self.system_prompt = config.get("system_prompt", "")
-        self.capabilities = config.get("capabilities", [])
+    def stats(self) -> Dict:
+        manifest = self.manifest()
+        parts = [part for parts in manifest["partitions"].values() for part in parts]
+        return {
+            "files": len(manifest["files"]),
+            "partitions": len(manifest["partitions"]),
+            "parts": len(parts),
+            "rows": sum(p["rows"] for p in parts),
+            "duplicates_skipped": sum(f["duplicates"] for f in manifest["files"].values()),
+            "generation": manifest["generation"],
+        }
 
-    def execute(
-        self,
-        query: str,
-        system_prompt_override: Optional[str] = None,
-        model_override: Optional[str] = None,
-        max_tokens: int = 12000,
-    ) -> str:
-        effective_model = model_override or self.model
-        effective_system = system_prompt_override or self.system_prompt
 
-        provider = self.llm_provider
-        if model_override and model_override in MODEL_PROVIDER_MAP:
-            provider = MODEL_PROVIDER_MAP[model_override]
+@st.cache_resource
+def get_dataset_store() -> DatasetStore:
+    return DatasetStore()
 
-        try:
-            if provider == "openai":
-                return self._execute_openai(query, effective_model, effective_system, max_tokens)
-            elif provider == "anthropic":
-                return self._execute_anthropic(query, effective_model, effective_system, max_tokens)
-            elif provider == "gemini":
-                return self._execute_gemini(query, effective_model, effective_system, max_tokens)
-            elif provider == "grok":
-                return self._execute_grok(query, effective_model, effective_system, max_tokens)
-            else:
-                return f"Unsupported LLM provider: {provider}"
-        except Exception as e:
-            return f"Error executing agent {self.name}: {str(e)}"
 
-    def _execute_openai(self, query: str, model: str, system_prompt: str, max_tokens: int) -> str:
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            return "OpenAI API key not configured"
-        if openai is None:
-            return "OpenAI library not installed"
+def append_to_store(csv_file) -> Dict:
+    """Parse an upload (via the ingest cache, which also indexes it for recall traces) and append it to the store."""
+    dataset_key, df = load_packing_list_cached(csv_file)
+    result = get_dataset_store().append(df, dataset_key, name=getattr(csv_file, "name", ""))
+    if not result["skipped"]:
+        log_event("store_append", f"file={result['name']}, added={result['added']}, duplicates={result['duplicates']}")
+    return result
 
-        client = openai.OpenAI(api_key=api_key) if hasattr(openai, "OpenAI") else openai
 
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": query},
-        ]
+def load_packing_lists_cached(csv_files: List):
+    """
+    (dataset_key, DataFrame) for the sample, one upload, or several uploads
+    analysed together. Several files are combined like the store does: rows
+    already present in an earlier file are dropped, and UDI quality is
+    recomputed over the union.
+    """
+    if len(csv_files) <= 1:
+        return load_packing_list_cached(csv_files[0] if csv_files else None)
+    parsed = [load_packing_list_cached(f) for f in csv_files]
+    dataset_key = hashlib.blake2b("+".join(key for key, _ in parsed).encode("utf-8"), digest_size=16).hexdigest()
 
-        if hasattr(client, "chat") and hasattr(client.chat, "completions"):
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=max_tokens,
-            )
-            return response.choices[0].message.content
-        else:
-            completion = client.Completion.create(
-                model=model,
-                prompt=f"{system_prompt}\n\nUser: {query}\nAssistant:",
-                max_tokens=max_tokens,
-                temperature=0.7,
-            )
-            return completion.choices[0].text
+    def combine():
+        frames, seen = [], []
+        for _, frame in parsed:
+            hashes = store_row_hashes(frame)
+            keep = ~np.isin(hashes, np.concatenate(seen)) if seen else np.ones(len(frame), dtype=bool)
+            # Shallow copies: _concat_chunks re-types columns and the cached frames are shared.
+            frames.append(frame[keep].copy(deep=False))
+            seen.append(hashes)
+        df = _concat_chunks(frames)
+        if "UDI" in df.columns:
+            df["udi_quality"] = udi_quality_flags(df)
+        return df
 
-    def _execute_anthropic(self, query: str, model: str, system_prompt: str, max_tokens: int) -> str:
-        api_key = os.getenv("ANTHROPIC_API_KEY")
-        if not api_key:
-            return "Anthropic API key not configured"
-        if Anthropic is None:
-            return "Anthropic library not installed"
+    return dataset_key, get_ingest_cache().get_or_create(("packing_lists", dataset_key), combine)
 
-        client = Anthropic(api_key=api_key)
-        response = client.messages.create(
-            model=model,
-            max_tokens=max_tokens,
-            system=system_prompt,
-            messages=[{"role": "user", "content": query}],
-        )
-        return response.content[0].text
 
-    def _execute_gemini(self, query: str, model: str, system_prompt: str, max_tokens: int) -> str:
-        api_key = os.getenv("GEMINI_API_KEY")
-        if not api_key:
-            return "Gemini API key not configured"
-        if genai is None:
-            return "Google Generative AI library not installed"
+def store_window_key(start, end) -> str:
+    """Dataset key for a store window; changes whenever a file is appended."""
+    return f"store-{get_dataset_store().generation}-{start}-{end}"
 
+
+def load_store_window_cached(start, end, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Shared, read-only rows of a store window (see load_packing_list_cached)."""
+    cache_key = ("store", store_window_key(start, end), tuple(columns) if columns is not None else None)
+    return get_ingest_cache().get_or_create(cache_key, lambda: get_dataset_store().load(start, end, columns))
+
+
+def get_store_cube(start, end) -> pd.DataFrame:
+    return get_ingest_cache().get_or_create(
+        ("summary_cube", store_window_key(start, end)), lambda: get_dataset_store().cube(start, end)
+    )
+
+
+# =========================
+# AGENT DATA CONTEXT PACKER
+# =========================
+
+# Heuristic tokenizer ratios when tiktoken is unavailable (or for non-OpenAI
+# models): ASCII characters per token, and tokens per CJK character.
+PROVIDER_TOKEN_RATIOS = {
+    "openai": (4.0, 1.0),
+    "anthropic": (3.5, 1.3),
+    "gemini": (4.0, 1.0),
+    "grok": (4.0, 1.0),
+}
+
+CJK_PATTERN = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+# Long identifiers replaced by short dictionary codes in packed context.
+CONTEXT_CODED_COLUMNS = {"Suppliername": "S", "DeviceName": "D", "licenseID": "L"}
+
+CONTEXT_DEFAULT_BUDGET = 4000
+
+
+@st.cache_resource
+def get_tiktoken_encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def estimate_tokens(text: str, model: str) -> int:
+    """Token count for `model`: exact via tiktoken for OpenAI models, otherwise a CJK-aware estimate."""
+    provider = MODEL_PROVIDER_MAP.get(model, "openai")
+    if provider == "openai" and tiktoken is not None:
+        return len(get_tiktoken_encoding(model).encode(text))
+    ascii_per_token, per_cjk = PROVIDER_TOKEN_RATIOS.get(provider, PROVIDER_TOKEN_RATIOS["openai"])
+    cjk = len(CJK_PATTERN.findall(text))
+    return int(np.ceil((len(text) - cjk) / ascii_per_token + cjk * per_cjk))
+
+
+class ContextBudget:
+    """Accumulates context lines until the token budget is spent, coding long IDs on first use."""
+
+    def __init__(self, model: str, budget_tokens: int):
+        self.model = model
+        self.budget = budget_tokens
+        self.used = 0
+        self.lines: List[str] = []
+        self.codes: Dict[str, Dict[str, str]] = {col: {} for col in CONTEXT_CODED_COLUMNS}
+
+    def add(self, line: str) -> bool:
+        cost = estimate_tokens(line, self.model) + 1
+        if self.used + cost > self.budget:
+            return False
+        self.lines.append(line)
+        self.used += cost
+        return True
+
+    def code(self, column: str, value) -> Optional[str]:
+        """Short code for `value`, reserving room for its legend entry; None when that no longer fits."""
+        value = str(value)
+        codes = self.codes[column]
+        if value not in codes:
+            code = f"{CONTEXT_CODED_COLUMNS[column]}{len(codes) + 1}"
+            cost = estimate_tokens(f"{code}={value}", self.model) + 1
+            if self.used + cost > self.budget:
+                return None
+            codes[value] = code
+            self.used += cost
+        return codes[value]
+
+    def section(self, title: str, header: List[str], rows: List[List]) -> int:
+        """Add a pipe-separated table, as many rows as fit; returns rows included."""
+        if not rows or not self.add(f"\n## {title}\n" + "|".join(header)):
+            return 0
+        included = 0
+        for row in rows:
+            cells = []
+            for col, value in zip(header, row):
+                if col in CONTEXT_CODED_COLUMNS:
+                    value = self.code(col, value)
+                    if value is None:
+                        return included
+                elif isinstance(value, float):
+                    value = f"{value:.2f}"
+                elif isinstance(value, pd.Timestamp):
+                    value = value.strftime("%Y-%m-%d")
+                cells.append(str(value))
+            if not self.add("|".join(cells)):
+                break
+            included += 1
+        return included
+
+    def render(self) -> str:
+        legend = [
+            f"{code}={value}" for column in CONTEXT_CODED_COLUMNS for value, code in self.codes[column].items()
+        ]
+        if legend:
+            return "\n".join(self.lines + ["\n## Code legend"] + legend)
+        return "\n".join(self.lines)
+
+
+def _table_rows(df: pd.DataFrame) -> List[List]:
+    return df.astype(object).where(df.notna(), "").values.tolist()
+
+
+def pack_data_context(
+    df: pd.DataFrame,
+    model: str,
+    budget_tokens: int = CONTEXT_DEFAULT_BUDGET,
+    top_k: int = 20,
+    seed: int = 0,
+) -> Dict:
+    """
+    Compact, token-budgeted representation of filtered packing-list rows.
+
+    Sections are filled in priority order: an overview, aggregate tables
+    (customer, device/model, month), the top-k shipments that are largest
+    relative to their device's median, then a random row sample. Supplier,
+    device and license names are replaced by short codes listed once in a
+    legend. Returns {"text", "tokens", "budget", "sections"}.
+    """
+    packer = ContextBudget(model, budget_tokens)
+    sections: Dict[str, str] = {}
+    qty = df["Numbers"] if "Numbers" in df.columns else pd.Series(1, index=df.index)
+
+    overview = [f"# Packing list context · {len(df):,} lines · {int(qty.sum()):,} units"]
+    if "deliverdate_dt" in df.columns and df["deliverdate_dt"].notna().any():
+        overview.append(
+            f"Delivery dates: {df['deliverdate_dt'].min():%Y-%m-%d} → {df['deliverdate_dt'].max():%Y-%m-%d}"
+        )
+    counts = [
+        f"{col}={df[col].nunique():,}"
+        for col in ("Suppliername", "customer", "DeviceName", "ModelNum", "LotNumber", "licenseID")
+        if col in df.columns
+    ]
+    overview.append("Distinct: " + ", ".join(counts))
+    for line in overview:
+        packer.add(line)
+
+    def add_section(name: str, title: str, table: pd.DataFrame):
+        included = packer.section(title, list(table.columns), _table_rows(table))
+        sections[name] = f"{included}/{len(table)}"
+
+    frame = df.assign(Units=qty)
+    if "customer" in df.columns:
+        by_customer = (
+            frame.groupby("customer", observed=True)
+            .agg(Units=("Units", "sum"), Lines=("Units", "size"))
+            .sort_values("Units", ascending=False)
+            .reset_index()
+        )
+        add_section("by_customer", "Units by customer", by_customer)
+
+    if {"DeviceName", "ModelNum"}.issubset(df.columns):
+        aggs = {"Units": ("Units", "sum"), "Lines": ("Units", "size")}
+        if "customer" in df.columns:
+            aggs["Customers"] = ("customer", "nunique")
+        if "LotNumber" in df.columns:
+            aggs["Lots"] = ("LotNumber", "nunique")
+        by_device = (
+            frame.groupby(["DeviceName", "ModelNum"], observed=True)
+            .agg(**aggs)
+            .sort_values("Units", ascending=False)
+            .reset_index()
+        )
+        add_section("by_device", "Units by device/model", by_device)
+
+    if "deliverdate_dt" in df.columns and df["deliverdate_dt"].notna().any():
+        by_month = (
+            frame.dropna(subset=["deliverdate_dt"])
+            .groupby(frame["deliverdate_dt"].dt.to_period("M").astype(str))
+            .agg(Units=("Units", "sum"), Lines=("Units", "size"))
+            .rename_axis("Month")
+            .reset_index()
+        )
+        add_section("by_month", "Units by month", by_month)
+
+    row_columns = [
+        c
+        for c in ("deliverdate_dt", "Suppliername", "customer", "DeviceName", "ModelNum", "LotNumber", "licenseID", "Numbers")
+        if c in df.columns
+    ]
+    if "Numbers" in df.columns and "DeviceName" in df.columns and len(df):
+        median = df.groupby("DeviceName", observed=True)["Numbers"].transform("median").to_numpy(dtype=float)
+        ratio = df["Numbers"].to_numpy(dtype=float) / np.maximum(median, 1.0)
+        top = np.argsort(-ratio, kind="stable")[:top_k]
+        outliers = df.iloc[top][row_columns].assign(xMedian=ratio[top].round(1))
+        add_section("outliers", f"Top {len(outliers)} shipments vs device median", outliers)
+
+    if len(df):
+        sample_n = min(len(df), 500)
+        sample = df[row_columns].sample(n=sample_n, random_state=seed)
+        add_section("sample", "Sampled rows", sample)
+
+    text = packer.render()
+    return {"text": text, "tokens": estimate_tokens(text, model), "budget": budget_tokens, "sections": sections}
+
+
+# =========================
+# ANOMALY ENGINE (deterministic, vectorized)
+# =========================
+
+# Bit per anomaly rule in the `anomaly_flags` column.
+ANOMALY_FLAGS = {
+    "rolling_z": 1,
+    "seasonal": 2,
+    "new_edge": 4,
+    "quantity_spike": 8,
+    "date_pattern": 16,
+}
+
+ANOMALY_LABELS = {
+    "rolling_z": "Daily units far from the customer/model rolling mean",
+    "seasonal": "Daily units far from the customer/model weekday baseline",
+    "new_edge": "First delivery on a new supplier → customer edge",
+    "quantity_spike": "Line quantity far above the model's typical line",
+    "date_pattern": "Delivery date outside the customer's usual pattern",
+}
+
+ANOMALY_DEFAULTS = {
+    "window": 28,  # prior daily observations in the rolling baseline
+    "min_history": 5,  # observations required before a z-score is trusted
+    "z_threshold": 4.0,
+    "daily_ratio": 4.0,  # daily units must also differ from the baseline by this factor
+    "spike_ratio": 5.0,  # line quantity / model median that counts as a spike
+    "rare_weekday_share": 0.05,  # weekday share below which a delivery is out of pattern
+    "min_deliveries": 20,  # per customer before weekday patterns are judged
+    "new_edge_baseline_days": 30,  # edges seen within this (or the first quarter of the span) are known
+}
+
+# Robust z-scores use MAD scaled to a normal sigma.
+MAD_TO_SIGMA = 1.4826
+
+# Columns the rules read; loaded for the whole dataset rather than the filtered view.
+ANOMALY_COLUMNS = ["deliverdate_dt", "Suppliername", "customer", "DeviceName", "ModelNum", "LotNumber", "Numbers"]
+
+
+def _rolling_prior_stats(values: pd.Series, groups: List[pd.Series], window: int):
+    """Mean / std / count over each row's previous `window` values within its group (rows pre-sorted)."""
+    grouped = values.groupby(groups, sort=False, observed=True)
+    c1 = grouped.cumsum()
+    c2 = (values**2).groupby(groups, sort=False, observed=True).cumsum()
+    position = grouped.cumcount()
+    dropped1 = c1.groupby(groups, sort=False, observed=True).shift(window + 1).fillna(0)
+    dropped2 = c2.groupby(groups, sort=False, observed=True).shift(window + 1).fillna(0)
+    count = np.minimum(position, window).astype(float)
+    total = c1 - values - dropped1
+    total_sq = c2 - values**2 - dropped2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (total / count).fillna(0.0)
+        var = np.maximum(total_sq / count - mean**2, 0.0).fillna(0.0)
+    return mean, np.sqrt(var), count
+
+
+def _count_noise_floor(center):
+    """Lower bound on the spread of count data (Poisson sd = sqrt(mean)), so sparse series are not over-flagged."""
+    return np.maximum(np.sqrt(np.maximum(center, 0.0)), 1.0)
+
+
+def _fold_change(values: pd.Series, baseline: pd.Series) -> pd.Series:
+    """max(value / baseline, baseline / value), with both floored at 1 unit."""
+    values, baseline = np.maximum(values, 1.0), np.maximum(baseline, 1.0)
+    return np.maximum(values / baseline, baseline / values)
+
+
+def _robust_z(values: pd.Series, groups: List[pd.Series]) -> pd.Series:
+    grouped = values.groupby(groups, sort=False, observed=True)
+    median = grouped.transform("median")
+    mad = (values - median).abs().groupby(groups, sort=False, observed=True).transform("median")
+    return (values - median) / np.maximum(MAD_TO_SIGMA * mad, _count_noise_floor(median))
+
+
+def score_anomalies(df: pd.DataFrame, **params) -> pd.DataFrame:
+    """Per-row `anomaly_flags` and `anomaly_score` (by position) for the rules in detect_anomalies."""
+    p = {**ANOMALY_DEFAULTS, **params}
+    n = len(df)
+    flags = np.zeros(n, dtype=np.uint8)
+    score = np.zeros(n, dtype=float)
+    if n == 0 or "Numbers" not in df.columns:
+        return pd.DataFrame({"anomaly_flags": flags, "anomaly_score": score})
+
+    qty = df["Numbers"].astype(float).reset_index(drop=True)
+    has_dates = "deliverdate_dt" in df.columns and df["deliverdate_dt"].notna().any()
+    series_keys = [c for c in ("customer", "ModelNum") if c in df.columns]
+
+    if has_dates and series_keys:
+        # Daily units per customer/model series, then map day-level flags back to rows.
+        rows = df[series_keys].reset_index(drop=True)
+        rows = rows.assign(day=df["deliverdate_dt"].dt.normalize().to_numpy(), qty=qty)
+        rows = rows[rows["day"].notna()]
+        daily = rows.groupby(series_keys + ["day"], observed=True, sort=True)["qty"].sum().reset_index()
+        groups = [daily[c] for c in series_keys]
+
+        mean, std, count = _rolling_prior_stats(daily["qty"], groups, p["window"])
+        rolling_z = ((daily["qty"] - mean) / np.maximum(std, _count_noise_floor(mean))).fillna(0.0)
+        rolling_hit = (
+            (count >= p["min_history"])
+            & (rolling_z.abs() >= p["z_threshold"])
+            & (_fold_change(daily["qty"], mean) >= p["daily_ratio"])
+        )
+        daily_flags = np.where(rolling_hit, ANOMALY_FLAGS["rolling_z"], 0)
+        daily_score = rolling_z.abs().to_numpy()
+
+        weekday = daily["day"].dt.dayofweek
+        seasonal_groups = groups + [weekday]
+        seasonal = daily["qty"].groupby(seasonal_groups, sort=False, observed=True)
+        seasonal_z = _robust_z(daily["qty"], seasonal_groups)
+        seasonal_hit = (
+            (seasonal.transform("size") >= p["min_history"])
+            & (seasonal_z.abs() >= p["z_threshold"])
+            & (_fold_change(daily["qty"], seasonal.transform("median")) >= p["daily_ratio"])
+        )
+        daily_flags = daily_flags | np.where(seasonal_hit, ANOMALY_FLAGS["seasonal"], 0)
+        daily_score = np.fmax(daily_score, np.where(seasonal_hit, seasonal_z.abs(), 0.0))
+
+        daily = daily.assign(_flags=daily_flags.astype(np.uint8), _score=daily_score)
+        mapped = rows.merge(daily[series_keys + ["day", "_flags", "_score"]], on=series_keys + ["day"], how="left")
+        flags[rows.index.to_numpy()] |= mapped["_flags"].fillna(0).to_numpy(dtype=np.uint8)
+        score[rows.index.to_numpy()] = np.fmax(score[rows.index.to_numpy()], mapped["_score"].fillna(0).to_numpy())
+
+    if has_dates and {"Suppliername", "customer"}.issubset(df.columns):
+        dates = df["deliverdate_dt"].reset_index(drop=True)
+        start, end = dates.min(), dates.max()
+        baseline_end = start + max((end - start) * 0.25, pd.Timedelta(days=p["new_edge_baseline_days"]))
+        edge_groups = [df["Suppliername"].reset_index(drop=True), df["customer"].reset_index(drop=True)]
+        first_seen = dates.groupby(edge_groups, observed=True).transform("min")
+        new_edge = (dates == first_seen) & (first_seen > baseline_end)
+        flags |= np.where(new_edge, ANOMALY_FLAGS["new_edge"], 0).astype(np.uint8)
+
+    if "ModelNum" in df.columns:
+        model = df["ModelNum"].reset_index(drop=True)
+        median = qty.groupby(model, observed=True).transform("median")
+        ratio = (qty / median.clip(lower=1.0)).to_numpy()
+        line_z = _robust_z(qty, [model]).abs().to_numpy()
+        spike = (ratio >= p["spike_ratio"]) & (line_z >= p["z_threshold"])
+        flags |= np.where(spike, ANOMALY_FLAGS["quantity_spike"], 0).astype(np.uint8)
+        score = np.where(spike, np.fmax(score, ratio), score)
+
+    if has_dates and "customer" in df.columns:
+        customer = df["customer"].reset_index(drop=True)
+        weekday = df["deliverdate_dt"].dt.dayofweek.reset_index(drop=True)
+        per_customer = weekday.groupby(customer, observed=True).transform("size")
+        per_weekday = weekday.groupby([customer, weekday], observed=True).transform("size")
+        rare = (per_customer >= p["min_deliveries"]) & (per_weekday / per_customer < p["rare_weekday_share"])
+        flags |= np.where(rare.to_numpy(), ANOMALY_FLAGS["date_pattern"], 0).astype(np.uint8)
+
+    return pd.DataFrame({"anomaly_flags": flags, "anomaly_score": score})
+
+
+def detect_anomalies(
+    df: pd.DataFrame, positions: Optional[np.ndarray] = None, scores: Optional[pd.DataFrame] = None, **params
+) -> pd.DataFrame:
+    """
+    Flag unusual packing-list rows without any LLM call.
+
+    Rules (see ANOMALY_LABELS): rolling z-score of daily units per
+    customer/model against the previous `window` days with deliveries;
+    weekday-seasonal robust z-score per customer/model; the first delivery
+    on a supplier → customer edge that appears after the first quarter of the
+    date span; line quantities far above the model's median; deliveries on
+    weekdays the customer almost never receives on.
+
+    Baselines, first-seen dates and weekday patterns always cover all of
+    `df`; `positions` (e.g. the dashboard filter) only limits which flagged
+    rows are returned, so a date window cannot make an old edge look new.
+    `scores` reuses a score_anomalies result for the same `df` and params.
+
+    Returns only the flagged rows with `anomaly_flags` (bitmask of
+    ANOMALY_FLAGS), `anomaly_reasons` and `anomaly_score` (largest |z|, or
+    spike ratio), sorted by score.
+    """
+    scores = score_anomalies(df, **params) if scores is None else scores
+    flags = scores["anomaly_flags"].to_numpy()
+    score = scores["anomaly_score"].to_numpy()
+    flagged = np.flatnonzero(flags)
+    if positions is not None:
+        flagged = flagged[np.isin(flagged, positions)]
+    result = df.iloc[flagged].copy()
+    result["anomaly_flags"] = flags[flagged]
+    result["anomaly_score"] = np.round(score[flagged], 2)
+    result["anomaly_reasons"] = [
+        ", ".join(name for name, bit in ANOMALY_FLAGS.items() if f & bit) for f in flags[flagged]
+    ]
+    return result.sort_values("anomaly_score", ascending=False, kind="stable")
+
+
+def get_anomalies(
+    dataset_key: str, filter_key: str, df: pd.DataFrame, positions: Optional[np.ndarray], **params
+) -> pd.DataFrame:
+    """
+    Flagged rows of a filtered view. Rules run once per dataset and params on
+    the whole frame; each filter only selects from the shared scores.
+    """
+    cache = get_ingest_cache()
+    params_key = tuple(sorted(params.items()))
+    scores = cache.get_or_create(("anomaly_scores", dataset_key, params_key), lambda: score_anomalies(df, **params))
+    return cache.get_or_create(
+        ("anomalies", dataset_key, filter_key, params_key),
+        lambda: detect_anomalies(df, positions, scores=scores, **params),
+    )
+
+
+def anomaly_agent_prompt(flagged: pd.DataFrame, total_rows: int, model: str, budget_tokens: int) -> str:
+    """Compact prompt for anomaly_detector: rule counts plus the top-scoring flagged rows within budget."""
+    packer = ContextBudget(model, budget_tokens)
+    packer.add(
+        f"# Local anomaly engine: {len(flagged):,} of {total_rows:,} packing-list lines flagged. "
+        "Explain likely causes, rank the risks, and suggest follow-up checks."
+    )
+    packer.add("\n## Rules")
+    for name, bit in ANOMALY_FLAGS.items():
+        hits = int(((flagged["anomaly_flags"] & bit) > 0).sum()) if len(flagged) else 0
+        packer.add(f"{name}: {hits:,} · {ANOMALY_LABELS[name]}")
+    columns = [
+        c
+        for c in ("deliverdate_dt", "Suppliername", "customer", "DeviceName", "ModelNum", "LotNumber", "Numbers")
+        if c in flagged.columns
+    ] + ["anomaly_reasons", "anomaly_score"]
+    included = packer.section("Flagged rows (highest score first)", columns, _table_rows(flagged[columns]))
+    if included < len(flagged):
+        packer.add(f"... {len(flagged) - included:,} more flagged rows omitted for the token budget")
+    return packer.render()
+
+
+# =========================
+# DUPLICATE ENGINE (exact hashing + blocked fuzzy matching)
+# =========================
+
+# Rows sharing all of these values are exact duplicates.
+DUPLICATE_EXACT_COLUMNS = ["UDI", "LotNumber", "SN", "customer", "deliverdate_dt"]
+# Free-text columns whose spelling variants are clustered before near-duplicate matching.
+DUPLICATE_FUZZY_COLUMNS = ["DeviceName", "licenseID"]
+# Near duplicates share these values (plus the variant clusters) and fall within the date tolerance.
+DUPLICATE_BLOCK_COLUMNS = ["customer", "LotNumber", "SN", "Numbers"]
+DUPLICATE_COLUMNS = list(
+    dict.fromkeys(DUPLICATE_EXACT_COLUMNS + DUPLICATE_FUZZY_COLUMNS + DUPLICATE_BLOCK_COLUMNS + ["Suppliername", "ModelNum"])
+)
+
+DUPLICATE_DEFAULTS = {
+    "similarity": 0.88,  # difflib ratio for two spellings to count as variants
+    "window": 6,  # sorted-neighbourhood window (per pass, forward and reversed keys)
+    "date_tolerance_days": 1,  # near duplicates: same block delivered within this many days
+}
+
+VARIANT_NOISE_PATTERN = re.compile(r"[\W_]+")
+DIGIT_RUN_PATTERN = re.compile(r"\d+")
+
+
+def variant_key(value) -> str:
+    """Spelling-insensitive form of a name / licence: NFKC, casefolded, no punctuation, no leading zeros."""
+    text = unicodedata.normalize("NFKC", str(value)).casefold()
+    text = DIGIT_RUN_PATTERN.sub(lambda m: str(int(m.group())), text)
+    return VARIANT_NOISE_PATTERN.sub("", text)
+
+
+class UnionFind:
+    """Disjoint sets over 0..n-1 (path halving, union by size)."""
+
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, x: int) -> int:
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a: int, b: int):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+    def union_pairs(self, left, right):
+        for a, b in zip(left, right):
+            self.union(int(a), int(b))
+
+    def labels(self) -> np.ndarray:
+        return np.fromiter((self.find(i) for i in range(len(self.parent))), dtype=np.int64, count=len(self.parent))
+
+
+def sorted_neighbourhood_pairs(keys: List[str], window: int) -> np.ndarray:
+    """
+    Candidate pairs (i, j), i < j, of keys within `window` positions of each
+    other when sorted — once by the key and once by the reversed key, so a
+    variant differing in its first characters still lands next to its twin.
+    """
+    n = len(keys)
+    if n < 2:
+        return np.empty((0, 2), dtype=np.int64)
+    arr = np.array(keys, dtype=object)
+    reversed_keys = np.array([k[::-1] for k in keys], dtype=object)
+    parts = []
+    for order in (np.argsort(arr, kind="stable"), np.argsort(reversed_keys, kind="stable")):
+        for offset in range(1, min(window, n)):
+            parts.append(np.stack([order[:-offset], order[offset:]], axis=1))
+    pairs = np.sort(np.concatenate(parts), axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def _similar_pairs(left: List[str], right: List[str], threshold: float) -> List[bool]:
+    """difflib ratio >= threshold per pair (quick_ratio first; it is an upper bound)."""
+    matcher = difflib.SequenceMatcher(autojunk=False)
+    hits = []
+    for a, b in zip(left, right):
+        matcher.set_seqs(a, b)
+        hits.append(matcher.quick_ratio() >= threshold and matcher.ratio() >= threshold)
+    return hits
+
+
+def score_pairs(left: List[str], right: List[str], threshold: float, stats: Dict) -> np.ndarray:
+    """
+    Score candidate pairs in-process. Blocking and the length bound keep the
+    pair count small, and forking from the server's threads is not safe.
+    """
+    stats["pairs_scored"] = stats.get("pairs_scored", 0) + len(left)
+    return np.array(_similar_pairs(left, right, threshold), dtype=bool)
+
+
+def cluster_variants(values: pd.Series, similarity: float, window: int, stats: Dict):
+    """
+    Group spelling variants of one column.
+
+    Values are first merged on `variant_key`; distinct keys are then matched
+    by sorted neighbourhood and difflib ratio, only when their digit runs
+    agree (so "3.0 mm" and "3.5 mm", or two licence numbers, never merge).
+    Returns (cluster id per row, -1 for missing; variants table).
+    """
+    codes, uniques = pd.factorize(values, use_na_sentinel=True)
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    key_codes, keys = pd.factorize(pd.Series([variant_key(v) for v in uniques], dtype=object))
+    keys = list(keys)
+
+    uf = UnionFind(len(keys))
+    pairs = sorted_neighbourhood_pairs(keys, window)
+    if len(pairs):
+        digits = pd.factorize(pd.Series([",".join(DIGIT_RUN_PATTERN.findall(k)) for k in keys], dtype=object))[0]
+        lengths = np.array([len(k) for k in keys])
+        la, lb = lengths[pairs[:, 0]], lengths[pairs[:, 1]]
+        # 2*min/(la+lb) bounds the ratio from above, so skip pairs that cannot reach the threshold.
+        keep = (digits[pairs[:, 0]] == digits[pairs[:, 1]]) & (2 * np.minimum(la, lb) >= similarity * (la + lb))
+        pairs = pairs[keep]
+        hits = score_pairs([keys[i] for i in pairs[:, 0]], [keys[j] for j in pairs[:, 1]], similarity, stats)
+        uf.union_pairs(pairs[hits, 0], pairs[hits, 1])
+    value_cluster = uf.labels()[key_codes]
+
+    table = pd.DataFrame({"variant": pd.Series(uniques, dtype=object), "rows": counts, "cluster": value_cluster})
+    table = table.sort_values(["cluster", "rows"], ascending=[True, False], kind="stable")
+    table["canonical"] = table.groupby("cluster")["variant"].transform("first")
+    table = table[table.groupby("cluster")["variant"].transform("size") > 1]
+    row_cluster = np.where(codes >= 0, value_cluster[np.maximum(codes, 0)], -1)
+    return row_cluster, table[["canonical", "variant", "rows"]].reset_index(drop=True)
+
+
+def row_key_codes(frame: pd.DataFrame) -> np.ndarray:
+    """Dense int64 id per distinct row of `frame` (NA counts as a value); cheaper than hashing long strings."""
+    key = np.zeros(len(frame), dtype=np.int64)
+    span = 1
+    for col in frame.columns:
+        codes, uniques = pd.factorize(frame[col], use_na_sentinel=True)
+        if span * (len(uniques) + 1) >= 2**62:
+            key, seen = pd.factorize(key)
+            span = len(seen)
+        key = key * (len(uniques) + 1) + (codes + 1)
+        span *= len(uniques) + 1
+    return key
+
+
+def _consecutive_links(positions: np.ndarray, keys: np.ndarray, days: Optional[np.ndarray] = None, tolerance: int = 0):
+    """Links between neighbouring rows (after sorting by key, then day) that share a key and lie within `tolerance` days."""
+    order = np.lexsort((days, keys)) if days is not None else np.argsort(keys, kind="stable")
+    positions, keys = positions[order], keys[order]
+    same = keys[1:] == keys[:-1]
+    if days is not None:
+        days = days[order]
+        same &= (days[1:] - days[:-1]) <= tolerance
+    return positions[:-1][same], positions[1:][same]
+
+
+def find_duplicates(df: pd.DataFrame, **params) -> Dict:
+    """
+    Exact and near-duplicate packing-list rows, clustered into groups.
+
+    Exact: identical (UDI, LotNumber, SN, customer, delivery date), for
+    rows carrying at least one identifier. Near: same customer, lot, serial and
+    quantity with DeviceName / licenseID variants (see cluster_variants),
+    delivered within `date_tolerance_days`. Links from both passes are joined
+    with union-find, so the work stays O(n log n) plus the blocked pair scoring.
+
+    Returns {"groups": rows with duplicate_group / duplicate_kind / group_size,
+    "variants": spelling-variant table, "stats": counts and timing}.
+    """
+    p = {**DUPLICATE_DEFAULTS, **params}
+    started = time.perf_counter()
+    stats: Dict = {"rows": len(df), "pairs_scored": 0}
+    n = len(df)
+    left_parts, right_parts = [], []
+
+    id_columns = [c for c in ("UDI", "LotNumber", "SN") if c in df.columns]
+    has_id = np.zeros(n, dtype=bool)
+    for col in id_columns:
+        codes, uniques = pd.factorize(df[col], use_na_sentinel=True)
+        filled = pd.Series(uniques, dtype="string").str.strip().ne("").to_numpy(dtype=bool, na_value=False)
+        has_id |= (codes >= 0) & np.append(filled, False)[codes]
+
+    exact_columns = [c for c in DUPLICATE_EXACT_COLUMNS if c in df.columns]
+    exact_key = row_key_codes(df[exact_columns]) if exact_columns else None
+    if exact_key is not None and id_columns:
+        candidates = np.flatnonzero(has_id)
+        a, b = _consecutive_links(candidates, exact_key[candidates])
+        left_parts.append(a)
+        right_parts.append(b)
+    stats["exact_links"] = int(sum(len(a) for a in left_parts))
+
+    variants = []
+    block = df[[c for c in DUPLICATE_BLOCK_COLUMNS if c in df.columns]].reset_index(drop=True)
+    for col in DUPLICATE_FUZZY_COLUMNS:
+        if col in df.columns:
+            clusters, table = cluster_variants(df[col], p["similarity"], p["window"], stats)
+            block[f"{col}_cluster"] = clusters
+            variants.append(table.assign(column=col))
+    if "deliverdate_dt" in df.columns and {"LotNumber", "SN"} & set(block.columns):
+        days = df["deliverdate_dt"].to_numpy(dtype="datetime64[D]")
+        candidates = np.flatnonzero(has_id & ~np.isnat(days))
+        a, b = _consecutive_links(
+            candidates,
+            row_key_codes(block.iloc[candidates]),
+            days[candidates].astype(np.int64),
+            int(p["date_tolerance_days"]),
+        )
+        left_parts.append(a)
+        right_parts.append(b)
+
+    left = np.concatenate(left_parts) if left_parts else np.empty(0, dtype=np.int64)
+    right = np.concatenate(right_parts) if right_parts else np.empty(0, dtype=np.int64)
+    involved = np.unique(np.concatenate([left, right]))
+    uf = UnionFind(len(involved))
+    uf.union_pairs(np.searchsorted(involved, left), np.searchsorted(involved, right))
+    roots = uf.labels()
+
+    groups = df.iloc[involved].copy()
+    sizes = np.bincount(roots, minlength=len(involved))[roots] if len(involved) else np.empty(0, dtype=np.int64)
+    exact_kinds = pd.Series(exact_key[involved] if exact_key is not None else np.zeros(len(involved)))
+    distinct_keys = exact_kinds.groupby(roots).transform("nunique").to_numpy()
+    groups["group_size"] = sizes
+    groups["duplicate_kind"] = np.where(distinct_keys == 1, "exact", "near")
+    groups["_root"] = roots
+    groups = groups.sort_values(["group_size", "_root"], ascending=[False, True], kind="stable")
+    groups["duplicate_group"] = pd.factorize(groups["_root"])[0] + 1
+    groups = groups.drop(columns="_root")
+    groups = groups[["duplicate_group", "duplicate_kind", "group_size"] + [c for c in groups.columns[:-3]]]
+
+    variants_table = (
+        pd.concat(variants, ignore_index=True)[["column", "canonical", "variant", "rows"]]
+        if variants
+        else pd.DataFrame(columns=["column", "canonical", "variant", "rows"])
+    )
+    first_rows = groups.drop_duplicates("duplicate_group")
+    stats.update(
+        {
+            "groups": int(groups["duplicate_group"].max()) if len(groups) else 0,
+            "exact_groups": int((first_rows["duplicate_kind"] == "exact").sum()),
+            "near_groups": int((first_rows["duplicate_kind"] == "near").sum()),
+            "duplicate_rows": len(groups),
+            "variant_values": len(variants_table),
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+    )
+    return {"groups": groups, "variants": variants_table, "stats": stats}
+
+
+def get_duplicates(dataset_key: str, df: pd.DataFrame, **params) -> Dict:
+    """Duplicate groups for a dataset, computed once per process and shared read-only."""
+    return get_ingest_cache().get_or_create(
+        ("duplicates", dataset_key, tuple(sorted(params.items()))), lambda: find_duplicates(df, **params)
+    )
+
+
+def duplicate_agent_prompt(result: Dict, model: str, budget_tokens: int) -> str:
+    """Compact prompt for duplicate_checker: counts, spelling variants, then the largest groups within budget."""
+    stats = result["stats"]
+    packer = ContextBudget(model, budget_tokens)
+    packer.add(
+        f"# Local duplicate engine: {stats['duplicate_rows']:,} of {stats['rows']:,} packing-list lines in "
+        f"{stats['groups']:,} groups ({stats['exact_groups']:,} exact, {stats['near_groups']:,} near). "
+        "Explain why each kind of group is likely a duplicate, which to keep, and how to prevent them upstream."
+    )
+    variants = result["variants"]
+    shown = packer.section("Spelling variants", ["column", "canonical", "variant", "rows"], _table_rows(variants))
+    if shown < len(variants):
+        packer.add(f"... {len(variants) - shown:,} more variants omitted for the token budget")
+    groups = result["groups"]
+    columns = ["duplicate_group", "duplicate_kind"] + [
+        c
+        for c in ("deliverdate_dt", "customer", "Suppliername", "DeviceName", "licenseID", "UDI", "LotNumber", "SN", "Numbers")
+        if c in groups.columns
+    ]
+    included = packer.section("Duplicate groups (largest first)", columns, _table_rows(groups[columns]))
+    if included < len(groups):
+        packer.add(f"... {len(groups) - included:,} more duplicate rows omitted for the token budget")
+    return packer.render()
+
+
+# =========================
+# SUPPLY CHAIN GRAPH BUILD & RENDER
+# =========================
+
+GRAPH_NODE_COLORS = {
+    "supplier": "#38bdf8",  # sky blue
+    "device": "#22c55e",  # green
+    "customer": "#f97316",  # orange
+}
+
+# (source column, target column, source type, target type) for each edge layer.
+SUPPLY_CHAIN_EDGE_LAYERS = [
+    ("Suppliername", "DeviceName", "supplier", "device"),
+    ("DeviceName", "customer", "device", "customer"),
+]
+
+
+def _stripped_labels(s: pd.Series) -> pd.Series:
+    """Strip whitespace from node labels; categoricals are cleaned per category, not per row."""
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        cats = s.cat.categories.astype(str).str.strip()
+        if not cats.has_duplicates:
+            return s.cat.rename_categories(cats)
+    return s.astype("string").str.strip()
+
+
+def aggregate_supply_chain_edges(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Aggregate packing-list rows into supplier→device and device→customer edges.
+
+    Returns one row per distinct edge with summed `weight` (Numbers), `lines`
+    (row count) and `lots` (distinct LotNumber).
+    """
+    columns = ["source", "target", "source_type", "target_type", "weight", "lines", "lots"]
+    layers = []
+    for src_col, dst_col, src_type, dst_type in SUPPLY_CHAIN_EDGE_LAYERS:
+        if src_col not in df.columns or dst_col not in df.columns:
+            continue
+        part = pd.DataFrame(
+            {
+                "source": _stripped_labels(df[src_col]),
+                "target": _stripped_labels(df[dst_col]),
+                "qty": df["Numbers"] if "Numbers" in df.columns else 0,
+                "lot": df["LotNumber"] if "LotNumber" in df.columns else pd.NA,
+            }
+        )
+        part = part[part["source"].notna() & part["target"].notna()]
+        part = part[(part["source"].astype(str) != "") & (part["target"].astype(str) != "")]
+        if part.empty:
+            continue
+        agg = (
+            part.groupby(["source", "target"], observed=True, sort=False)
+            .agg(weight=("qty", "sum"), lines=("qty", "size"), lots=("lot", "nunique"))
+            .reset_index()
+        )
+        agg["source"] = agg["source"].astype(str)
+        agg["target"] = agg["target"].astype(str)
+        agg["source_type"] = src_type
+        agg["target_type"] = dst_type
+        layers.append(agg[columns])
+
+    if not layers:
+        return pd.DataFrame(columns=columns)
+    edges = pd.concat(layers, ignore_index=True)
+    edges[["weight", "lines", "lots"]] = edges[["weight", "lines", "lots"]].astype("int64")
+    return edges
+
+
+def supply_chain_node_weights(edges: pd.DataFrame) -> pd.DataFrame:
+    """Node throughput: the larger of total inbound and outbound units."""
+    outbound = edges.groupby(["source", "source_type"])["weight"].sum()
+    inbound = edges.groupby(["target", "target_type"])["weight"].sum()
+    outbound.index.names = inbound.index.names = ["node", "type"]
+    nodes = pd.concat([outbound, inbound], axis=1, keys=["out", "in"]).fillna(0)
+    nodes["weight"] = nodes[["out", "in"]].max(axis=1).astype("int64")
+    return nodes.reset_index()[["node", "type", "weight"]].sort_values("weight", ascending=False, kind="stable")
+
+
+# Level-of-detail modes for the relation graph.
+GRAPH_LOD_MODES = {
+    "top": "Top-N nodes by throughput",
+    "collapse": "Top-N + collapse long tail into 'Other' nodes",
+}
+
+AGGREGATE_NODE_LABELS = {
+    "supplier": "Other suppliers",
+    "device": "Other devices",
+    "customer": "Other customers",
+}
+
+
+def aggregate_node_id(n_type: str) -> str:
+    return f"__other_{n_type}__"
+
+
+def apply_level_of_detail(
+    edges: pd.DataFrame,
+    max_nodes: int,
+    max_edges: int,
+    mode: str = "top",
+    expanded: Optional[List[str]] = None,
+):
+    """
+    Reduce an aggregated edge table to a renderable graph.
+
+    "top" keeps the `max_nodes` heaviest nodes and drops everything else.
+    "collapse" additionally folds the long tail of each node type into one
+    aggregate node (e.g. "Other customers") so no units are lost; types listed
+    in `expanded` get up to another `max_nodes` of their tail shown individually.
+    Edges touching an aggregate node report summed lots (an upper bound).
+
+    Returns (nodes, edges); nodes has node/type/weight/label/members/aggregate columns.
+    """
+    node_weights = supply_chain_node_weights(edges)
+    node_weights = node_weights.assign(label=node_weights["node"], members=1, aggregate=False)
+    # Node names are only unique per type, so nodes are matched on (type, name).
+    def endpoint_keys(edges):
+        return edges["source_type"] + "\x1f" + edges["source"], edges["target_type"] + "\x1f" + edges["target"]
+
+    node_keys = node_weights["type"] + "\x1f" + node_weights["node"]
+    source_keys, target_keys = endpoint_keys(edges)
+    in_top = node_keys.isin(set(node_keys.head(max_nodes)))
+
+    if mode != "collapse":
+        kept = set(node_keys[in_top])
+        edges = edges[source_keys.isin(kept) & target_keys.isin(kept)]
+        edges = edges.sort_values("weight", ascending=False, kind="stable").head(max_edges)
+        return node_weights[node_keys.isin(set().union(*endpoint_keys(edges)))], edges
+
+    tail = node_weights[~in_top]
+    for n_type in expanded or []:
+        tail_of_type = tail[tail["type"] == n_type]
+        tail = tail.drop(tail_of_type.index[:max_nodes])
+
+    mapping = pd.Series(tail["type"].map(aggregate_node_id).to_numpy(), index=node_keys[tail.index].to_numpy())
+    edges = edges.assign(
+        source=source_keys.map(mapping).fillna(edges["source"]),
+        target=target_keys.map(mapping).fillna(edges["target"]),
+    )
+    edges = (
+        edges.groupby(["source", "target", "source_type", "target_type"], sort=False)[["weight", "lines", "lots"]]
+        .sum()
+        .reset_index()
+        .sort_values("weight", ascending=False, kind="stable")
+        .head(max_edges)
+    )
+
+    aggregates = (
+        tail.groupby("type")
+        .agg(weight=("weight", "sum"), members=("node", "size"))
+        .reset_index()
+    )
+    aggregates["node"] = aggregates["type"].map(aggregate_node_id)
+    aggregates["aggregate"] = True
+    aggregates["label"] = [
+        f"{AGGREGATE_NODE_LABELS.get(t, 'Other')} ({m:,})" for t, m in zip(aggregates["type"], aggregates["members"])
+    ]
+    nodes = pd.concat([node_weights.drop(tail.index), aggregates], ignore_index=True)
+    nodes = nodes[(nodes["type"] + "\x1f" + nodes["node"]).isin(set().union(*endpoint_keys(edges)))]
+    return nodes, edges
+
+
+# Server-side layouts; coordinates are fixed in the HTML so vis.js physics stays off.
+GRAPH_LAYOUTS = {
+    "layered": "Layered (supplier → device → customer)",
+    "force": "Force-directed",
+}
+
+GRAPH_LAYER_ORDER = ["supplier", "device", "customer"]
+
+
+@st.cache_resource
+def get_layout_cache() -> LRUCache:
+    """Process-wide cache of node coordinates keyed by graph fingerprint."""
+    return LRUCache(max_items=256)
+
+
+def graph_fingerprint(G) -> str:
+    """
+    Stable digest of everything the layouts read: node type and units (the
+    layered layout orders suppliers by units) and weighted edges (spring layout).
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for node, data in sorted(G.nodes(data=True), key=lambda item: str(item[0])):
+        h.update(f"n\x1f{node}\x1f{data.get('type', '')}\x1f{data.get('units', 0)}\x1e".encode("utf-8"))
+    for source, target, weight in sorted(G.edges(data="weight", default=1), key=lambda e: (str(e[0]), str(e[1]))):
+        h.update(f"e\x1f{source}\x1f{target}\x1f{weight}\x1e".encode("utf-8"))
+    return h.hexdigest()
+
+
+def layered_layout(G, column_gap: float = 600.0, row_gap: float = 36.0) -> Dict:
+    """
+    Tripartite layout: one column per node type, suppliers ordered by units and
+    each later column ordered by the barycenter of its predecessors to limit crossings.
+    """
+    columns: Dict[str, List] = {}
+    for node, data in G.nodes(data=True):
+        columns.setdefault(data.get("type", ""), []).append(node)
+    types = [t for t in GRAPH_LAYER_ORDER if t in columns] + [t for t in columns if t not in GRAPH_LAYER_ORDER]
+
+    pos: Dict = {}
+    for col_idx, n_type in enumerate(types):
+
+        def order_key(node):
+            ys = [pos[p][1] for p in G.predecessors(node) if p in pos]
+            barycenter = sum(ys) / len(ys) if ys else float("inf")
+            return (barycenter, -G.nodes[node].get("units", 0), str(node))
+
+        nodes = sorted(columns[n_type], key=order_key)
+        offset = (len(nodes) - 1) * row_gap / 2
+        for row_idx, node in enumerate(nodes):
+            pos[node] = (col_idx * column_gap, row_idx * row_gap - offset)
+    return pos
+
+
+def force_layout(G) -> Dict:
+    """Force-directed layout computed once in Python (sparse solver for large graphs)."""
+    try:
+        raw = nx.spring_layout(G, seed=7, iterations=60)
+    except ImportError:
+        # networkx needs scipy for its sparse solver on graphs with 500+ nodes.
+        return layered_layout(G)
+    scale = max(400.0, 60.0 * len(G) ** 0.5)
+    return {node: (float(x) * scale, float(y) * scale) for node, (x, y) in raw.items()}
+
+
+def compute_graph_layout(G, layout: str = "layered") -> Dict:
+    """Node coordinates for `G`, cached across reruns and sessions by graph fingerprint."""
+    builder = force_layout if layout == "force" else layered_layout
+    return get_layout_cache().get_or_create((graph_fingerprint(G), layout), lambda: builder(G))
+
+
+def build_supply_chain_graph(
+    df: pd.DataFrame,
+    license_id_filter: Optional[str] = None,
+    lot_filter: Optional[str] = None,
+    max_nodes: int = 200,
+    max_edges: int = 400,
+    search_term: Optional[str] = None,
+    lod_mode: str = "top",
+    expanded_groups: Optional[List[str]] = None,
+    layout: str = "layered",
+):
+    """Build a Network (pyvis) from packing list with filters and limits.
+
+    Nodes and edges are chosen by aggregated units (top-k), not by row order;
+    see apply_level_of_detail for the `lod_mode` / `expanded_groups` options.
+    Node positions come from compute_graph_layout, so the browser does not
+    need to run a physics simulation.
+    """
+    if nx is None or Network is None:
+        return None
+
+    mask = pd.Series(True, index=df.index)
+    if license_id_filter:
+        mask &= df["licenseID"] == license_id_filter
+    if lot_filter:
+        mask &= df["LotNumber"] == lot_filter
+    df_g = df if mask.all() else df[mask]
+
+    edges = aggregate_supply_chain_edges(df_g)
+    nodes, edges = apply_level_of_detail(edges, max_nodes, max_edges, mode=lod_mode, expanded=expanded_groups)
+
+    if search_term:
+        highlight = nodes["label"].str.lower().str.contains(search_term.lower(), regex=False)
+    else:
+        highlight = pd.Series(False, index=nodes.index)
+
+    G = nx.DiGraph()
+    G.add_nodes_from(
+        (
+            name,
+            {
+                "label": label,
+                "type": n_type,
+                "units": int(weight),
+                "aggregate": bool(is_aggregate),
+                "highlight": bool(hl),
+                "title": f"{n_type}: {label}\nUnits: {weight:,}",
+            },
+        )
+        for name, label, n_type, weight, is_aggregate, hl in zip(
+            nodes["node"], nodes["label"], nodes["type"], nodes["weight"], nodes["aggregate"], highlight
+        )
+    )
+    G.add_edges_from(
+        (
+            s,
+            t,
+            {
+                "weight": w,
+                "value": w,
+                "width": 1,
+                "title": f"Units: {w:,} · Lines: {n:,} · Lots: {lots:,}",
+            },
+        )
+        for s, t, w, n, lots in zip(edges["source"], edges["target"], edges["weight"], edges["lines"], edges["lots"])
+    )
+
+    log_event(
+        "graph_build",
+        f"nodes={G.number_of_nodes()}, edges={G.number_of_edges()}, "
+        f"license={license_id_filter or 'All'}, lot={lot_filter or 'All'}, "
+        f"search={search_term or ''}, max_nodes={max_nodes}, max_edges={max_edges}, "
+        f"lod={lod_mode}, expanded={','.join(expanded_groups or [])}, layout={layout}",
+    )
+
+    positions = compute_graph_layout(G, layout)
+
+    net = Network(height="100%", width="100%", directed=True, bgcolor="#0b1120", font_color="#e5e7eb")
+    net.from_nx(G)
+
+    # Apply node styling by type and highlight
+    for node in net.nodes:
+        n_type = node.get("type", "")
+        highlight = node.get("highlight", False)
+        base_color = GRAPH_NODE_COLORS.get(n_type, "#e5e7eb")
+
+        if highlight:
+            node["color"] = {"background": "#facc15", "border": "#f97316"}
+            node["size"] = 28
+        elif node.get("aggregate"):
+            node["color"] = {"background": "#64748b", "border": base_color}
+            node["size"] = 24
+        else:
+            node["color"] = {"background": base_color, "border": "#e5e7eb"}
+            node["size"] = 18
+
+        node["shape"] = "diamond" if node.get("aggregate") else "dot"
+
+        x, y = positions[node["id"]]
+        node["x"], node["y"] = x, y
+        node["physics"] = False
+
+    return net
+
+
+GRAPH_HTML_CACHE_MB = int(os.getenv("GUDID_GRAPH_HTML_CACHE_MB", "64"))
+
+GRAPH_OPTIONS = """
+var options = {
+  "nodes": {
+    "borderWidth": 1,
+    "size": 16,
+    "font": {"size": 16}
+  },
+  "edges": {
+    "arrows": {"to": {"enabled": true}},
+    "color": {"inherit": "from"},
+    "smooth": false
+  },
+  "physics": {
+    "enabled": false
+  }
+}
+"""
+
+
+@st.cache_resource
+def get_graph_html_cache() -> LRUCache:
+    """Process-wide cache of rendered graph HTML, bounded by total HTML size."""
+    return LRUCache(max_bytes=GRAPH_HTML_CACHE_MB * 2**20, sizeof=lambda entry: len(entry["html"]))
+
+
+def supply_chain_graph_html(net: "Network") -> Dict:
+    """Render a pyvis network to HTML; returns {"html", "labels"} with node id → label."""
+    net.set_options(GRAPH_OPTIONS)
+    return {
+        "html": net.generate_html(notebook=False),
+        "labels": {node["id"]: str(node.get("label", node["id"])) for node in net.nodes},
+    }
+
+
+def highlight_patch_script(labels: Dict, search_term: Optional[str]) -> str:
+    """
+    Client-side patch that recolors search matches in an already rendered graph,
+    so a new search term does not require regenerating the HTML.
+    """
+    if not search_term:
+        return ""
+    needle = search_term.lower()
+    matches = [node_id for node_id, label in labels.items() if needle in label.lower()]
+    if not matches:
+        return ""
+    # Node ids come from the data; keep "</script>" and friends from closing the tag early.
+    ids = (
+        json.dumps(matches, ensure_ascii=False)
+        .replace("<", "\\u003c")
+        .replace(">", "\\u003e")
+        .replace("&", "\\u0026")
+    )
+    return (
+        "<script>(function(){var ids=%s;"
+        "nodes.update(ids.map(function(id){return {id:id,size:28,"
+        "color:{background:'#facc15',border:'#f97316'}};}));})();</script>"
+    ) % ids
+
+
+def render_supply_chain_graph_html(graph: Optional[Dict], height: int = 520, search_term: Optional[str] = None):
+    """Render cached graph HTML, applying the search highlight as a client-side patch."""
+    if graph is None:
+        st.warning("networkx / pyvis not installed; graph view unavailable.")
+        return
+    html = graph["html"]
+    patch = highlight_patch_script(graph["labels"], search_term)
+    if patch:
+        html = html.replace("</body>", patch + "</body>", 1)
+    components.html(html, height=height, scrolling=True)
+
+
+# =========================
+# MODEL MAP
+# =========================
+
+MODEL_PROVIDER_MAP = {
+    "gpt-4o-mini": "openai",
+    "gpt-4.1-mini": "openai",
+    "gemini-2.5-flash": "gemini",
+    "gemini-2.5-flash-lite": "gemini",
+    "claude-3-5-sonnet-latest": "anthropic",
+    "claude-3-haiku-latest": "anthropic",
+    "grok-4-fast-reasoning": "grok",
+    "grok-3-mini": "grok",
+}
+
+# Max concurrent calls per provider within one fan-out run.
+PROVIDER_CONCURRENCY = {
+    "openai": 4,
+    "anthropic": 2,
+    "gemini": 4,
+    "grok": 2,
+}
+
+# Agents pre-selected for fan-out in Agent HQ (a typical recall investigation).
+FAN_OUT_DEFAULT_AGENTS = ["lot_trace_agent", "recall_manager", "license_consistency_checker", "udi_quality_checker"]
+
+
+# =========================
+# PROVIDER CLIENT REGISTRY
+# =========================
+
+PROVIDER_ENV_KEYS = {
+    "openai": "OPENAI_API_KEY",
+    "anthropic": "ANTHROPIC_API_KEY",
+    "gemini": "GEMINI_API_KEY",
+    "grok": "GROK_API_KEY",
+}
+
+PROVIDER_LABELS = {
+    "openai": "OpenAI",
+    "anthropic": "Anthropic",
+    "gemini": "Gemini",
+    "grok": "Grok (xAI)",
+}
+
+PROVIDER_LIBRARY_LABELS = {
+    "openai": "OpenAI library",
+    "anthropic": "Anthropic library",
+    "gemini": "Google Generative AI library",
+    "grok": "requests library",
+}
+
+GROK_API_URL = "https://api.x.ai/v1/chat/completions"
+
+# Keep-alive connections held by the Grok HTTP session.
+PROVIDER_POOL_SIZE = int(os.getenv("GUDID_PROVIDER_POOL_SIZE", "10"))
+
+
+class ProviderUnavailableError(Exception):
+    """Raised when a provider's API key or SDK is missing; the message is shown as-is."""
+
+
+class ProviderHTTPError(Exception):
+    """Non-200 response from a provider's raw HTTP endpoint."""
+
+    def __init__(self, provider: str, status_code: int, body: str = "", retry_after: Optional[str] = None):
+        super().__init__(f"{PROVIDER_LABELS.get(provider, provider)} API error: {status_code} {body}")
+        self.provider = provider
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(ProviderUnavailableError):
+    """Raised without calling the provider while its circuit breaker is open."""
+
+
+class GeminiClient:
+    """Configured google.generativeai module plus one GenerativeModel per model name."""
+
+    def __init__(self, api_key: str):
         genai.configure(api_key=api_key)
+        self._models: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def model(self, name: str):
+        with self._lock:
+            if name not in self._models:
+                self._models[name] = genai.GenerativeModel(name)
+            return self._models[name]
+
+
+class ProviderClientRegistry:
+    """
+    Process-wide LLM clients, one per provider, each with its own keep-alive pool.
+
+    The OpenAI and Anthropic SDK clients pool connections internally and are
+    thread-safe, so reusing the client object reuses warm connections; Grok gets
+    a requests.Session with a sized HTTPAdapter. Clients are keyed by a
+    fingerprint of the provider's API key and rebuilt when the key changes.
+    """
+
+    def __init__(self, pool_size: int = PROVIDER_POOL_SIZE):
+        self.pool_size = pool_size
+        self._clients: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self._stats = {p: {"created": 0, "reused": 0, "key": None} for p in PROVIDER_ENV_KEYS}
+
+    def get(self, provider: str):
+        api_key = os.getenv(PROVIDER_ENV_KEYS[provider])
+        if not api_key:
+            raise ProviderUnavailableError(f"{PROVIDER_LABELS[provider]} API key not configured")
+        fingerprint = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+        with self._lock:
+            entry = self._clients.get(provider)
+            if entry is not None and entry[0] == fingerprint:
+                self._stats[provider]["reused"] += 1
+                return entry[1]
+            # A replaced client is not closed: other sessions may still be mid-request on it.
+            client = self._create(provider, api_key)
+            self._clients[provider] = (fingerprint, client)
+            self._stats[provider]["created"] += 1
+            self._stats[provider]["key"] = fingerprint
+            return client
+
+    def _create(self, provider: str, api_key: str):
+        if provider == "openai":
+            if openai is None:
+                raise ProviderUnavailableError(f"{PROVIDER_LIBRARY_LABELS[provider]} not installed")
+            if not hasattr(openai, "OpenAI"):
+                openai.api_key = api_key
+                return openai
+            # Retries are handled by ProviderResilience, not the SDK.
+            return openai.OpenAI(api_key=api_key, timeout=PROVIDER_TIMEOUTS[provider], max_retries=0)
+        if provider == "anthropic":
+            if Anthropic is None:
+                raise ProviderUnavailableError(f"{PROVIDER_LIBRARY_LABELS[provider]} not installed")
+            return Anthropic(api_key=api_key, timeout=PROVIDER_TIMEOUTS[provider], max_retries=0)
+        if provider == "gemini":
+            if genai is None:
+                raise ProviderUnavailableError(f"{PROVIDER_LIBRARY_LABELS[provider]} not installed")
+            return GeminiClient(api_key)
+        if provider == "grok":
+            if requests is None:
+                raise ProviderUnavailableError(f"{PROVIDER_LIBRARY_LABELS[provider]} not installed")
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount("https://", adapter)
+            session.headers.update({"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"})
+            return session
+        raise ProviderUnavailableError(f"Unsupported LLM provider: {provider}")
+
+    def stats(self) -> List[Dict]:
+        with self._lock:
+            return [
+                {
+                    "provider": PROVIDER_LABELS[p],
+                    "active": p in self._clients,
+                    "clients_created": s["created"],
+                    "calls_reused": s["reused"],
+                    "pool_size": self.pool_size,
+                    "key_fingerprint": s["key"] or "",
+                }
+                for p, s in self._stats.items()
+            ]
+
+
+@st.cache_resource
+def get_provider_clients() -> ProviderClientRegistry:
+    return ProviderClientRegistry()
+
+
+# =========================
+# PROVIDER RESILIENCE (timeouts, retries, circuit breakers)
+# =========================
+
+# Per-request timeout in seconds, passed to each SDK / HTTP call.
+PROVIDER_TIMEOUTS = {
+    "openai": float(os.getenv("GUDID_TIMEOUT_OPENAI_S", "60")),
+    "anthropic": float(os.getenv("GUDID_TIMEOUT_ANTHROPIC_S", "90")),
+    "gemini": float(os.getenv("GUDID_TIMEOUT_GEMINI_S", "60")),
+    "grok": float(os.getenv("GUDID_TIMEOUT_GROK_S", "60")),
+}
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("GUDID_RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY_S = 1.0
+RETRY_MAX_DELAY_S = 20.0
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_S = 30.0
+
+# Start a hedged request on a fallback model when the primary has not answered by then.
+HEDGE_AFTER_S = float(os.getenv("GUDID_HEDGE_AFTER_S", "8"))
+
+
+def provider_error_status(exc: Exception) -> Optional[int]:
+    """HTTP status of an SDK / HTTP error (`status_code` on OpenAI/Anthropic/Grok, `code` on Google)."""
+    for attr in ("status_code", "code"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return int(value)
+    response = getattr(exc, "response", None)
+    value = getattr(response, "status_code", None)
+    return int(value) if isinstance(value, int) else None
+
+
+def is_transient_error(exc: Exception) -> bool:
+    """Rate limits, 5xx, timeouts and dropped connections are worth retrying; 4xx request errors are not."""
+    if isinstance(exc, ProviderUnavailableError):
+        return False
+    status = provider_error_status(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    names = [cls.__name__ for cls in type(exc).__mro__]
+    return any("Timeout" in n or "Connection" in n for n in names)
+
+
+def retry_after_seconds(exc: Exception) -> Optional[float]:
+    value = getattr(exc, "retry_after", None)
+    if value is None:
+        headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+        value = headers.get("retry-after")
+    try:
+        return min(float(value), RETRY_MAX_DELAY_S) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure breaker: opens after `threshold` transient failures,
+    lets a single probe through after `reset_s`, and closes on its success.
+    """
+
+    def __init__(self, threshold: int = BREAKER_FAILURE_THRESHOLD, reset_s: float = BREAKER_RESET_S):
+        self.threshold = threshold
+        self.reset_s = reset_s
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_s:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def release_probe(self):
+        """End a half-open probe that neither succeeded nor failed transiently; the state is unchanged."""
+        with self._lock:
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+
+class ProviderResilience:
+    """
+    Process-wide retry policy and circuit breakers, one breaker per provider.
+
+    `call` retries transient failures with full-jitter exponential backoff
+    (honouring Retry-After), and fails fast with CircuitOpenError while the
+    provider's breaker is open so one unhealthy provider cannot stall sessions.
+    """
+
+    def __init__(self, max_attempts: int = RETRY_MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self.breakers = {p: CircuitBreaker() for p in PROVIDER_ENV_KEYS}
+        self._stats = {p: {"calls": 0, "retries": 0, "failures": 0, "rejected": 0} for p in PROVIDER_ENV_KEYS}
+        self._lock = threading.Lock()
+
+    def _count(self, provider: str, field: str):
+        with self._lock:
+            self._stats[provider][field] += 1
+
+    def available(self, provider: str) -> bool:
+        return self.breakers[provider].state != "open"
+
+    def _admit(self, provider: str):
+        if not self.breakers[provider].allow():
+            self._count(provider, "rejected")
+            raise CircuitOpenError(
+                f"{PROVIDER_LABELS[provider]} is temporarily unavailable after repeated failures; "
+                f"retrying in up to {int(BREAKER_RESET_S)}s"
+            )
+
+    def _backoff(self, provider: str, attempt: int, exc: Exception) -> bool:
+        """Record a failed attempt; sleep and return True if it should be retried."""
+        transient = is_transient_error(exc)
+        breaker = self.breakers[provider]
+        if transient:
+            breaker.record_failure()
+        else:
+            breaker.release_probe()
+        if not transient or attempt + 1 >= self.max_attempts or breaker.state != "closed":
+            self._count(provider, "failures")
+            return False
+        self._count(provider, "retries")
+        delay = retry_after_seconds(exc)
+        if delay is None:
+            delay = random.uniform(0, min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * 2**attempt))
+        time.sleep(delay)
+        return True
+
+    def call(self, provider: str, fn):
+        self._count(provider, "calls")
+        for attempt in range(self.max_attempts):
+            self._admit(provider)
+            try:
+                result = fn()
+            except Exception as e:
+                if self._backoff(provider, attempt, e):
+                    continue
+                raise
+            self.breakers[provider].record_success()
+            return result
+
+    def stream(self, provider: str, make_stream):
+        """Like call for generators: retried only until the first chunk has been yielded."""
+        self._count(provider, "calls")
+        for attempt in range(self.max_attempts):
+            self._admit(provider)
+            started = False
+            try:
+                for chunk in make_stream():
+                    started = True
+                    yield chunk
+            except Exception as e:
+                if not started and self._backoff(provider, attempt, e):
+                    continue
+                if started and is_transient_error(e):
+                    self.breakers[provider].record_failure()
+                elif started:
+                    self.breakers[provider].release_probe()
+                raise
+            self.breakers[provider].record_success()
+            return
+
+    def stats(self) -> List[Dict]:
+        with self._lock:
+            return [
+                {
+                    "provider": PROVIDER_LABELS[p],
+                    "breaker": self.breakers[p].state,
+                    "timeout_s": PROVIDER_TIMEOUTS[p],
+                    **s,
+                }
+                for p, s in self._stats.items()
+            ]
+
+
+@st.cache_resource
+def get_provider_resilience() -> ProviderResilience:
+    return ProviderResilience()
+
+
+# =========================
+# PROVIDER RATE LIMITS (shared across sessions)
+# =========================
+
+AGENTS_CONFIG_PATH = "agents.yaml"
+
+RATE_LIMIT_MAX_WAIT_S = float(os.getenv("GUDID_RATE_LIMIT_MAX_WAIT_S", "300"))
+
+# Set per script run / task so limiter calls from worker threads know their session.
+REQUEST_SESSION_ID = contextvars.ContextVar("request_session_id", default="anonymous")
+# Optional callback(provider, model, position, eta_s) invoked while a request waits.
+QUEUE_OBSERVER = contextvars.ContextVar("queue_observer", default=None)
+
+
+class RateLimitTimeoutError(ProviderUnavailableError):
+    """Raised when a request waited longer than RATE_LIMIT_MAX_WAIT_S for rate-limit budget."""
+
+
+class TokenBucket:
+    """Refills continuously at `per_minute / 60` per second up to `per_minute`."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        return max(0.0, (amount - self.level) / self.rate)
+
+
+class QueueTicket:
+    """One waiting request; compared by identity so equal-sized requests stay distinct."""
+
+    __slots__ = ("tokens",)
+
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+
+
+class ProviderRequestQueue:
+    """
+    RPM / TPM token buckets for one provider+model, served in round-robin
+    order across sessions so one user's burst cannot starve the others.
+    """
+
+    def __init__(self, rpm: Optional[float], tpm: Optional[float]):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._cond = threading.Condition()
+        self._generation = 0
+
+    def _buckets(self):
+        return [b for b in (self.requests, self.tokens) if b is not None]
+
+    def _order(self) -> List[QueueTicket]:
+        """Waiting tickets in the order they will be served: one per session per round."""
+        queues = list(self._queues.values())
+        order, depth = [], 0
+        while True:
+            row = [q[depth] for q in queues if len(q) > depth]
+            if not row:
+                return order
+            order.extend(row)
+            depth += 1
+
+    def _eta(self, tickets: List[QueueTicket]) -> float:
+        waits = [0.0]
+        if self.requests is not None:
+            waits.append(self.requests.wait_for(len(tickets)))
+        if self.tokens is not None:
+            waits.append(self.tokens.wait_for(sum(t.tokens for t in tickets)))
+        return max(waits)
+
+    def _remove(self, session_id: str, ticket: QueueTicket):
+        queue = self._queues.get(session_id)
+        if queue is not None and any(t is ticket for t in queue):
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[session_id]
+
+    def acquire(self, session_id: str, tokens: int, observer=None) -> float:
+        """Block until this request may be sent; returns seconds waited."""
+        if self.tokens is not None:
+            tokens = min(tokens, int(self.tokens.capacity))
+        ticket = QueueTicket(tokens)
+        enqueued = time.monotonic()
+        with self._cond:
+            self._queues.setdefault(session_id, deque()).append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    now = time.monotonic()
+                    for bucket in self._buckets():
+                        bucket.refill(now)
+                    order = self._order()
+                    position = next(i for i, t in enumerate(order) if t is ticket)
+                    eta = self._eta(order[: position + 1])
+                    if position == 0 and eta == 0.0:
+                        if self.requests is not None:
+                            self.requests.level -= 1
+                        if self.tokens is not None:
+                            self.tokens.level -= tokens
+                        self._remove(session_id, ticket)
+                        if session_id in self._queues:
+                            self._queues.move_to_end(session_id)
+                        self._notify()
+                        return now - enqueued
+                    if now - enqueued + eta > RATE_LIMIT_MAX_WAIT_S:
+                        raise RateLimitTimeoutError(
+                            f"Rate limit queue is full: estimated wait {int(eta)}s exceeds "
+                            f"{int(RATE_LIMIT_MAX_WAIT_S)}s"
+                        )
+                    generation = self._generation
+                # The observer touches UI state, so it runs without holding the queue lock.
+                if observer is not None:
+                    observer(position, eta)
+                with self._cond:
+                    if self._generation == generation:
+                        self._cond.wait(timeout=min(max(eta, 0.05), 1.0))
+        except BaseException:
+            with self._cond:
+                self._remove(session_id, ticket)
+                self._notify()
+            raise
+
+    def _notify(self):
+        """Wake waiters; the generation lets a waiter see notifies sent while it was unlocked."""
+        self._generation += 1
+        self._cond.notify_all()
+
+    def waiting(self, session_id: str) -> List[tuple]:
+        """(position, eta_s) for each of the session's waiting requests."""
+        with self._cond:
+            now = time.monotonic()
+            for bucket in self._buckets():
+                bucket.refill(now)
+            order = self._order()
+            positions = {id(t): i for i, t in enumerate(order)}
+            mine = [positions[id(t)] for t in self._queues.get(session_id) or ()]
+            return [(position, self._eta(order[: position + 1])) for position in mine]
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                "rpm": self.requests.capacity if self.requests else None,
+                "tpm": self.tokens.capacity if self.tokens else None,
+                "requests_available": round(self.requests.level, 1) if self.requests else None,
+                "tokens_available": int(self.tokens.level) if self.tokens else None,
+                "queued": sum(len(q) for q in self._queues.values()),
+                "sessions_waiting": len(self._queues),
+            }
+
+
+class ProviderRateLimiter:
+    """
+    Process-wide limiter: one ProviderRequestQueue per provider+model, with
+    budgets from the `rate_limits` section of agents.yaml (a provider entry
+    may override rpm / tpm per model under `models`).
+    """
+
+    def __init__(self, limits: Dict):
+        self.limits = limits or {}
+        self._queues: Dict[tuple, Optional[ProviderRequestQueue]] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, limits: Dict):
+        """Swap in new budgets; requests already waiting finish on their old queues."""
+        if limits is self.limits:
+            return
+        with self._lock:
+            if limits != self.limits:
+                self._queues = {}
+            self.limits = limits
+
+    def _queue(self, provider: str, model: str) -> Optional[ProviderRequestQueue]:
+        key = (provider, model)
+        with self._lock:
+            if key not in self._queues:
+                provider_limits = self.limits.get(provider) or {}
+                model_limits = {**provider_limits, **((provider_limits.get("models") or {}).get(model) or {})}
+                rpm, tpm = model_limits.get("rpm"), model_limits.get("tpm")
+                self._queues[key] = ProviderRequestQueue(rpm, tpm) if (rpm or tpm) else None
+            return self._queues[key]
+
+    def acquire(self, provider: str, model: str, tokens: int) -> float:
+        """Block until the request may be sent; returns seconds waited for the caller to report."""
+        queue = self._queue(provider, model)
+        if queue is None:
+            return 0.0
+        observer = QUEUE_OBSERVER.get()
+        return queue.acquire(
+            REQUEST_SESSION_ID.get(),
+            tokens,
+            observer=(lambda position, eta: observer(provider, model, position, eta)) if observer else None,
+        )
+
+    def waiting(self, session_id: str) -> List[Dict]:
+        with self._lock:
+            queues = [(key, q) for key, q in self._queues.items() if q is not None]
+        return [
+            {"provider": provider, "model": model, "position": position, "eta_s": eta}
+            for (provider, model), queue in queues
+            for position, eta in queue.waiting(session_id)
+        ]
+
+    def stats(self) -> List[Dict]:
+        with self._lock:
+            queues = [(key, q) for key, q in self._queues.items() if q is not None]
+        return [{"provider": PROVIDER_LABELS[p], "model": m, **q.stats()} for (p, m), q in queues]
+
+
+@st.cache_resource
+def _rate_limiter() -> ProviderRateLimiter:
+    return ProviderRateLimiter({})
+
+
+def get_rate_limiter() -> ProviderRateLimiter:
+    """The process-wide limiter, reconfigured when agents.yaml's rate_limits change."""
+    limiter = _rate_limiter()
+    limiter.configure(get_agent_registry().config.get("rate_limits") or {})
+    return limiter
+
+
+def request_token_estimate(system_prompt: str, query: str, model: str, max_tokens: int) -> int:
+    """TPM charge for one request: prompt estimate plus the completion allowance, as providers count it."""
+    return estimate_tokens(f"{system_prompt}\n{query}", model) + int(max_tokens)
+
+
+@st.cache_resource
+def get_hedge_executor() -> concurrent.futures.ThreadPoolExecutor:
+    return concurrent.futures.ThreadPoolExecutor(max_workers=PROVIDER_POOL_SIZE, thread_name_prefix="hedge")
+
+
+def hedge_fallback_model(model: str) -> Optional[str]:
+    """First model in MODEL_PROVIDER_MAP on another provider that has a key and a closed breaker."""
+    primary = MODEL_PROVIDER_MAP.get(model)
+    resilience = get_provider_resilience()
+    for candidate, provider in MODEL_PROVIDER_MAP.items():
+        if provider != primary and os.getenv(PROVIDER_ENV_KEYS[provider]) and resilience.available(provider):
+            return candidate
+    return None
+
+
+# =========================
+# RESPONSE CACHE
+# =========================
+
+RESPONSE_CACHE_PATH = os.path.join(GUDID_DATA_DIR, "agent_responses.sqlite")
+RESPONSE_CACHE_TTL_HOURS = float(os.getenv("GUDID_RESPONSE_CACHE_TTL_HOURS", "24"))
+RESPONSE_CACHE_MAX_MB = float(os.getenv("GUDID_RESPONSE_CACHE_MAX_MB", "200"))
+
+
+class ResponseCache:
+    """
+    SQLite-backed cache of successful agent responses, shared by all sessions.
+
+    Entries expire after `ttl_seconds`; when the stored text exceeds `max_bytes`
+    the least recently used entries are evicted.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float, max_bytes: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                provider TEXT,
+                model TEXT,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(provider: str, model: str, system_prompt: str, query: str, max_tokens: int, temperature: float) -> str:
+        def digest(text: str) -> str:
+            return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+        parts = [provider, model, digest(system_prompt), digest(query), int(max_tokens), float(temperature)]
+        return digest(json.dumps(parts))
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, response: str, provider: str = "", model: str = ""):
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, provider, model, response, size, now, now),
+            )
+            self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        freed = 0
+        stale = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_used ASC"):
+            if total - freed <= self.max_bytes:
+                break
+            stale.append((key,))
+            freed += size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            entries, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "mb": round(total / 2**20, 2)}
+
+
+@st.cache_resource
+def get_response_cache() -> ResponseCache:
+    return ResponseCache(
+        RESPONSE_CACHE_PATH,
+        ttl_seconds=RESPONSE_CACHE_TTL_HOURS * 3600,
+        max_bytes=int(RESPONSE_CACHE_MAX_MB * 2**20),
+    )
+
+
+# =========================
+# AGENT IMPLEMENTATION
+# =========================
+
+class Agent:
+    """Individual agent for specific GUDID use case"""
+
+    def __init__(self, name: str, config: Dict):
+        self.name = name
+        self.config = config
+        self.llm_provider = config.get("llm_provider", "openai")
+        self.model = config.get("model", "gpt-4o-mini")
+        self.system_prompt = config.get("system_prompt", "")
+        self.capabilities = config.get("capabilities", [])
+        self.temperature = float(config.get("temperature", 0.7))
+
+    def resolve(self, system_prompt_override: Optional[str] = None, model_override: Optional[str] = None):
+        """Return (provider, model, system_prompt) after applying per-run overrides."""
+        effective_model = model_override or self.model
+        effective_system = system_prompt_override or self.system_prompt
+
+        provider = self.llm_provider
+        if model_override and model_override in MODEL_PROVIDER_MAP:
+            provider = MODEL_PROVIDER_MAP[model_override]
+        return provider, effective_model, effective_system
+
+    def caches(self, use_cache: Optional[bool]) -> bool:
+        """Whether a run uses the response cache; None means only when sampling is deterministic."""
+        return self.temperature == 0 if use_cache is None else use_cache
+
+    def execute(
+        self,
+        query: str,
+        system_prompt_override: Optional[str] = None,
+        model_override: Optional[str] = None,
+        max_tokens: int = 12000,
+        use_cache: Optional[bool] = None,
+        hedge_after: Optional[float] = None,
+        outcome: Optional[Dict] = None,
+    ) -> str:
+        try:
+            return self.complete(
+                query,
+                system_prompt_override=system_prompt_override,
+                model_override=model_override,
+                max_tokens=max_tokens,
+                use_cache=use_cache,
+                hedge_after=hedge_after,
+                outcome=outcome,
+            )
+        except ProviderUnavailableError as e:
+            return str(e)
+        except Exception as e:
+            return f"Error executing agent {self.name}: {str(e)}"
+
+    def complete(
+        self,
+        query: str,
+        system_prompt_override: Optional[str] = None,
+        model_override: Optional[str] = None,
+        max_tokens: int = 12000,
+        use_cache: Optional[bool] = None,
+        hedge_after: Optional[float] = None,
+        outcome: Optional[Dict] = None,
+    ) -> str:
+        """
+        Like execute, but raises on provider errors instead of returning an error string.
+
+        Successful responses are served from / stored in the response cache when
+        `use_cache` is True; None (the default) caches only agents with temperature 0,
+        whose answers are meant to be repeatable. With `hedge_after` (seconds), a request still pending
+        by then is raced against a fallback model and the first answer wins.
+
+        `outcome`, if given, is updated in place with the provider and model that
+        answered, seconds spent in the rate-limit queue and the hedge result;
+        nothing is logged here, so worker threads can call this and hand the
+        outcome to `_record_run` on the script thread.
+        """
+        provider, effective_model, effective_system = self.resolve(system_prompt_override, model_override)
+        outcome = {} if outcome is None else outcome
+        outcome.update(provider=provider, model=effective_model, waited_s=0.0, hedge=None)
+        if provider not in PROVIDER_ENV_KEYS:
+            raise ProviderUnavailableError(f"Unsupported LLM provider: {provider}")
+
+        cache = get_response_cache() if self.caches(use_cache) else None
+        cache_key = ResponseCache.make_key(
+            provider, effective_model, effective_system, query, max_tokens, self.temperature
+        )
+        if cache is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        if hedge_after is None:
+            response, outcome["waited_s"] = self._call(provider, effective_model, effective_system, query, max_tokens)
+        else:
+            response, winner = self._call_hedged(
+                provider, effective_model, effective_system, query, max_tokens, hedge_after, outcome
+            )
+            if winner != effective_model:
+                provider, effective_model = MODEL_PROVIDER_MAP[winner], winner
+                outcome.update(provider=provider, model=winner)
+                cache_key = ResponseCache.make_key(
+                    provider, winner, effective_system, query, max_tokens, self.temperature
+                )
+        if cache is not None and response:
+            cache.put(cache_key, response, provider, effective_model)
+        return response
+
+    def _call(self, provider: str, model: str, system_prompt: str, query: str, max_tokens: int) -> tuple:
+        """Returns (response, seconds waited for rate-limit budget across attempts)."""
+        executors = {
+            "openai": self._execute_openai,
+            "anthropic": self._execute_anthropic,
+            "gemini": self._execute_gemini,
+            "grok": self._execute_grok,
+        }
+        tokens = request_token_estimate(system_prompt, query, model, max_tokens)
+        waited = [0.0]
+
+        def attempt():
+            waited[0] += get_rate_limiter().acquire(provider, model, tokens)
+            return executors[provider](query, model, system_prompt, max_tokens)
+
+        return get_provider_resilience().call(provider, attempt), waited[0]
+
+    def _rate_limited_stream(
+        self, streamer, provider: str, query: str, model: str, system_prompt: str, max_tokens: int, outcome: Dict
+    ):
+        outcome["waited_s"] += get_rate_limiter().acquire(
+            provider, model, request_token_estimate(system_prompt, query, model, max_tokens)
+        )
+        yield from streamer(query, model, system_prompt, max_tokens)
+
+    def _call_hedged(
+        self,
+        provider: str,
+        model: str,
+        system_prompt: str,
+        query: str,
+        max_tokens: int,
+        hedge_after: float,
+        outcome: Dict,
+    ) -> tuple:
+        """Returns (response, winning_model); a raced request sets outcome["hedge"]."""
+        pool = get_hedge_executor()
+        # Each worker runs in a copy of this context so it keeps the session id for rate limiting.
+        primary = pool.submit(
+            contextvars.copy_context().run, self._call, provider, model, system_prompt, query, max_tokens
+        )
+        done, _ = concurrent.futures.wait([primary], timeout=hedge_after)
+        fallback = None if done else hedge_fallback_model(model)
+        if fallback is None:
+            response, outcome["waited_s"] = primary.result()
+            return response, model
+
+        backup = pool.submit(
+            contextvars.copy_context().run,
+            self._call,
+            MODEL_PROVIDER_MAP[fallback],
+            fallback,
+            system_prompt,
+            query,
+            max_tokens,
+        )
+        contenders = {primary: model, backup: fallback}
+        errors = []
+        # The losing request is left to finish in the background; its result is discarded.
+        for future in concurrent.futures.as_completed(contenders):
+            try:
+                response, outcome["waited_s"] = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            outcome["hedge"] = {"primary": model, "fallback": fallback, "winner": contenders[future]}
+            return response, contenders[future]
+        raise errors[0]
+
+    def execute_stream(
+        self,
+        query: str,
+        system_prompt_override: Optional[str] = None,
+        model_override: Optional[str] = None,
+        max_tokens: int = 12000,
+        use_cache: Optional[bool] = None,
+        outcome: Optional[Dict] = None,
+    ):
+        """Like execute, but yields text chunks as the provider produces them; `outcome` as in complete."""
+        provider, effective_model, effective_system = self.resolve(system_prompt_override, model_override)
+        outcome = {} if outcome is None else outcome
+        outcome.update(provider=provider, model=effective_model, waited_s=0.0, hedge=None)
+
+        streamers = {
+            "openai": self._stream_openai,
+            "anthropic": self._stream_anthropic,
+            "gemini": self._stream_gemini,
+            "grok": self._stream_grok,
+        }
+        if provider not in streamers:
+            yield f"Unsupported LLM provider: {provider}"
+            return
+
+        cache = get_response_cache() if self.caches(use_cache) else None
+        cache_key = ResponseCache.make_key(
+            provider, effective_model, effective_system, query, max_tokens, self.temperature
+        )
+        if cache is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                yield cached
+                return
+
+        parts: List[str] = []
+        stream = get_provider_resilience().stream(
+            provider,
+            lambda: self._rate_limited_stream(
+                streamers[provider], provider, query, effective_model, effective_system, max_tokens, outcome
+            ),
+        )
+        try:
+            for chunk in stream:
+                parts.append(chunk)
+                yield chunk
+        except ProviderUnavailableError as e:
+            yield str(e)
+            return
+        except Exception as e:
+            separator = "\n\n" if parts else ""
+            yield f"{separator}Error executing agent {self.name}: {str(e)}"
+            return
+        if cache is not None and parts:
+            cache.put(cache_key, "".join(parts), provider, effective_model)
+
+    def _execute_openai(self, query: str, model: str, system_prompt: str, max_tokens: int) -> str:
+        client = get_provider_clients().get("openai")
+
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": query},
+        ]
+
+        if hasattr(client, "chat") and hasattr(client.chat, "completions"):
+            response = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=self.temperature,
+                max_tokens=max_tokens,
+            )
+            return response.choices[0].message.content
+        else:
+            completion = client.Completion.create(
+                model=model,
+                prompt=f"{system_prompt}\n\nUser: {query}\nAssistant:",
+                max_tokens=max_tokens,
+                temperature=self.temperature,
+            )
+            return completion.choices[0].text
+
+    def _execute_anthropic(self, query: str, model: str, system_prompt: str, max_tokens: int) -> str:
+        client = get_provider_clients().get("anthropic")
+        response = client.messages.create(
+            model=model,
+            max_tokens=max_tokens,
+            temperature=self.temperature,
+            system=system_prompt,
+            messages=[{"role": "user", "content": query}],
+        )
+        return response.content[0].text
+
+    def _execute_gemini(self, query: str, model: str, system_prompt: str, max_tokens: int) -> str:
+        client = get_provider_clients().get("gemini")
         full_prompt = f"{system_prompt}\n\nUser Query:\n{query}"
-        model_obj = genai.GenerativeModel(model)
-        response = model_obj.generate_content(
+        response = client.model(model).generate_content(
             full_prompt,
-            generation_config={"max_output_tokens": max_tokens},
+            generation_config={"max_output_tokens": max_tokens, "temperature": self.temperature},
+            request_options={"timeout": PROVIDER_TIMEOUTS["gemini"]},
         )
         return getattr(response, "text", str(response))
 
     def _execute_grok(self, query: str, model: str, system_prompt: str, max_tokens: int) -> str:
-        api_key = os.getenv("GROK_API_KEY")
-        if not api_key:
-            return "Grok (xAI) API key not configured"
-        if requests is None:
-            return "requests library not installed"
-
-        url = "https://api.x.ai/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        }
+        session = get_provider_clients().get("grok")
         payload = {
             "model": model,
             "messages": [
@@ -779,57 +4254,403 @@ class Agent:
                 {"role": "user", "content": query},
             ],
             "max_tokens": max_tokens,
-            "temperature": 0.7,
+            "temperature": self.temperature,
         }
-        resp = requests.post(url, headers=headers, json=payload, timeout=60)
+        resp = session.post(GROK_API_URL, json=payload, timeout=PROVIDER_TIMEOUTS["grok"])
         if resp.status_code != 200:
-            return f"Grok API error: {resp.status_code} {resp.text}"
+            raise ProviderHTTPError("grok", resp.status_code, resp.text, resp.headers.get("retry-after"))
         data = resp.json()
         try:
-            return data["choices"][0]["message"]["content"]
+            return data["choices"][0]["message"]["content"]
+        except Exception:
+            return json.dumps(data, ensure_ascii=False, indent=2)
+
+    def _stream_openai(self, query: str, model: str, system_prompt: str, max_tokens: int):
+        client = get_provider_clients().get("openai")
+        if not (hasattr(client, "chat") and hasattr(client.chat, "completions")):
+            # Legacy SDK without chat streaming: fall back to a single chunk.
+            yield self._execute_openai(query, model, system_prompt, max_tokens)
+            return
+        stream = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": query},
+            ],
+            temperature=self.temperature,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def _stream_anthropic(self, query: str, model: str, system_prompt: str, max_tokens: int):
+        client = get_provider_clients().get("anthropic")
+        with client.messages.stream(
+            model=model,
+            max_tokens=max_tokens,
+            temperature=self.temperature,
+            system=system_prompt,
+            messages=[{"role": "user", "content": query}],
+        ) as stream:
+            for text in stream.text_stream:
+                yield text
+
+    def _stream_gemini(self, query: str, model: str, system_prompt: str, max_tokens: int):
+        client = get_provider_clients().get("gemini")
+        full_prompt = f"{system_prompt}\n\nUser Query:\n{query}"
+        response = client.model(model).generate_content(
+            full_prompt,
+            generation_config={"max_output_tokens": max_tokens, "temperature": self.temperature},
+            stream=True,
+            request_options={"timeout": PROVIDER_TIMEOUTS["gemini"]},
+        )
+        for chunk in response:
+            text = getattr(chunk, "text", "")
+            if text:
+                yield text
+
+    def _stream_grok(self, query: str, model: str, system_prompt: str, max_tokens: int):
+        session = get_provider_clients().get("grok")
+        payload = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": query},
+            ],
+            "max_tokens": max_tokens,
+            "temperature": self.temperature,
+            "stream": True,
+        }
+        with session.post(GROK_API_URL, json=payload, timeout=PROVIDER_TIMEOUTS["grok"], stream=True) as resp:
+            if resp.status_code != 200:
+                raise ProviderHTTPError("grok", resp.status_code, resp.text, resp.headers.get("retry-after"))
+            # Server-sent events: "data: {json}" lines, terminated by "data: [DONE]".
+            for line in resp.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    delta = json.loads(data)["choices"][0].get("delta", {})
+                except (ValueError, KeyError, IndexError):
+                    continue
+                if delta.get("content"):
+                    yield delta["content"]
+
+
+# =========================
+# SHARED REGISTRIES (agents.yaml, SKILL.md)
+# =========================
+
+SKILL_MD_PATH = "SKILL.md"
+
+
+def file_mtime(path: str) -> Optional[float]:
+    try:
+        return os.stat(path).st_mtime_ns / 1e9
+    except OSError:
+        return None
+
+
+class AgentRegistry:
+    """
+    Immutable snapshot of agents.yaml shared by every session.
+
+    Agents hold no per-request state, so one set of Agent objects serves all
+    sessions and threads; a new snapshot is built only when the file changes.
+    """
+
+    def __init__(
+        self, path: str, mtime: Optional[float], config: Dict, digest: str = "", error: Optional[str] = None
+    ):
+        self.path = path
+        self.mtime = mtime
+        self.digest = digest
+        self.error = error
+        self.config = MappingProxyType(config)
+        self.agents = MappingProxyType(
+            {name: Agent(name, agent_config) for name, agent_config in (config.get("agents") or {}).items()}
+        )
+
+
+@st.cache_resource(max_entries=2)
+def _load_agent_registry(path: str, mtime: Optional[float]) -> AgentRegistry:
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+        config = yaml.safe_load(raw.decode("utf-8")) or {}
+    except Exception as e:
+        return AgentRegistry(path, mtime, {}, error=f"Failed to load config: {e}")
+    return AgentRegistry(path, mtime, config, digest=hashlib.sha256(raw).hexdigest())
+
+
+def get_agent_registry(path: str = AGENTS_CONFIG_PATH) -> AgentRegistry:
+    return _load_agent_registry(path, file_mtime(path))
+
+
+@st.cache_resource(max_entries=4)
+def _read_text_file(path: str, mtime: Optional[float]) -> Optional[str]:
+    if mtime is None:
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+# =========================
+# SEMANTIC ROUTER (local TF-IDF over agents.yaml)
+# =========================
+
+ROUTER_VERSION = "2"
+ROUTER_CACHE_DIR = os.path.join(GUDID_DATA_DIR, "router")
+ROUTER_NGRAMS = (2, 3)
+# Relative weight of each agents.yaml field in an agent's routing document.
+ROUTER_FIELD_WEIGHTS = {"name": 2, "keywords": 4, "description": 3, "capabilities": 2, "system_prompt": 1}
+# Below this cosine score the router falls back to ROUTER_DEFAULT_AGENT.
+ROUTER_MIN_SCORE = 0.05
+ROUTER_DEFAULT_AGENT = "nlp_analyzer"
+
+# Routing keywords for agents whose agents.yaml text is Chinese-only, so English
+# queries still reach them; an agent's own `routing_keywords` list replaces these.
+ROUTER_KEYWORDS = {
+    "nlp_analyzer": ["分析", "文字", "analyze", "text", "nlp", "實體", "entity", "extract"],
+    "anomaly_detector": ["異常", "anomaly", "偵測", "detect", "檢測", "outlier"],
+    "duplicate_checker": ["重複", "duplicate", "相似", "similar", "dedupe"],
+    "label_matcher": ["標籤", "label", "比對", "match", "ocr"],
+    "data_standardizer": ["標準化", "standardize", "正規化", "normalize"],
+    "adverse_event_linker": ["不良事件", "adverse", "event", "連結", "link"],
+    "recall_manager": ["回收", "recall", "追蹤", "track"],
+    "eifu_manager": ["說明書", "eifu", "instructions", "ifu"],
+    "customs_verifier": ["海關", "customs", "查驗", "verify"],
+    "international_connector": ["國際", "international", "同步", "sync"],
+}
+
+ROUTER_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def router_word(word: str) -> str:
+    """Fold simple English plurals so "anomalies" matches "anomaly" and "devices" matches "device"."""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def router_terms(text: str) -> Dict[str, int]:
+    """
+    Term counts: ASCII words, plus character 2/3-grams of the remaining text
+    (works for unsegmented Chinese). English is not n-grammed, so a greeting
+    does not match agents on shared letter pairs.
+    """
+    text = text.lower()
+    counts: Dict[str, int] = {}
+    for word in ROUTER_WORD_PATTERN.findall(text):
+        key = f"w:{router_word(word)}"
+        counts[key] = counts.get(key, 0) + 1
+    for run in ROUTER_WORD_PATTERN.sub(" ", text).split():
+        for n in ROUTER_NGRAMS:
+            for i in range(len(run) - n + 1):
+                gram = run[i : i + n]
+                counts[gram] = counts.get(gram, 0) + 1
+    return counts
+
+
+def agent_routing_document(name: str, config: Dict) -> Dict[str, float]:
+    fields = {
+        "name": name.replace("_", " "),
+        "keywords": "\n".join(config.get("routing_keywords") or ROUTER_KEYWORDS.get(name, [])),
+        "description": config.get("description", ""),
+        "capabilities": "\n".join(config.get("capabilities") or []),
+        "system_prompt": config.get("system_prompt", ""),
+    }
+    counts: Dict[str, float] = {}
+    for field, text in fields.items():
+        for term, count in router_terms(text).items():
+            counts[term] = counts.get(term, 0.0) + count * ROUTER_FIELD_WEIGHTS[field]
+    return counts
+
+
+class SemanticRouter:
+    """
+    Nearest-agent router: sublinear TF-IDF vectors over character n-grams,
+    one L2-normalized row per agent, matched to a query by cosine similarity.
+    """
+
+    def __init__(self, names: List[str], vocabulary: List[str], idf: np.ndarray, matrix: np.ndarray):
+        self.names = names
+        self.vocabulary = {term: i for i, term in enumerate(vocabulary)}
+        self.idf = idf
+        self.matrix = matrix
+
+    @classmethod
+    def build(cls, agents: Dict[str, Dict]) -> "SemanticRouter":
+        names = list(agents)
+        documents = [agent_routing_document(name, agents[name]) for name in names]
+        vocabulary = sorted({term for doc in documents for term in doc})
+        index = {term: i for i, term in enumerate(vocabulary)}
+        matrix = np.zeros((len(names), len(vocabulary)), dtype=np.float32)
+        for row, doc in enumerate(documents):
+            cols = [index[t] for t in doc]
+            matrix[row, cols] = 1.0 + np.log(np.fromiter(doc.values(), dtype=np.float32))
+        df = np.count_nonzero(matrix, axis=0)
+        idf = (np.log((1 + len(names)) / (1 + df)) + 1.0).astype(np.float32)
+        matrix *= idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1.0, norms)
+        return cls(names, vocabulary, idf, matrix)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        vocabulary = sorted(self.vocabulary, key=self.vocabulary.get)
+        np.savez(
+            tmp_path, names=np.array(self.names), vocabulary=np.array(vocabulary), idf=self.idf, matrix=self.matrix
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "SemanticRouter":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["names"].tolist(), data["vocabulary"].tolist(), data["idf"], data["matrix"])
+
+    def route(self, query: str, k: int = 3) -> Dict:
+        """
+        {"agent", "confidence", "fallback", "alternatives": [(name, score), ...]}.
+
+        Below ROUTER_MIN_SCORE the query goes to ROUTER_DEFAULT_AGENT with
+        confidence 0 and fallback True, and all top-k matches are listed as
+        alternatives; otherwise alternatives are the next-best k - 1.
+        """
+        counts = router_terms(query)
+        cols = [self.vocabulary[t] for t in counts if t in self.vocabulary]
+        if not cols or not self.names:
+            return {"agent": ROUTER_DEFAULT_AGENT, "confidence": 0.0, "fallback": True, "alternatives": []}
+        weights = 1.0 + np.log(np.array([counts[t] for t in counts if t in self.vocabulary], dtype=np.float32))
+        weights *= self.idf[cols]
+        scores = self.matrix[:, cols] @ (weights / np.linalg.norm(weights))
+        top = np.argsort(-scores)[:k]
+        ranked = [(self.names[i], round(float(scores[i]), 3)) for i in top if scores[i] > 0]
+        if not ranked or ranked[0][1] < ROUTER_MIN_SCORE:
+            return {"agent": ROUTER_DEFAULT_AGENT, "confidence": 0.0, "fallback": True, "alternatives": ranked}
+        agent, confidence = ranked[0]
+        return {"agent": agent, "confidence": confidence, "fallback": False, "alternatives": ranked[1:]}
+
+
+@st.cache_resource(max_entries=2)
+def _load_semantic_router(digest: str, _registry: AgentRegistry) -> SemanticRouter:
+    path = os.path.join(ROUTER_CACHE_DIR, f"{digest[:24]}-v{ROUTER_VERSION}.npz")
+    if os.path.exists(path):
+        try:
+            return SemanticRouter.load(path)
         except Exception:
-            return json.dumps(data, ensure_ascii=False, indent=2)
+            pass
+    agents = {name: agent.config for name, agent in _registry.agents.items()}
+    router = SemanticRouter.build(agents)
+    try:
+        router.save(path)
+    except OSError:
+        pass
+    return router
+
+
+def get_semantic_router(registry: AgentRegistry) -> SemanticRouter:
+    """Router for this agents.yaml content; vectors are cached on disk keyed by the file's hash."""
+    return _load_semantic_router(registry.digest, registry)
 
 
 class AgentOrchestrator:
-    """Main orchestrator for the GUDID agentic AI system"""
+    """
+    Per-session orchestrator for the GUDID agentic AI system.
+
+    Holds only the session's conversation state; agents come from the shared
+    AgentRegistry, so a new session does not re-parse agents.yaml.
+    """
 
-    def __init__(self, config_path: str = "agents.yaml"):
-        self.config = self.load_config(config_path)
-        self.agents: Dict[str, Agent] = {}
+    def __init__(self, config_path: str = AGENTS_CONFIG_PATH):
+        self.config_path = config_path
         self.conversation_history: List[Dict] = []
-        self.initialize_agents()
+        self.last_result: Dict = {}
 
-    def load_config(self, path: str) -> Dict:
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                return yaml.safe_load(f)
-        except Exception as e:
-            st.error(f"Failed to load config: {e}")
-            return {}
+    @property
+    def registry(self) -> AgentRegistry:
+        return get_agent_registry(self.config_path)
+
+    @property
+    def config(self):
+        return self.registry.config
+
+    @property
+    def agents(self):
+        return self.registry.agents
 
-    def initialize_agents(self):
-        for agent_name, agent_config in self.config.get("agents", {}).items():
-            self.agents[agent_name] = Agent(agent_name, agent_config)
+    def route(self, user_query: str) -> Dict:
+        """Semantic routing result: best agent, its confidence and the next-best alternatives."""
+        return get_semantic_router(self.registry).route(user_query)
 
     def route_query(self, user_query: str) -> str:
-        query_lower = user_query.lower()
-        routing_keywords = {
-            "nlp_analyzer": ["分析", "文字", "analyze", "text", "nlp", "實體"],
-            "anomaly_detector": ["異常", "anomaly", "偵測", "detect", "檢測"],
-            "duplicate_checker": ["重複", "duplicate", "相似", "similar"],
-            "label_matcher": ["標籤", "label", "比對", "match", "ocr"],
-            "data_standardizer": ["標準化", "standardize", "正規化", "normalize"],
-            "adverse_event_linker": ["不良事件", "adverse", "連結", "link"],
-            "recall_manager": ["回收", "recall", "追蹤", "track"],
-            "eifu_manager": ["說明書", "eifu", "instructions"],
-            "customs_verifier": ["海關", "customs", "查驗", "verify"],
-            "international_connector": ["國際", "international", "同步", "sync"],
+        return self.route(user_query)["agent"]
+
+    def _record_run(
+        self,
+        agent_name: str,
+        user_query: str,
+        response: str,
+        model: str,
+        started: float,
+        first_token_at: Optional[float] = None,
+        streamed: bool = False,
+        outcome: Optional[Dict] = None,
+    ) -> Dict:
+        """
+        Append a finished run to conversation_history and the usage log.
+
+        `outcome` is the dict filled in by Agent.complete: its model (the hedge
+        winner, if any) replaces `model`, and its rate-limit wait and hedge result
+        are logged here. Call this from the script thread only.
+        """
+        if outcome:
+            model = outcome.get("model") or model
+            if outcome.get("waited_s", 0.0) >= 1.0:
+                log_event(
+                    "rate_limit_wait",
+                    f"provider={outcome['provider']}, model={model}, waited_s={outcome['waited_s']:.1f}",
+                )
+            hedge = outcome.get("hedge")
+            if hedge:
+                log_event(
+                    "hedged_request",
+                    f"agent={agent_name}, primary={hedge['primary']}, fallback={hedge['fallback']}, "
+                    f"winner={hedge['winner']}",
+                )
+        finished = time.perf_counter()
+        latency_ms = int((finished - started) * 1000)
+        ttft_ms = int(((first_token_at or finished) - started) * 1000)
+        record = {
+            "timestamp": datetime.now().isoformat(),
+            "agent": agent_name,
+            "query": user_query,
+            "response": response,
+            "model": model,
+            "ttft_ms": ttft_ms,
+            "latency_ms": latency_ms,
+            "streamed": streamed,
+        }
+        self.conversation_history.append(record)
+        log_event(
+            "agent_run",
+            f"agent={agent_name}, model={model}, ttft_ms={ttft_ms}, latency_ms={latency_ms}, streamed={streamed}",
+        )
+        return {
+            "agent": agent_name,
+            "response": response,
+            "timestamp": record["timestamp"],
+            "model": model,
+            "ttft_ms": ttft_ms,
+            "latency_ms": latency_ms,
         }
-        for agent_name, keywords in routing_keywords.items():
-            if any(keyword in query_lower for keyword in keywords):
-                return agent_name
-        return "nlp_analyzer"
 
     def process_query(
         self,
@@ -838,35 +4659,309 @@ class AgentOrchestrator:
         system_prompt_override: Optional[str] = None,
         model_override: Optional[str] = None,
         max_tokens: int = 12000,
+        use_cache: Optional[bool] = None,
+        hedge_after: Optional[float] = None,
     ) -> Dict:
-        agent_name = selected_agent if selected_agent else self.route_query(user_query)
+        routing = None if selected_agent else self.route(user_query)
+        agent_name = selected_agent or routing["agent"]
         if agent_name not in self.agents:
             return {"error": f"Agent {agent_name} not found"}
 
         agent = self.agents[agent_name]
+        started = time.perf_counter()
+        outcome: Dict = {}
         response = agent.execute(
             user_query,
             system_prompt_override=system_prompt_override,
             model_override=model_override,
             max_tokens=max_tokens,
+            use_cache=use_cache,
+            hedge_after=hedge_after,
+            outcome=outcome,
+        )
+        result = self._record_run(
+            agent_name, user_query, response, model_override or agent.model, started, outcome=outcome
         )
+        if routing is not None:
+            result["routing"] = routing
+        return result
 
-        record = {
-            "timestamp": datetime.now().isoformat(),
-            "agent": agent_name,
-            "query": user_query,
-            "response": response,
-            "model": model_override or agent.model,
-        }
-        self.conversation_history.append(record)
-        log_event("agent_run", f"agent={agent_name}, model={record['model']}")
+    def stream_query(
+        self,
+        user_query: str,
+        selected_agent: Optional[str] = None,
+        system_prompt_override: Optional[str] = None,
+        model_override: Optional[str] = None,
+        max_tokens: int = 12000,
+        use_cache: Optional[bool] = None,
+    ):
+        """
+        Streaming variant of process_query: yields response chunks as they arrive.
 
-        return {
-            "agent": agent_name,
-            "response": response,
-            "timestamp": record["timestamp"],
-            "model": record["model"],
-        }
+        Once the stream is exhausted the run is recorded like process_query and its
+        result dict (including ttft_ms / latency_ms) is available as `last_result`.
+        """
+        routing = None if selected_agent else self.route(user_query)
+        agent_name = selected_agent or routing["agent"]
+        if agent_name not in self.agents:
+            self.last_result = {"error": f"Agent {agent_name} not found"}
+            yield self.last_result["error"]
+            return
+
+        agent = self.agents[agent_name]
+        started = time.perf_counter()
+        first_token_at = None
+        parts: List[str] = []
+        outcome: Dict = {}
+        for chunk in agent.execute_stream(
+            user_query,
+            system_prompt_override=system_prompt_override,
+            model_override=model_override,
+            max_tokens=max_tokens,
+            use_cache=use_cache,
+            outcome=outcome,
+        ):
+            if not chunk:
+                continue
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            parts.append(chunk)
+            yield chunk
+
+        self.last_result = self._record_run(
+            agent_name,
+            user_query,
+            "".join(parts),
+            model_override or agent.model,
+            started,
+            first_token_at=first_token_at,
+            streamed=True,
+            outcome=outcome,
+        )
+        if routing is not None:
+            self.last_result["routing"] = routing
+
+    async def fan_out(
+        self,
+        user_query: str,
+        agent_names: List[str],
+        system_prompt_override: Optional[str] = None,
+        model_override: Optional[str] = None,
+        max_tokens: int = 12000,
+        use_cache: Optional[bool] = None,
+        hedge_after: Optional[float] = None,
+    ):
+        """
+        Run one query on several agents concurrently, yielding result dicts
+        (as returned by process_query) in completion order.
+
+        Provider calls run in worker threads; PROVIDER_CONCURRENCY caps how many
+        are in flight per provider. Runs are recorded from the event loop's
+        thread, so workers never touch Streamlit state.
+        """
+        semaphores = {provider: asyncio.Semaphore(limit) for provider, limit in PROVIDER_CONCURRENCY.items()}
+
+        async def run_one(agent_name: str):
+            agent = self.agents[agent_name]
+            provider, model, _ = agent.resolve(system_prompt_override, model_override)
+            outcome: Dict = {}
+            async with semaphores.setdefault(provider, asyncio.Semaphore(1)):
+                started = time.perf_counter()
+                response = await asyncio.to_thread(
+                    agent.execute,
+                    user_query,
+                    system_prompt_override=system_prompt_override,
+                    model_override=model_override,
+                    max_tokens=max_tokens,
+                    use_cache=use_cache,
+                    hedge_after=hedge_after,
+                    outcome=outcome,
+                )
+            return agent_name, model, response, started, outcome
+
+        tasks = [asyncio.create_task(run_one(name)) for name in agent_names if name in self.agents]
+        for future in asyncio.as_completed(tasks):
+            agent_name, model, response, started, outcome = await future
+            yield self._record_run(agent_name, user_query, response, model, started, outcome=outcome)
+
+    async def run_pipeline(
+        self,
+        pipeline: "AgentPipeline",
+        user_input: str,
+        outputs: Dict[str, str],
+        max_tokens: int = 12000,
+        use_cache: Optional[bool] = None,
+        hedge_after: Optional[float] = None,
+    ):
+        """
+        Execute a pipeline DAG, yielding one event dict per node as it settles.
+
+        Nodes start as soon as their dependencies have succeeded, so independent
+        branches run concurrently (capped per provider like fan_out). `outputs`
+        maps node id → output of nodes that already succeeded and is updated in
+        place: passing the same dict again after a failure resumes from the last
+        successful nodes. Event status is "reused", "done", "failed" or "skipped".
+        """
+        semaphores = {provider: asyncio.Semaphore(limit) for provider, limit in PROVIDER_CONCURRENCY.items()}
+
+        async def run_node(node_id: str):
+            node = pipeline.nodes[node_id]
+            if node["agent"] not in self.agents:
+                raise KeyError(f"Agent {node['agent']} not found")
+            agent = self.agents[node["agent"]]
+            query = pipeline.render_input(node_id, user_input, outputs)
+            provider, model, _ = agent.resolve(node["system_prompt"], node["model"])
+            outcome: Dict = {}
+            async with semaphores.setdefault(provider, asyncio.Semaphore(1)):
+                started = time.perf_counter()
+                response = await asyncio.to_thread(
+                    agent.complete,
+                    query,
+                    system_prompt_override=node["system_prompt"],
+                    model_override=node["model"],
+                    max_tokens=node["max_tokens"] or max_tokens,
+                    use_cache=use_cache,
+                    hedge_after=hedge_after,
+                    outcome=outcome,
+                )
+            return query, model, response, started, outcome
+
+        for node_id in pipeline.order:
+            if node_id in outputs:
+                yield {"node": node_id, "agent": pipeline.nodes[node_id]["agent"], "status": "reused"}
+
+        pending = [n for n in pipeline.order if n not in outputs]
+        failed: set = set()
+        running: Dict = {}
+        while pending or running:
+            for node_id in list(pending):
+                deps = pipeline.nodes[node_id]["depends_on"]
+                if any(d in failed for d in deps):
+                    pending.remove(node_id)
+                    failed.add(node_id)
+                    yield {"node": node_id, "agent": pipeline.nodes[node_id]["agent"], "status": "skipped"}
+                elif all(d in outputs for d in deps):
+                    pending.remove(node_id)
+                    running[asyncio.create_task(run_node(node_id))] = node_id
+            if not running:
+                break
+            done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                node_id = running.pop(task)
+                agent_name = pipeline.nodes[node_id]["agent"]
+                try:
+                    query, model, response, started, outcome = task.result()
+                except Exception as e:
+                    failed.add(node_id)
+                    log_event("pipeline_node_failed", f"pipeline={pipeline.name}, node={node_id}, error={e}")
+                    yield {"node": node_id, "agent": agent_name, "status": "failed", "error": str(e)}
+                    continue
+                outputs[node_id] = response
+                result = self._record_run(agent_name, query, response, model, started, outcome=outcome)
+                yield {"node": node_id, "status": "done", **result}
+
+
+# =========================
+# AGENT PIPELINES (pipelines.yaml)
+# =========================
+
+PIPELINES_PATH = "pipelines.yaml"
+
+PIPELINE_PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+
+class PipelineConfigError(ValueError):
+    """Invalid pipeline definition (unknown dependency, cycle, reserved node id)."""
+
+
+class AgentPipeline:
+    """
+    A DAG of agent runs defined in pipelines.yaml.
+
+    Each node names an agent (optionally a model / system prompt / max_tokens
+    override), the nodes it `depends_on`, and an `input` template in which
+    `{input}` is the user's input and `{<node_id>}` is that node's output;
+    a template may only name nodes it depends on.
+    """
+
+    def __init__(self, name: str, config: Dict):
+        self.name = name
+        self.description = config.get("description", "")
+        self.nodes: Dict[str, Dict] = {}
+        for node_id, node in (config.get("nodes") or {}).items():
+            if node_id == "input":
+                raise PipelineConfigError(f"{name}: 'input' is reserved for the user input")
+            if not node.get("agent"):
+                raise PipelineConfigError(f"{name}.{node_id}: missing 'agent'")
+            self.nodes[node_id] = {
+                "agent": node["agent"],
+                "model": node.get("model"),
+                "system_prompt": node.get("system_prompt"),
+                "max_tokens": node.get("max_tokens"),
+                "depends_on": list(node.get("depends_on") or []),
+                "input": node.get("input", "{input}"),
+            }
+            undeclared = sorted(
+                set(PIPELINE_PLACEHOLDER.findall(self.nodes[node_id]["input"]))
+                - {"input"}
+                - set(self.nodes[node_id]["depends_on"])
+            )
+            if undeclared:
+                raise PipelineConfigError(f"{name}.{node_id}: input uses {undeclared} without depends_on")
+        self.order = self._topological_order()
+        self.sinks = [n for n in self.order if not any(n in other["depends_on"] for other in self.nodes.values())]
+
+    def _topological_order(self) -> List[str]:
+        for node_id, node in self.nodes.items():
+            unknown = [d for d in node["depends_on"] if d not in self.nodes]
+            if unknown:
+                raise PipelineConfigError(f"{self.name}.{node_id}: unknown dependencies {unknown}")
+        remaining = {node_id: set(node["depends_on"]) for node_id, node in self.nodes.items()}
+        order: List[str] = []
+        while remaining:
+            ready = [node_id for node_id, deps in remaining.items() if not deps]
+            if not ready:
+                raise PipelineConfigError(f"{self.name}: dependency cycle among {sorted(remaining)}")
+            for node_id in ready:
+                order.append(node_id)
+                del remaining[node_id]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return order
+
+    def render_input(self, node_id: str, user_input: str, outputs: Dict[str, str]) -> str:
+        values = {"input": user_input, **outputs}
+        return PIPELINE_PLACEHOLDER.sub(lambda m: values.get(m.group(1), m.group(0)), self.nodes[node_id]["input"])
+
+    def final_output(self, outputs: Dict[str, str]) -> str:
+        """Output of the sink node, or of every sink under its own heading."""
+        sinks = [n for n in self.sinks if n in outputs]
+        if len(sinks) == 1:
+            return outputs[sinks[0]]
+        return "\n\n".join(f"## {n}\n\n{outputs[n]}" for n in sinks)
+
+
+@st.cache_resource(max_entries=2)
+def _load_pipelines(path: str, mtime: Optional[float]):
+    if mtime is None:
+        return MappingProxyType({}), []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            config = yaml.safe_load(f) or {}
+    except Exception as e:
+        return MappingProxyType({}), [f"Failed to load pipelines: {e}"]
+    pipelines, errors = {}, []
+    for name, pipeline_config in (config.get("pipelines") or {}).items():
+        try:
+            pipelines[name] = AgentPipeline(name, pipeline_config)
+        except PipelineConfigError as e:
+            errors.append(f"Invalid pipeline {e}")
+    return MappingProxyType(pipelines), errors
+
+
+def load_pipelines(path: str = PIPELINES_PATH):
+    """Parsed pipelines shared by all sessions; returns (pipelines, errors), re-parsed when the file changes."""
+    return _load_pipelines(path, file_mtime(path))
 
 
 # =========================
@@ -947,6 +5042,158 @@ def render_wow_status(orchestrator: AgentOrchestrator):
     provider_badge("Anthropic", "ANTHROPIC_API_KEY")
     provider_badge("Grok", "GROK_API_KEY")
 
+    cache_stats = get_response_cache().stats()
+    st.caption(
+        f"Response cache: {cache_stats['hits']} hits · {cache_stats['misses']} misses · "
+        f"{cache_stats['entries']} entries ({cache_stats['mb']} MB)"
+    )
+
+    with st.expander("Connection pools", expanded=False):
+        st.dataframe(pd.DataFrame(get_provider_clients().stats()), use_container_width=True)
+        st.dataframe(pd.DataFrame(get_provider_resilience().stats()), use_container_width=True)
+        limiter_stats = get_rate_limiter().stats()
+        if limiter_stats:
+            st.dataframe(pd.DataFrame(limiter_stats), use_container_width=True)
+    with st.expander("Lazy imports", expanded=False):
+        entries = get_import_report()["entries"]
+        if entries:
+            st.dataframe(pd.DataFrame(entries), use_container_width=True)
+        pending = [
+            name
+            for name, module in (
+                ("openai", openai),
+                ("anthropic", Anthropic),
+                ("google.generativeai", genai),
+                ("requests", requests),
+                ("tiktoken", tiktoken),
+                ("plotly.express", px),
+                ("networkx", nx),
+                ("pyvis", Network),
+            )
+            if module is not None and name not in sys.modules
+        ]
+        st.caption(f"Not loaded yet: {', '.join(pending) or '—'}")
+
+
+def format_routing(routing: Dict) -> str:
+    alternatives = ", ".join(f"{name} {score:.2f}" for name, score in routing["alternatives"])
+    confidence = tr("routing_fallback") if routing.get("fallback") else f"{routing['confidence']:.2f}"
+    return (
+        f"🧭 {tr('routing_label')}: {routing['agent']} ({confidence})"
+        + (f" · {tr('routing_alternatives')}: {alternatives}" if alternatives else "")
+    )
+
+
+def format_queue_status(provider: str, model: str, position: int, eta_s: float) -> str:
+    ahead = tr("queue_next") if position == 0 else tr("queue_ahead").format(n=position)
+    return f"⏳ {PROVIDER_LABELS.get(provider, provider)} · {model}: {ahead} · ETA ~{eta_s:.0f}s"
+
+
+async def watch_request_queue(placeholder, interval_s: float = 0.5):
+    """Show this session's rate-limit queue positions until cancelled."""
+    session_id = REQUEST_SESSION_ID.get()
+    try:
+        while True:
+            waiting = get_rate_limiter().waiting(session_id)
+            if waiting:
+                placeholder.caption(" | ".join(format_queue_status(**w) for w in waiting))
+            else:
+                placeholder.empty()
+            await asyncio.sleep(interval_s)
+    finally:
+        placeholder.empty()
+
+
+def collect_with_queue_status(placeholder, events) -> List:
+    """Drain an orchestrator async generator while showing this session's rate-limit queue."""
+
+    async def consume():
+        watcher = asyncio.create_task(watch_request_queue(placeholder))
+        try:
+            return [event async for event in events]
+        finally:
+            watcher.cancel()
+
+    return asyncio.run(consume())
+
+
+def render_fan_out(orchestrator: AgentOrchestrator, user_input: str, agent_names: List[str], **kwargs):
+    """Run a fan-out, showing each agent's answer as soon as it finishes; returns (combined_markdown, wall_ms)."""
+    progress = st.empty()
+    queue_status = st.empty()
+    results: List[Dict] = []
+    started = time.perf_counter()
+
+    async def consume():
+        watcher = asyncio.create_task(watch_request_queue(queue_status))
+        try:
+            async for result in orchestrator.fan_out(user_input, agent_names, **kwargs):
+                results.append(result)
+                progress.caption(f"{len(results)}/{len(agent_names)} agents finished")
+                with st.expander(f"🤖 {result['agent']} · {result['model']} · {result['latency_ms']} ms"):
+                    st.markdown(result["response"])
+        finally:
+            watcher.cancel()
+
+    progress.caption(f"0/{len(agent_names)} agents finished")
+    asyncio.run(consume())
+    wall_ms = int((time.perf_counter() - started) * 1000)
+    log_event("agent_fan_out", f"agents={','.join(agent_names)}, wall_ms={wall_ms}")
+
+    combined = "\n\n".join(f"## {r['agent']} ({r['model']})\n\n{r['response']}" for r in results)
+    return combined, wall_ms
+
+
+PIPELINE_STATUS_ICONS = {"pending": "⏳", "reused": "♻️", "done": "✅", "failed": "❌", "skipped": "⏭️"}
+
+
+def render_pipeline_run(orchestrator: AgentOrchestrator, pipeline: AgentPipeline, user_input: str, **kwargs):
+    """
+    Run a pipeline with live per-node status; returns (final_output, wall_ms).
+
+    Successful node outputs are kept in session_state per (pipeline, input), so
+    running again after a failure resumes instead of starting over.
+    """
+    run_key = hashlib.sha256(
+        json.dumps([pipeline.name, user_input, kwargs.get("max_tokens")], ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+    store = st.session_state.setdefault("pipeline_outputs", {})
+    outputs = store.setdefault(run_key, {})
+
+    slots = {node_id: st.empty() for node_id in pipeline.order}
+    for node_id in pipeline.order:
+        slots[node_id].markdown(f"{PIPELINE_STATUS_ICONS['pending']} **{node_id}** · {pipeline.nodes[node_id]['agent']}")
+
+    queue_status = st.empty()
+    failures = []
+    started = time.perf_counter()
+
+    async def consume():
+        watcher = asyncio.create_task(watch_request_queue(queue_status))
+        try:
+            await consume_events()
+        finally:
+            watcher.cancel()
+
+    async def consume_events():
+        async for event in orchestrator.run_pipeline(pipeline, user_input, outputs, **kwargs):
+            detail = ""
+            if event["status"] == "done":
+                detail = f" · {event['model']} · {event['latency_ms']} ms"
+            elif event["status"] == "failed":
+                detail = f" · {event['error']}"
+                failures.append(event["node"])
+            slots[event["node"]].markdown(
+                f"{PIPELINE_STATUS_ICONS[event['status']]} **{event['node']}** · {event['agent']}{detail}"
+            )
+
+    asyncio.run(consume())
+    wall_ms = int((time.perf_counter() - started) * 1000)
+    log_event("pipeline_run", f"pipeline={pipeline.name}, failed={','.join(failures)}, wall_ms={wall_ms}")
+    if failures:
+        st.warning(f"Failed nodes: {', '.join(failures)}. Run again to resume from the last successful nodes.")
+    return pipeline.final_output(outputs), wall_ms
+
 
 def render_agent_headquarters(orchestrator: AgentOrchestrator):
     st.markdown(tr("agent_hq_intro"))
@@ -958,37 +5205,164 @@ def render_agent_headquarters(orchestrator: AgentOrchestrator):
         st.warning("No agents configured in agents.yaml")
         return
 
+    pipelines, pipeline_errors = load_pipelines()
+    for error in pipeline_errors:
+        st.error(error)
+    run_modes = ["single", "fan_out"] + (["pipeline"] if pipelines else [])
+    run_mode = st.radio(
+        tr("agent_hq_mode"),
+        options=run_modes,
+        format_func=lambda m: tr(f"agent_hq_mode_{m}"),
+        horizontal=True,
+    )
+
     col_top1, col_top2 = st.columns([2, 1])
     with col_top1:
-        selected_agent = st.selectbox(tr("agent_hq_select_agent"), options=agents)
+        if run_mode == "pipeline":
+            pipeline = pipelines[st.selectbox(tr("agent_hq_pipeline"), options=list(pipelines))]
+            st.caption(pipeline.description)
+        elif run_mode == "fan_out":
+            fan_out_agents = st.multiselect(
+                tr("agent_hq_fan_out_agents"),
+                options=agents,
+                default=[a for a in FAN_OUT_DEFAULT_AGENTS if a in agents],
+            )
+        else:
+            suggested = st.session_state.agent_chain.get("suggested_agent")
+            selected_agent = st.selectbox(
+                tr("agent_hq_select_agent"),
+                options=agents,
+                index=agents.index(suggested) if suggested in agents else 0,
+            )
     with col_top2:
         model_options = list(MODEL_PROVIDER_MAP.keys())
-        selected_model = st.selectbox(tr("agent_hq_model"), options=model_options, index=0)
+        selected_model = st.selectbox(
+            tr("agent_hq_model"), options=model_options, index=0, disabled=run_mode == "pipeline"
+        )
+        use_agent_models = run_mode == "fan_out" and st.checkbox(tr("agent_hq_fan_out_defaults"), value=True)
 
     max_tokens = st.number_input(tr("agent_hq_max_tokens"), min_value=128, max_value=120000, value=12000, step=512)
+    if run_mode == "pipeline":
+        run_agents = [node["agent"] for node in pipeline.nodes.values()]
+    else:
+        run_agents = fan_out_agents if run_mode == "fan_out" else [selected_agent]
+    # Default to the agents' own rule: only deterministic (temperature 0) answers are worth replaying.
+    cache_default = bool(run_agents) and all(
+        orchestrator.agents[name].caches(None) for name in run_agents if name in orchestrator.agents
+    )
+    use_cache = st.checkbox(tr("agent_hq_use_cache"), value=cache_default)
+    hedged = st.checkbox(tr("agent_hq_hedged").format(seconds=HEDGE_AFTER_S), value=False)
+    hedge_after = HEDGE_AFTER_S if hedged else None
 
     base_input_default = st.session_state.agent_chain.get("current_input", "")
     user_input = st.text_area(tr("agent_hq_user_input"), value=base_input_default, height=160)
 
-    system_override = st.text_area(tr("agent_hq_system_prompt"), value="", height=120)
+    if run_mode == "pipeline":
+        system_override = ""
+        st.dataframe(
+            pd.DataFrame(
+                [
+                    {
+                        "node": node_id,
+                        "agent": pipeline.nodes[node_id]["agent"],
+                        "model": pipeline.nodes[node_id]["model"] or "(agent default)",
+                        "depends_on": ", ".join(pipeline.nodes[node_id]["depends_on"]),
+                    }
+                    for node_id in pipeline.order
+                ]
+            ),
+            use_container_width=True,
+        )
+    else:
+        system_override = st.text_area(tr("agent_hq_system_prompt"), value="", height=120)
 
     if st.button(tr("agent_hq_run"), type="primary"):
         if not user_input.strip():
             st.warning("Please provide input for the agent.")
-        else:
-            with st.spinner("Running agent..."):
-                result = orchestrator.process_query(
+        elif run_mode == "pipeline":
+            combined, wall_ms = render_pipeline_run(
+                orchestrator,
+                pipeline,
+                user_input,
+                max_tokens=max_tokens,
+                use_cache=use_cache,
+                hedge_after=hedge_after,
+            )
+            st.session_state.agent_chain["last_output"] = combined
+            st.session_state.agent_chain["last_timing"] = (None, wall_ms)
+        elif run_mode == "fan_out":
+            if not fan_out_agents:
+                st.warning("Please select at least one agent.")
+            else:
+                combined, wall_ms = render_fan_out(
+                    orchestrator,
                     user_input,
-                    selected_agent=selected_agent,
+                    fan_out_agents,
                     system_prompt_override=system_override or None,
-                    model_override=selected_model,
+                    model_override=None if use_agent_models else selected_model,
                     max_tokens=max_tokens,
+                    use_cache=use_cache,
+                    hedge_after=hedge_after,
                 )
-            response = result.get("response", "No response generated")
+                st.session_state.agent_chain["last_output"] = combined
+                st.session_state.agent_chain["last_timing"] = (None, wall_ms)
+        elif hedged:
+            # Hedged runs race complete responses, so they are not streamed; running the
+            # request as a one-agent fan-out keeps this thread free to show the queue.
+            queue_status = st.empty()
+            with st.spinner(tr("agent_hq_running")):
+                results = collect_with_queue_status(
+                    queue_status,
+                    orchestrator.fan_out(
+                        user_input,
+                        [selected_agent],
+                        system_prompt_override=system_override or None,
+                        model_override=selected_model,
+                        max_tokens=max_tokens,
+                        use_cache=use_cache,
+                        hedge_after=hedge_after,
+                    ),
+                )
+            result = results[0] if results else {"error": f"Agent {selected_agent} not found"}
+            response = result.get("response") or result.get("error") or "No response generated"
+            st.session_state.agent_chain["last_output"] = response
+            st.session_state.agent_chain["last_timing"] = (None, result.get("latency_ms"))
+        else:
+            live_output = st.empty()
+            queue_status = st.empty()
+            token = QUEUE_OBSERVER.set(lambda *status: queue_status.caption(format_queue_status(*status)))
+            try:
+                with live_output.container():
+                    st.write_stream(
+                        orchestrator.stream_query(
+                            user_input,
+                            selected_agent=selected_agent,
+                            system_prompt_override=system_override or None,
+                            model_override=selected_model,
+                            max_tokens=max_tokens,
+                            use_cache=use_cache,
+                        )
+                    )
+            finally:
+                QUEUE_OBSERVER.reset(token)
+            live_output.empty()
+            queue_status.empty()
+            result = orchestrator.last_result
+            response = result.get("response") or result.get("error") or "No response generated"
             st.session_state.agent_chain["last_output"] = response
+            st.session_state.agent_chain["last_timing"] = (result.get("ttft_ms"), result.get("latency_ms"))
+
+    if run_mode == "pipeline" and st.button(tr("agent_hq_pipeline_reset")):
+        st.session_state.pipeline_outputs = {}
+        st.success("Pipeline progress cleared.")
 
     if st.session_state.agent_chain.get("last_output"):
         st.subheader(tr("agent_hq_output"))
+        ttft_ms, latency_ms = st.session_state.agent_chain.get("last_timing", (None, None))
+        if latency_ms is not None and ttft_ms is None:
+            st.caption(f"Wall time: {latency_ms} ms")
+        elif latency_ms is not None:
+            st.caption(f"Time to first token: {ttft_ms} ms · Total latency: {latency_ms} ms")
         view_mode = st.radio(tr("agent_hq_view_mode"), [tr("view_markdown"), tr("view_text")], horizontal=True)
         output_text = st.session_state.agent_chain["last_output"]
 
@@ -1007,50 +5381,137 @@ def render_agent_headquarters(orchestrator: AgentOrchestrator):
 
 def render_supply_chain_analytics():
     st.subheader(tr("supply_chain_analytics"))
-    uploaded = st.file_uploader(tr("upload_csv"), type=["csv"])
+    uploads = st.file_uploader(tr("upload_csv"), type=["csv"], accept_multiple_files=True) or []
 
     # Log upload vs sample usage
-    if uploaded is not None:
-        last_name = st.session_state.get("last_csv_name")
-        if uploaded.name != last_name:
-            log_event("csv_upload", f"filename={uploaded.name}")
-            st.session_state.last_csv_name = uploaded.name
+    if uploads:
+        logged = st.session_state.setdefault("logged_csv_names", [])
+        for f in uploads:
+            if f.name not in logged:
+                log_event("csv_upload", f"filename={f.name}")
+                logged.append(f.name)
     else:
         if not st.session_state.get("sample_csv_logged", False):
             log_event("csv_sample_used", "Using built-in sample CSV")
             st.session_state.sample_csv_logged = True
 
-    df = load_packing_list(uploaded)
+    store = get_dataset_store() if pa is not None else None
+    store_stats = store.stats() if store is not None else None
+    persisted = list_persisted_datasets()
+    persisted_choice = ""
+    sources = {}
+    if store_stats and store_stats["rows"]:
+        sources[STORE_CHOICE] = (
+            f"📚 {tr('dataset_store')} · {store_stats['files']} files · {store_stats['rows']:,} rows"
+        )
+    sources.update(
+        {
+            d["key"]: f"{d.get('name', d['key'])} · {d.get('rows', 0):,} rows · {d.get('created', '')}"
+            for d in persisted
+        }
+    )
+    if sources:
+        persisted_choice = st.selectbox(
+            "Saved columnar dataset",
+            options=[""] + list(sources),
+            format_func=lambda k: sources.get(k, "— use upload / sample —"),
+        )
+
+    base_cube = None
+    if persisted_choice == STORE_CHOICE:
+        window_start = window_end = None
+        bounds = store.date_bounds()
+        if bounds:
+            min_d, max_d = bounds
+            default_window = (max(min_d, max_d - timedelta(days=STORE_DEFAULT_WINDOW_DAYS)), max_d)
+            window = st.date_input(
+                tr("dataset_store_window"),
+                value=default_window,
+                min_value=min_d,
+                max_value=max_d,
+            )
+            # Mid-selection the picker returns only the start; keep the last complete window until the end is picked.
+            if len(window) == 2:
+                st.session_state.store_window = tuple(window)
+            window_start, window_end = st.session_state.get("store_window", default_window)
+        dataset_key = store_window_key(window_start, window_end)
+        df = load_store_window_cached(window_start, window_end, DASHBOARD_COLUMNS)
+        base_cube = get_store_cube(window_start, window_end)
+        st.caption(
+            f"{store_stats['partitions']} monthly partitions ({store_stats['parts']} parts), "
+            f"{store_stats['duplicates_skipped']:,} duplicate rows skipped at ingest · "
+            f"window {window_start} → {window_end}: {len(df):,} rows"
+        )
+    elif persisted_choice:
+        dataset_key = persisted_choice
+        df = load_persisted_packing_list_cached(dataset_key, DASHBOARD_COLUMNS)
+    else:
+        dataset_key, df = load_packing_lists_cached(uploads)
+        upload_name = ", ".join(f.name for f in uploads)
+        if uploads and pa is not None:
+            col_s1, col_s2 = st.columns(2)
+            with col_s1:
+                if os.path.exists(persisted_dataset_path(dataset_key)):
+                    st.caption("This upload is already saved as a columnar dataset.")
+                elif st.button("💾 Save as columnar dataset (Arrow)"):
+                    path = persist_packing_list(df, dataset_key, name=upload_name)
+                    log_event("dataset_persisted", f"filename={upload_name}, path={path}")
+                    st.success(f"Saved {len(df):,} rows to {path}")
+            with col_s2:
+                pending = [f for f in uploads if not store.has(_session_digest(f))]
+                if not pending:
+                    st.caption(tr("dataset_store_done"))
+                elif st.button(f"📚 {tr('dataset_store_append')} ({len(pending)})"):
+                    for f in pending:
+                        result = append_to_store(f)
+                        st.success(
+                            f"{result['name']}: +{result['added']:,} rows, {result['duplicates']:,} duplicates skipped "
+                            f"→ {', '.join(result['partitions']) or '—'}"
+                        )
+
+    def dataset_columns(columns: List[str]) -> pd.DataFrame:
+        """Whole-dataset rows with extra columns the dashboard projection leaves out."""
+        if persisted_choice == STORE_CHOICE:
+            return load_store_window_cached(window_start, window_end, columns)
+        if persisted_choice:
+            return load_persisted_packing_list_cached(dataset_key, columns)
+        return df
 
     if df.empty:
         st.info("No data.")
         return
 
+    stats = df.attrs.get("ingest_stats")
+    if stats:
+        st.caption(
+            f"Ingested {stats['rows']:,} rows in {stats['chunks']} chunk(s), {stats['seconds']}s "
+            f"({stats['rows_per_sec']:,} rows/s), process peak RSS +{stats.get('peak_rss_growth_mb', '—')} MB, "
+            f"frame {stats['frame_mb']} MB"
+        )
+    cache_stats = get_ingest_cache().stats()
+    st.caption(
+        f"Ingest cache: {cache_stats['entries']} dataset(s), {cache_stats['mb']} / {cache_stats['budget_mb']} MB, "
+        f"{cache_stats['hits']} hits, {cache_stats['misses']} misses · dataset {dataset_key[:12]}"
+    )
+
+    index = get_packing_list_index(dataset_key, df)
+
     # Basic filters
     st.markdown("### Filters")
     col_f1, col_f2 = st.columns(2)
 
     with col_f1:
         if "customer" in df.columns:
-            customers = sorted(df["customer"].dropna().unique().tolist())
+            customers = index.customers
             selected_customers = st.multiselect("Customer", options=customers, default=customers)
         else:
             selected_customers = []
 
     with col_f2:
         date_range = None
-        if "deliverdate_dt" in df.columns and df["deliverdate_dt"].notna().any():
-            df_dates = df[df["deliverdate_dt"].notna()].copy()
-            min_ts = df_dates["deliverdate_dt"].min()
-            max_ts = df_dates["deliverdate_dt"].max()
-            if isinstance(min_ts, pd.Timestamp):
-                min_d = min_ts.date()
-            else:
-                min_d = min_ts
-            if isinstance(max_ts, pd.Timestamp):
-                max_d = max_ts.date()
-            else:
-                max_d = max_ts
+        bounds = index.date_bounds()
+        if bounds:
+            min_d, max_d = bounds
             date_range = st.slider(
                 "Deliver Date Range",
                 min_value=min_d,
@@ -1058,38 +5519,33 @@ def render_supply_chain_analytics():
                 value=(min_d, max_d),
             )
 
-    # Apply filters
-    mask = pd.Series(True, index=df.index)
-
-    if selected_customers:
-        mask &= df["customer"].isin(selected_customers)
+    # Apply filters through the row index; df_f only carries the row-level columns
+    # still needed below (the tables and charts read the summary cube).
+    positions = index.select(selected_customers, date_range)
+    df_f = filtered_rows(df, positions, FILTERED_ROW_COLUMNS)
+    filter_key = hashlib.blake2b(
+        json.dumps([sorted(map(str, selected_customers)), [str(d) for d in (date_range or ())]]).encode("utf-8"),
+        digest_size=12,
+    ).hexdigest()
 
-    if date_range and "deliverdate_dt" in df.columns:
-        start_date, end_date = date_range
-        valid_dt = df["deliverdate_dt"].notna()
-        mask &= valid_dt
-        mask.loc[valid_dt] &= df.loc[valid_dt, "deliverdate_dt"].dt.date.between(start_date, end_date)
-
-    df_f = df[mask].copy()
+    if base_cube is None:
+        base_cube = get_summary_cube(dataset_key, df)
+    cube = filter_summary_cube(base_cube, selected_customers, date_range)
+    is_zh = st.session_state.get("lang", "zh") == "zh"
 
     # ========== 3 SUMMARY TABLES ==========
     st.markdown(tr("summary_tables"))
 
     # Table 1: Global metrics
-    if "Numbers" in df_f.columns:
-        total_units = int(df_f["Numbers"].sum())
-    else:
-        total_units = len(df_f)
-
     summary_1 = pd.DataFrame(
         [
             {
-                "Total Lines": len(df_f),
-                "Total Units": total_units,
-                "Suppliers": df_f["Suppliername"].nunique() if "Suppliername" in df_f.columns else 0,
-                "Customers": df_f["customer"].nunique() if "customer" in df_f.columns else 0,
-                "Devices": df_f["DeviceName"].nunique() if "DeviceName" in df_f.columns else 0,
-                "Models": df_f["ModelNum"].nunique() if "ModelNum" in df_f.columns else 0,
+                "Total Lines": int(cube["Lines"].sum()),
+                "Total Units": int(cube["Units"].sum()),
+                "Suppliers": cube["Suppliername"].nunique() if "Suppliername" in cube.columns else 0,
+                "Customers": cube["customer"].nunique() if "customer" in cube.columns else 0,
+                "Devices": cube["DeviceName"].nunique() if "DeviceName" in cube.columns else 0,
+                "Models": cube["ModelNum"].nunique() if "ModelNum" in cube.columns else 0,
                 "Lots": df_f["LotNumber"].nunique() if "LotNumber" in df_f.columns else 0,
             }
         ]
@@ -1098,7 +5554,7 @@ def render_supply_chain_analytics():
     # Download button for summary_1
     csv_summary = summary_1.to_csv(index=False).encode("utf-8-sig")
     st.download_button(
-        "下載摘要表 CSV" if st.session_state.get("lang", "zh") == "zh" else "Download summary CSV",
+        "下載摘要表 CSV" if is_zh else "Download summary CSV",
         data=csv_summary,
         file_name="summary_overview.csv",
         mime="text/csv",
@@ -1106,21 +5562,18 @@ def render_supply_chain_analytics():
     )
 
     # Table 2: Volume by customer
-    if "customer" in df_f.columns:
-        tbl_customer = (
-            df_f.groupby("customer")
-            .agg(
-                Total_Units=("Numbers", "sum") if "Numbers" in df_f.columns else ("customer", "count"),
-                Lines=("customer", "count"),
-                Unique_Models=("ModelNum", "nunique") if "ModelNum" in df_f.columns else ("customer", "nunique"),
-            )
-            .reset_index()
-            .sort_values("Total_Units", ascending=False)
+    if "customer" in cube.columns:
+        tbl_customer = rollup_cube(
+            cube,
+            "customer",
+            Total_Units=("Units", "sum"),
+            Lines=("Lines", "sum"),
+            Unique_Models=("ModelNum", "nunique") if "ModelNum" in cube.columns else ("Lines", "size"),
         )
         st.dataframe(tbl_customer, use_container_width=True)
         csv_cust = tbl_customer.to_csv(index=False).encode("utf-8-sig")
         st.download_button(
-            "下載客戶統計 CSV" if st.session_state.get("lang", "zh") == "zh" else "Download customer summary CSV",
+            "下載客戶統計 CSV" if is_zh else "Download customer summary CSV",
             data=csv_cust,
             file_name="customer_summary.csv",
             mime="text/csv",
@@ -1128,44 +5581,207 @@ def render_supply_chain_analytics():
         )
 
     # Table 3: Device / Model performance
-    if "ModelNum" in df_f.columns and "DeviceName" in df_f.columns:
-        tbl_device = (
-            df_f.groupby(["DeviceName", "ModelNum"])
-            .agg(
-                Total_Units=("Numbers", "sum") if "Numbers" in df_f.columns else ("ModelNum", "count"),
-                Customers=("customer", "nunique") if "customer" in df_f.columns else ("ModelNum", "nunique"),
-                Lots=("LotNumber", "nunique") if "LotNumber" in df_f.columns else ("ModelNum", "nunique"),
-            )
-            .reset_index()
-            .sort_values("Total_Units", ascending=False)
+    if "ModelNum" in cube.columns and "DeviceName" in cube.columns:
+        tbl_device = rollup_cube(
+            cube,
+            ["DeviceName", "ModelNum"],
+            Total_Units=("Units", "sum"),
+            Customers=("customer", "nunique") if "customer" in cube.columns else ("Lines", "size"),
         )
+        if "LotNumber" in df_f.columns:
+            # Distinct lots are not additive, so they come from the filtered rows.
+            lots = df_f.groupby(["DeviceName", "ModelNum"], observed=True)["LotNumber"].nunique().rename("Lots")
+            tbl_device = tbl_device.merge(lots.reset_index(), on=["DeviceName", "ModelNum"], how="left")
         st.dataframe(tbl_device, use_container_width=True)
         csv_dev = tbl_device.to_csv(index=False).encode("utf-8-sig")
         st.download_button(
-            "下載裝置/型號統計 CSV" if st.session_state.get("lang", "zh") == "zh" else "Download device/model summary CSV",
+            "下載裝置/型號統計 CSV" if is_zh else "Download device/model summary CSV",
             data=csv_dev,
             file_name="device_model_summary.csv",
             mime="text/csv",
             key="download_device_summary",
         )
 
+    with st.expander(tr("data_context")):
+        col_c1, col_c2 = st.columns(2)
+        with col_c1:
+            context_model = st.selectbox(tr("data_context_model"), options=list(MODEL_PROVIDER_MAP), key="context_model")
+        with col_c2:
+            context_budget = st.number_input(
+                tr("data_context_budget"), min_value=200, max_value=100000, value=CONTEXT_DEFAULT_BUDGET, step=500
+            )
+        context_key = (dataset_key, filter_key, context_model, int(context_budget))
+        if st.button(tr("data_context_build")):
+            st.session_state.data_context = {
+                "key": context_key,
+                **pack_data_context(df_f, context_model, budget_tokens=int(context_budget)),
+            }
+        packed = st.session_state.get("data_context")
+        if packed and packed["key"] == context_key:
+            st.caption(
+                f"~{packed['tokens']:,} / {packed['budget']:,} tokens ({context_model}"
+                f"{', tiktoken' if tiktoken is not None and MODEL_PROVIDER_MAP[context_model] == 'openai' else ', estimated'})"
+                " · rows included: " + ", ".join(f"{k} {v}" for k, v in packed["sections"].items())
+            )
+            st.code(packed["text"], language="text")
+            if st.button(tr("data_context_send")):
+                if "agent_chain" not in st.session_state:
+                    st.session_state.agent_chain = {"last_output": "", "current_input": ""}
+                st.session_state.agent_chain["current_input"] = packed["text"]
+                log_event("data_context_sent", f"model={context_model}, tokens={packed['tokens']}")
+                st.success(tr("data_context_sent"))
+
+    with st.expander(tr("anomaly_engine")):
+        col_a1, col_a2 = st.columns(2)
+        anomaly_params = {
+            "z_threshold": col_a1.number_input(
+                "z threshold", min_value=2.0, max_value=10.0, value=ANOMALY_DEFAULTS["z_threshold"], step=0.5
+            ),
+            "daily_ratio": col_a2.number_input(
+                "Daily fold change", min_value=1.5, max_value=20.0, value=ANOMALY_DEFAULTS["daily_ratio"], step=0.5
+            ),
+        }
+        anomaly_view = (dataset_key, filter_key)
+        if st.button(tr("anomaly_engine_run")) or st.session_state.get("anomaly_view") == anomaly_view:
+            st.session_state.anomaly_view = anomaly_view
+            started = time.perf_counter()
+            # Baselines need the whole dataset; positions limit the output to the filtered rows.
+            source = dataset_columns(ANOMALY_COLUMNS)
+            flagged = get_anomalies(dataset_key, filter_key, source, positions, **anomaly_params)
+            elapsed = time.perf_counter() - started
+            st.caption(f"{len(flagged):,} of {len(df_f):,} lines flagged · {elapsed:.2f}s")
+            counts = pd.DataFrame(
+                [
+                    {
+                        "rule": name,
+                        "description": ANOMALY_LABELS[name],
+                        "lines": int(((flagged["anomaly_flags"] & bit) > 0).sum()),
+                    }
+                    for name, bit in ANOMALY_FLAGS.items()
+                ]
+            )
+            st.dataframe(counts, use_container_width=True)
+            if len(flagged):
+                st.dataframe(flagged.head(500), use_container_width=True)
+                st.download_button(
+                    "Download flagged rows CSV",
+                    data=flagged.to_csv(index=False).encode("utf-8-sig"),
+                    file_name="anomalies.csv",
+                    mime="text/csv",
+                    key="download_anomalies",
+                )
+                if st.button(tr("anomaly_engine_send")):
+                    if "agent_chain" not in st.session_state:
+                        st.session_state.agent_chain = {"last_output": "", "current_input": ""}
+                    st.session_state.agent_chain["current_input"] = anomaly_agent_prompt(
+                        flagged, len(df_f), context_model, int(context_budget)
+                    )
+                    st.session_state.agent_chain["suggested_agent"] = "anomaly_detector"
+                    log_event("anomalies_sent", f"flagged={len(flagged)}, rows={len(df_f)}")
+                    st.success(tr("anomaly_engine_sent"))
+
+    with st.expander(tr("duplicate_engine")):
+        col_d1, col_d2 = st.columns(2)
+        duplicate_params = {
+            "similarity": col_d1.slider(
+                "Name similarity", min_value=0.70, max_value=0.99, value=DUPLICATE_DEFAULTS["similarity"], step=0.01
+            ),
+            "date_tolerance_days": col_d2.number_input(
+                "Near-duplicate date tolerance (days)",
+                min_value=0,
+                max_value=30,
+                value=DUPLICATE_DEFAULTS["date_tolerance_days"],
+            ),
+        }
+        # Duplicates are judged on the whole dataset, not the current filter.
+        if st.button(tr("duplicate_engine_run")) or st.session_state.get("duplicate_view") == dataset_key:
+            st.session_state.duplicate_view = dataset_key
+            source = dataset_columns(DUPLICATE_COLUMNS)
+            duplicates = get_duplicates(dataset_key, source, **duplicate_params)
+            dup_stats = duplicates["stats"]
+            st.caption(
+                f"{dup_stats['duplicate_rows']:,} of {dup_stats['rows']:,} lines in {dup_stats['groups']:,} groups "
+                f"({dup_stats['exact_groups']:,} exact, {dup_stats['near_groups']:,} near) · "
+                f"{dup_stats['pairs_scored']:,} name pairs scored · {dup_stats['seconds']:.2f}s"
+            )
+            if len(duplicates["variants"]):
+                st.markdown(f"**{tr('duplicate_engine_variants')}**")
+                st.dataframe(duplicates["variants"], use_container_width=True)
+            groups = duplicates["groups"]
+            if len(groups):
+                st.dataframe(groups.head(1000), use_container_width=True)
+                st.download_button(
+                    "Download duplicate groups CSV",
+                    data=groups.to_csv(index=False).encode("utf-8-sig"),
+                    file_name="duplicate_groups.csv",
+                    mime="text/csv",
+                    key="download_duplicates",
+                )
+            if len(groups) or len(duplicates["variants"]):
+                if st.button(tr("duplicate_engine_send")):
+                    if "agent_chain" not in st.session_state:
+                        st.session_state.agent_chain = {"last_output": "", "current_input": ""}
+                    st.session_state.agent_chain["current_input"] = duplicate_agent_prompt(
+                        duplicates, context_model, int(context_budget)
+                    )
+                    st.session_state.agent_chain["suggested_agent"] = "duplicate_checker"
+                    log_event("duplicates_sent", f"groups={dup_stats['groups']}, rows={dup_stats['rows']}")
+                    st.success(tr("duplicate_engine_sent"))
+
+    if "UDI" in df.columns or persisted_choice:
+        with st.expander(tr("udi_quality")):
+            # The bitmask is computed at ingest over the whole dataset, not the current filter.
+            source = dataset_columns(UDI_QUALITY_COLUMNS + ["udi_quality"])
+            if "UDI" not in source.columns:
+                st.info("No UDI column in this dataset.")
+            else:
+                udi_summary = get_udi_quality(dataset_key, source)
+                st.caption(
+                    f"{udi_summary['clean']:,} of {udi_summary['rows']:,} lines clean · "
+                    f"{len(udi_summary['by_udi']):,} distinct UDIs with problems"
+                )
+                st.dataframe(
+                    pd.DataFrame(
+                        [
+                            {"problem": name, "description": UDI_QUALITY_LABELS[name], "lines": hits}
+                            for name, hits in udi_summary["counts"].items()
+                        ]
+                    ),
+                    use_container_width=True,
+                )
+                by_udi = udi_summary["by_udi"]
+                if len(by_udi):
+                    st.dataframe(by_udi.head(500), use_container_width=True)
+                    st.download_button(
+                        "Download problem UDIs CSV",
+                        data=by_udi.to_csv(index=False).encode("utf-8-sig"),
+                        file_name="udi_quality.csv",
+                        mime="text/csv",
+                        key="download_udi_quality",
+                    )
+                    if st.button(tr("udi_quality_send")):
+                        if "agent_chain" not in st.session_state:
+                            st.session_state.agent_chain = {"last_output": "", "current_input": ""}
+                        st.session_state.agent_chain["current_input"] = udi_agent_prompt(
+                            udi_summary, context_model, int(context_budget)
+                        )
+                        st.session_state.agent_chain["suggested_agent"] = "udi_quality_checker"
+                        log_event("udi_quality_sent", f"udis={len(by_udi)}, rows={udi_summary['rows']}")
+                        st.success(tr("udi_quality_sent"))
+
     # ========== 5 DISTRIBUTION / RELATION CHARTS ==========
     st.markdown(tr("dist_charts"))
 
     charts_col1, charts_col2 = st.columns(2)
 
     # Chart 1: Deliveries over time
-    if "deliverdate_dt" in df_f.columns and df_f["deliverdate_dt"].notna().any():
-        time_agg = (
-            df_f[df_f["deliverdate_dt"].notna()]
-            .groupby("deliverdate_dt")
-            .agg(
-                Total_Units=("Numbers", "sum") if "Numbers" in df_f.columns else ("deliverdate_dt", "count"),
-                Lines=("Suppliername", "count") if "Suppliername" in df_f.columns else ("deliverdate_dt", "count"),
-            )
-            .reset_index()
-            .sort_values("deliverdate_dt")
-        )
+    if "deliverdate_dt" in cube.columns and cube["deliverdate_dt"].notna().any():
+        time_agg = rollup_cube(
+            cube[cube["deliverdate_dt"].notna()],
+            "deliverdate_dt",
+            Total_Units=("Units", "sum"),
+            Lines=("Lines", "sum"),
+        ).sort_values("deliverdate_dt")
         fig_time = px.line(
             time_agg,
             x="deliverdate_dt",
@@ -1176,13 +5792,8 @@ def render_supply_chain_analytics():
         charts_col1.plotly_chart(fig_time, use_container_width=True)
 
     # Chart 2: Volume by Customer
-    if "customer" in df_f.columns:
-        cust_agg = (
-            df_f.groupby("customer")
-            .agg(Total_Units=("Numbers", "sum") if "Numbers" in df_f.columns else ("customer", "count"))
-            .reset_index()
-            .sort_values("Total_Units", ascending=False)
-        )
+    if "customer" in cube.columns:
+        cust_agg = rollup_cube(cube, "customer")
         fig_cust = px.bar(
             cust_agg,
             x="customer",
@@ -1192,14 +5803,8 @@ def render_supply_chain_analytics():
         charts_col2.plotly_chart(fig_cust, use_container_width=True)
 
     # Chart 3: Volume by DeviceName (Top 10)
-    if "DeviceName" in df_f.columns:
-        dev_agg = (
-            df_f.groupby("DeviceName")
-            .agg(Total_Units=("Numbers", "sum") if "Numbers" in df_f.columns else ("DeviceName", "count"))
-            .reset_index()
-            .sort_values("Total_Units", ascending=False)
-            .head(10)
-        )
+    if "DeviceName" in cube.columns:
+        dev_agg = rollup_cube(cube, "DeviceName").head(10)
         fig_dev = px.bar(
             dev_agg,
             x="DeviceName",
@@ -1209,13 +5814,8 @@ def render_supply_chain_analytics():
         st.plotly_chart(fig_dev, use_container_width=True)
 
     # Chart 4: Volume by LicenseID / DeviceCategory (pie)
-    if "licenseID" in df_f.columns:
-        lic_agg = (
-            df_f.groupby("licenseID")
-            .agg(Total_Units=("Numbers", "sum") if "Numbers" in df_f.columns else ("licenseID", "count"))
-            .reset_index()
-            .sort_values("Total_Units", ascending=False)
-        )
+    if "licenseID" in cube.columns:
+        lic_agg = rollup_cube(cube, "licenseID")
         fig_lic = px.pie(
             lic_agg,
             names="licenseID",
@@ -1250,6 +5850,28 @@ def render_supply_chain_analytics():
         max_edges = st.number_input("Max edges", min_value=10, max_value=4000, value=400, step=10)
         graph_height = st.slider("Graph height (px)", min_value=300, max_value=900, value=520, step=20)
 
+    col_lod1, col_lod2 = st.columns([1.5, 2])
+    with col_lod1:
+        lod_mode = st.radio(
+            "Level of detail",
+            options=list(GRAPH_LOD_MODES),
+            format_func=lambda m: GRAPH_LOD_MODES[m],
+        )
+    with col_lod2:
+        graph_layout = st.radio(
+            "Layout",
+            options=list(GRAPH_LAYOUTS),
+            format_func=lambda m: GRAPH_LAYOUTS[m],
+            horizontal=True,
+        )
+        expanded_groups = []
+        if lod_mode == "collapse":
+            expanded_groups = st.multiselect(
+                "Expand aggregate",
+                options=list(AGGREGATE_NODE_LABELS),
+                format_func=lambda t: AGGREGATE_NODE_LABELS[t],
+            )
+
     search_term = st.text_input("Search node (customer code or device name)")
 
     # Legend
@@ -1270,22 +5892,106 @@ def render_supply_chain_analytics():
         unsafe_allow_html=True,
     )
 
-    net = build_supply_chain_graph(
-        df_f,
-        license_id_filter=None if selected_license == "All" else selected_license,
-        lot_filter=None if selected_lot == "All" else selected_lot,
-        max_nodes=int(max_nodes),
-        max_edges=int(max_edges),
-        search_term=search_term.strip() or None,
+    license_id_filter = None if selected_license == "All" else selected_license
+    lot_filter = None if selected_lot == "All" else selected_lot
+    graph_key = (
+        dataset_key,
+        filter_key,
+        license_id_filter,
+        lot_filter,
+        int(max_nodes),
+        int(max_edges),
+        lod_mode,
+        tuple(sorted(expanded_groups)),
+        graph_layout,
+    )
+
+    def build_graph_html():
+        # Built without the search term: highlights are patched in client-side.
+        net = build_supply_chain_graph(
+            df_f,
+            license_id_filter=license_id_filter,
+            lot_filter=lot_filter,
+            max_nodes=int(max_nodes),
+            max_edges=int(max_edges),
+            lod_mode=lod_mode,
+            expanded_groups=expanded_groups,
+            layout=graph_layout,
+        )
+        return supply_chain_graph_html(net)
+
+    if nx is None or Network is None:
+        graph = None
+    else:
+        try:
+            graph = get_graph_html_cache().get_or_create(graph_key, build_graph_html)
+        except Exception as e:
+            st.error(f"Failed to render supply chain graph: {e}")
+            return
+    render_supply_chain_graph_html(graph, height=int(graph_height), search_term=search_term.strip() or None)
+
+
+def render_recall_trace():
+    st.subheader(tr("recall_trace_tab"))
+    if pa is None:
+        st.info("pyarrow is required for the traceability index.")
+        return
+
+    index = get_trace_index()
+    stats = index.stats()
+    st.caption(
+        f"Trace index: {stats['segments']} file(s), {stats['rows']:,} rows, "
+        f"{stats['postings_mb']} MB postings · {TRACE_INDEX_DIR}"
+    )
+
+    unindexed = [d for d in list_persisted_datasets() if not index.has(d["key"])]
+    if unindexed and st.button(tr("recall_trace_backfill").format(n=len(unindexed))):
+        for d in unindexed:
+            df = load_persisted_packing_list(d["key"], TRACE_ROW_COLUMNS)
+            index_packing_list(df, d["key"], name=d.get("name", d["key"]))
+        st.rerun()
+
+    column = st.selectbox(tr("recall_trace_column"), options=TRACE_KEY_COLUMNS)
+    raw = st.text_area(tr("recall_trace_values"), height=160)
+    values = [v for v in re.split(r"[\s,;]+", raw) if v]
+    if not st.button(tr("recall_trace_run"), type="primary", disabled=not values):
+        return
+
+    result = recall_trace(column, values)
+    rows, by_customer = result["rows"], result["by_customer"]
+    log_event(
+        "recall_trace", f"column={column}, queries={len(values)}, rows={len(rows)}, seconds={result['seconds']}"
     )
-    render_supply_chain_graph(net, height=int(graph_height))
+
+    col_m1, col_m2, col_m3, col_m4 = st.columns(4)
+    col_m1.metric("Customers", len(by_customer))
+    col_m2.metric("Units", int(by_customer["Units"].sum()) if len(by_customer) else 0)
+    col_m3.metric("Lines", len(rows))
+    col_m4.metric("Query time", f"{result['seconds'] * 1000:.0f} ms")
+    if result["unmatched"]:
+        st.warning(f"{len(result['unmatched'])} value(s) not found: {', '.join(result['unmatched'][:50])}")
+    if len(by_customer):
+        st.dataframe(by_customer, use_container_width=True)
+        st.download_button(
+            "Download affected customers CSV",
+            data=by_customer.to_csv(index=False).encode("utf-8-sig"),
+            file_name="recall_customers.csv",
+            mime="text/csv",
+            key="download_recall_customers",
+        )
+    if len(rows):
+        st.dataframe(rows, use_container_width=True)
+        st.download_button(
+            "Download affected rows CSV",
+            data=rows.to_csv(index=False).encode("utf-8-sig"),
+            file_name="recall_rows.csv",
+            mime="text/csv",
+            key="download_recall_rows",
+        )
 
 
 def load_skill_md():
-    if not os.path.exists("SKILL.md"):
-        return None
-    with open("SKILL.md", "r", encoding="utf-8") as f:
-        return f.read()
+    return _read_text_file(SKILL_MD_PATH, file_mtime(SKILL_MD_PATH))
 
 
 # =========================
@@ -1310,6 +6016,10 @@ def main():
     if "usage_log" not in st.session_state:
         st.session_state.usage_log = []
 
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    REQUEST_SESSION_ID.set(st.session_state.session_id)
+
     if "orchestrator" not in st.session_state:
         st.session_state.orchestrator = AgentOrchestrator()
 
@@ -1319,6 +6029,13 @@ def main():
     st.markdown("---")
 
     orchestrator: AgentOrchestrator = st.session_state.orchestrator
+    registry = orchestrator.registry
+    if registry.error:
+        st.error(registry.error)
+    elif st.session_state.get("logged_agent_registry") != registry.digest:
+        # Logged here, on the script thread: the cached loader also runs on agent worker threads.
+        st.session_state.logged_agent_registry = registry.digest
+        log_event("agent_registry_loaded", f"path={registry.path}, agents={len(registry.agents)}")
 
     # Sidebar
     with st.sidebar:
@@ -1401,6 +6118,8 @@ def main():
                 st.markdown(message["content"])
                 if "agent" in message:
                     st.caption(f"🤖 Agent: {message['agent']} | Model: {message.get('model', 'N/A')}")
+                if message.get("routing"):
+                    st.caption(format_routing(message["routing"]))
 
         if prompt := st.chat_input(tr("chat_input_placeholder")):
             st.session_state.messages.append({"role": "user", "content": prompt})
@@ -1408,23 +6127,34 @@ def main():
                 st.markdown(prompt)
 
             with st.chat_message("assistant"):
-                with st.spinner("Processing..."):
-                    agent_to_use = None if selected_agent == "auto" else selected_agent
-                    result = orchestrator.process_query(prompt, selected_agent=agent_to_use)
-                    response = result.get("response", "No response generated")
-                    agent_used = result.get("agent", "unknown")
-                    model_used = result.get("model", "N/A")
-                    st.markdown(response)
-                    st.caption(f"🤖 Agent: {agent_used} | Model: {model_used}")
-
-                    st.session_state.messages.append(
-                        {
-                            "role": "assistant",
-                            "content": response,
-                            "agent": agent_used,
-                            "model": model_used,
-                        }
-                    )
+                agent_to_use = None if selected_agent == "auto" else selected_agent
+                queue_status = st.empty()
+                token = QUEUE_OBSERVER.set(lambda *status: queue_status.caption(format_queue_status(*status)))
+                try:
+                    st.write_stream(orchestrator.stream_query(prompt, selected_agent=agent_to_use))
+                finally:
+                    QUEUE_OBSERVER.reset(token)
+                queue_status.empty()
+                result = orchestrator.last_result
+                response = result.get("response") or result.get("error") or "No response generated"
+                agent_used = result.get("agent", "unknown")
+                model_used = result.get("model", "N/A")
+                st.caption(
+                    f"🤖 Agent: {agent_used} | Model: {model_used} | "
+                    f"TTFT: {result.get('ttft_ms', 'N/A')} ms | Latency: {result.get('latency_ms', 'N/A')} ms"
+                )
+                if result.get("routing"):
+                    st.caption(format_routing(result["routing"]))
+
+                st.session_state.messages.append(
+                    {
+                        "role": "assistant",
+                        "content": response,
+                        "agent": agent_used,
+                        "model": model_used,
+                        "routing": result.get("routing"),
+                    }
+                )
 
     # Agent information
     with tab2:
@@ -1445,8 +6175,8 @@ def main():
 
     # Analytics dashboard
     with tab3:
-        subtab_a, subtab_b, subtab_c = st.tabs(
-            [tr("agent_usage_stats"), tr("supply_chain_analytics"), tr("usage_log_tab")]
+        subtab_a, subtab_b, subtab_trace, subtab_c = st.tabs(
+            [tr("agent_usage_stats"), tr("supply_chain_analytics"), tr("recall_trace_tab"), tr("usage_log_tab")]
         )
 
         with subtab_a:
@@ -1491,6 +6221,9 @@ def main():
         with subtab_b:
             render_supply_chain_analytics()
 
+        with subtab_trace:
+            render_recall_trace()
+
         with subtab_c:
             if st.session_state.usage_log:
                 df_log = pd.DataFrame(st.session_state.usage_log)
@@ -0,0 +1,16 @@
+import importlib.util
+import os
+import tempfile
+
+import pytest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+@pytest.fixture(scope="session")
+def app():
+    os.environ.setdefault("GUDID_DATA_DIR", tempfile.mkdtemp(prefix="gudid-test-"))
+    spec = importlib.util.spec_from_file_location("gudid_app", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
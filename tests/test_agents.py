@@ -0,0 +1,114 @@
+import threading
+
+
+class FakeStatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+def test_non_transient_error_leaves_breaker_open(app):
+    resilience = app.ProviderResilience(max_attempts=1)
+    breaker = resilience.breakers["openai"]
+    breaker.threshold = 1
+    breaker.reset_s = 0.0
+
+    def fail(exc):
+        raise exc
+
+    try:
+        resilience.call("openai", lambda: fail(FakeStatusError(503)))
+    except FakeStatusError:
+        pass
+    assert breaker.opened_at is not None
+
+    # The half-open probe hits a non-transient error: no verdict on the provider.
+    try:
+        resilience.call("openai", lambda: fail(app.RateLimitTimeoutError("queue full")))
+    except app.RateLimitTimeoutError:
+        pass
+    assert breaker.opened_at is not None
+    assert not breaker.probing
+
+    assert resilience.call("openai", lambda: "ok") == "ok"
+    assert breaker.opened_at is None
+
+
+def test_hedge_winner_is_cached_and_recorded(app, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+    release = threading.Event()
+
+    def slow_primary(self, query, model, system_prompt, max_tokens):
+        release.wait(5)
+        return "primary"
+
+    def fast_fallback(self, query, model, system_prompt, max_tokens):
+        return "fallback"
+
+    monkeypatch.setattr(app.Agent, "_execute_openai", slow_primary)
+    monkeypatch.setattr(app.Agent, "_execute_anthropic", fast_fallback)
+    monkeypatch.setattr(app, "hedge_fallback_model", lambda model: "claude-3-haiku-latest")
+
+    agent = app.Agent("hedge_test", {"llm_provider": "openai", "model": "gpt-4o-mini", "temperature": 0})
+    outcome = {}
+    try:
+        response = agent.complete("q", hedge_after=0.05, outcome=outcome)
+    finally:
+        release.set()
+
+    assert response == "fallback"
+    assert outcome["model"] == "claude-3-haiku-latest"
+    assert outcome["hedge"] == {
+        "primary": "gpt-4o-mini",
+        "fallback": "claude-3-haiku-latest",
+        "winner": "claude-3-haiku-latest",
+    }
+
+    cache = app.get_response_cache()
+    primary_key = app.ResponseCache.make_key("openai", "gpt-4o-mini", "", "q", 12000, 0.0)
+    winner_key = app.ResponseCache.make_key("anthropic", "claude-3-haiku-latest", "", "q", 12000, 0.0)
+    assert cache.get(primary_key) is None
+    assert cache.get(winner_key) == "fallback"
+
+
+def test_rate_limit_wait_is_returned_to_the_caller(app, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+
+    class WaitingLimiter:
+        def acquire(self, provider, model, tokens):
+            return 2.5
+
+    monkeypatch.setattr(app, "get_rate_limiter", lambda: WaitingLimiter())
+    monkeypatch.setattr(app.Agent, "_execute_openai", lambda self, *args: "answer")
+
+    agent = app.Agent("wait_test", {"llm_provider": "openai", "model": "gpt-4o-mini"})
+    outcome = {}
+    assert agent.complete("rate limited", use_cache=False, outcome=outcome) == "answer"
+    assert outcome["waited_s"] == 2.5
+    assert outcome["provider"] == "openai"
+
+
+def test_response_cache_defaults_to_deterministic_agents_only(app):
+    assert not app.Agent("chat", {"temperature": 0.7}).caches(None)
+    assert app.Agent("chat", {"temperature": 0.7}).caches(True)
+    assert app.Agent("lookup", {"temperature": 0}).caches(None)
+    assert not app.Agent("lookup", {"temperature": 0}).caches(False)
+
+
+def test_queue_observer_runs_without_holding_the_queue_lock(app):
+    queue = app.ProviderRequestQueue(rpm=600, tpm=None)
+    queue.requests.level = 0.0
+    seen = []
+
+    def observer(position, eta):
+        # A UI callback that reads the queue from another thread must not block on it.
+        reader = threading.Thread(target=lambda: seen.append(queue.stats()["queued"]))
+        reader.start()
+        reader.join(timeout=1.0)
+        assert not reader.is_alive()
+
+    waited = queue.acquire("session", 1, observer=observer)
+    assert seen and seen[0] == 1
+    assert waited > 0.0
+    assert queue.stats()["queued"] == 0
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+START = pd.Timestamp("2025-01-06")  # a Monday
+
+
+def shipments():
+    """Steady weekday deliveries for two customers over 20 weeks, plus one planted anomaly per rule."""
+    rows = []
+    for day in pd.bdate_range(START, periods=100):
+        rows.append(("S1", "C1", "M1", 10, day))
+        rows.append(("S1", "C2", "M2", 2, day))
+    # A long-standing edge that only ships now and then.
+    rows.append(("S3", "C3", "M3", 5, START + pd.Timedelta(days=10)))
+    rows.append(("S3", "C3", "M3", 5, START + pd.Timedelta(days=135)))
+    planted = {
+        "rolling_z": ("S1", "C1", "M1", 400, START + pd.Timedelta(days=91)),  # Monday, 40x the usual day
+        "new_edge": ("S9", "C2", "M2", 2, START + pd.Timedelta(days=120)),
+        "date_pattern": ("S1", "C2", "M2", 2, START + pd.Timedelta(days=62)),  # a Sunday
+    }
+    rows.extend(planted.values())
+    df = pd.DataFrame(rows, columns=["Suppliername", "customer", "ModelNum", "Numbers", "deliverdate_dt"])
+    positions = {name: len(df) - len(planted) + i for i, name in enumerate(planted)}
+    return df, positions
+
+
+def flags_at(result, position):
+    return int(result.loc[position, "anomaly_flags"]) if position in result.index else 0
+
+
+def test_each_rule_flags_its_planted_row(app):
+    df, planted = shipments()
+    result = app.detect_anomalies(df)
+    bits = app.ANOMALY_FLAGS
+
+    assert flags_at(result, planted["rolling_z"]) & bits["rolling_z"]
+    assert flags_at(result, planted["rolling_z"]) & bits["seasonal"]
+    assert flags_at(result, planted["rolling_z"]) & bits["quantity_spike"]
+    assert flags_at(result, planted["new_edge"]) & bits["new_edge"]
+    assert flags_at(result, planted["date_pattern"]) & bits["date_pattern"]
+    # Other lines are only flagged when they share the spiking customer/model day.
+    spike_day = df.loc[planted["rolling_z"], "deliverdate_dt"]
+    others = result.drop(index=list(planted.values()))
+    assert (others["deliverdate_dt"] == spike_day).all() and (others["customer"] == "C1").all()
+    assert result["anomaly_score"].is_monotonic_decreasing
+
+
+def test_filter_window_does_not_make_old_edges_new(app):
+    df, planted = shipments()
+    window = np.flatnonzero(df["deliverdate_dt"] >= START + pd.Timedelta(days=100))
+
+    # Judged on the window alone, S3's long-standing edge looks new.
+    alone = app.detect_anomalies(df.iloc[window].reset_index(drop=True))
+    assert set(alone.loc[alone["anomaly_reasons"].str.contains("new_edge"), "Suppliername"]) == {"S3"}
+
+    result = app.detect_anomalies(df, positions=window)
+    assert set(result.index) == {planted["new_edge"]}
+    assert set(result.index) <= set(window)
+
+
+def test_scores_are_reused_across_filters(app):
+    df, planted = shipments()
+    scores = app.score_anomalies(df)
+    assert len(scores) == len(df)
+    subset = app.detect_anomalies(df, positions=np.array([planted["date_pattern"]]), scores=scores)
+    assert list(subset.index) == [planted["date_pattern"]]
@@ -0,0 +1,73 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+MODELS = ["gpt-4o-mini", "claude-3-haiku-latest", "gemini-2.5-flash"]
+SECTIONS = ["by_customer", "by_device", "by_month", "outliers", "sample"]
+
+
+@pytest.fixture(scope="module")
+def sample(app):
+    return app.ingest_packing_list(io.StringIO(app.SAMPLE_CSV))
+
+
+@pytest.fixture(scope="module")
+def large(app):
+    rng = np.random.default_rng(5)
+    n = 3000
+    return pd.DataFrame(
+        {
+            "deliverdate_dt": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 200, n), unit="D"),
+            "Suppliername": rng.choice([f"Supplier company {i}" for i in range(20)], n),
+            "customer": rng.choice([f"C{i:05d}" for i in range(300)], n),
+            "DeviceName": rng.choice([f"心臟節律器 model family {i}" for i in range(40)], n),
+            "ModelNum": rng.choice([f"M{i}" for i in range(80)], n),
+            "LotNumber": rng.integers(100000, 999999, n).astype(str),
+            "licenseID": rng.choice([f"衛部醫器輸字第{i:06d}號" for i in range(30)], n),
+            "Numbers": rng.integers(1, 50, n),
+        }
+    )
+
+
+def included(result):
+    return {name: int(value.split("/")[0]) for name, value in result["sections"].items()}
+
+
+@pytest.mark.parametrize("model", MODELS)
+@pytest.mark.parametrize("budget", [80, 300, 1000, 4000])
+def test_context_stays_within_budget(app, large, model, budget):
+    result = app.pack_data_context(large, model, budget)
+    assert result["tokens"] <= budget
+    assert result["tokens"] == app.estimate_tokens(result["text"], model)
+
+
+def test_sections_fill_in_priority_order(app, sample):
+    tight = included(app.pack_data_context(sample, "gpt-4o-mini", 150))
+    roomy = included(app.pack_data_context(sample, "gpt-4o-mini", 4000))
+    assert roomy == {"by_customer": 6, "by_device": 6, "by_month": 2, "outliers": 11, "sample": 11}
+    assert tight["by_customer"] == roomy["by_customer"]
+    assert tight["sample"] == 0
+
+
+def test_more_budget_never_drops_rows(app, large):
+    previous = dict.fromkeys(SECTIONS, 0)
+    for budget in (200, 500, 1000, 2000, 4000):
+        current = included(app.pack_data_context(large, "gpt-4o-mini", budget))
+        assert all(current[name] >= previous[name] for name in SECTIONS)
+        previous = current
+
+
+def test_long_names_are_coded_once_in_a_legend(app, large):
+    text = app.pack_data_context(large, "gpt-4o-mini", 2000)["text"]
+    body, legend = text.split("## Code legend")
+    assert "Supplier company" not in body and "衛部醫器輸字" not in body
+    entries = dict(line.split("=", 1) for line in legend.strip().splitlines())
+    assert all(code[0] in "SDL" for code in entries)
+    assert len(set(entries.values())) == len(entries)
+
+
+def test_same_seed_gives_the_same_context(app, large):
+    first = app.pack_data_context(large, "gpt-4o-mini", 1000, seed=1)
+    assert app.pack_data_context(large, "gpt-4o-mini", 1000, seed=1)["text"] == first["text"]
@@ -0,0 +1,52 @@
+import io
+
+import pandas as pd
+
+HEADER = "Suppliername,deliverdate,customer,licenseID,DeviceCategory,UDI,DeviceName,LotNumber,SN,ModelNum,Numbers,Unit\n"
+DAY1 = "B00079,45968,C1,衛部醫器輸字第033951號,E.3610,00802526576331,英吉尼心臟節律器,LOT1,,L111,5,組\n"
+DAY2 = "B00079,45969,C2,衛部醫器輸字第033951號,E.3610,00802526576331,英吉尼心臟節律器,LOT2,,L111,3,組\n"
+NEXT_MONTH = "B00079,46000,C3,衛部醫器輸字第033951號,E.3610,00802526576331,英吉尼心臟節律器,LOT3,,L111,7,組\n"
+
+
+def parse(app, *lines):
+    return app.ingest_packing_list(io.StringIO(HEADER + "".join(lines)))
+
+
+def test_overlapping_drops_are_stored_and_traced_once(app, tmp_path):
+    store = app.DatasetStore(root=str(tmp_path / "store"))
+    index = app.TraceIndex(root=str(tmp_path / "trace"))
+    first, second = parse(app, DAY1), parse(app, DAY1, DAY2)
+
+    assert store.append(first, "drop-1")["added"] == 1
+    result = store.append(second, "drop-2")
+    assert (result["added"], result["duplicates"]) == (1, 1)
+    assert store.append(second, "drop-2")["skipped"]
+    index.add(first, "drop-1")
+    index.add(second, "drop-2")
+
+    assert len(store.load()) == 2
+    by_customer = index.trace("LotNumber", ["LOT1"])["by_customer"]
+    assert by_customer.set_index("customer")["Units"].to_dict() == {"C1": 5}
+
+
+def test_identical_lines_within_one_file_are_kept(app, tmp_path):
+    index = app.TraceIndex(root=str(tmp_path / "trace"))
+    index.add(parse(app, DAY1, DAY1), "drop-1")
+    assert int(index.trace("LotNumber", ["LOT1"])["by_customer"]["Units"].sum()) == 10
+
+
+def test_window_reads_only_overlapping_months(app, tmp_path):
+    store = app.DatasetStore(root=str(tmp_path / "store"))
+    store.append(parse(app, DAY1, DAY2, NEXT_MONTH), "drop-1")
+    assert store.stats()["partitions"] == 2
+
+    lo, hi = store.date_bounds()
+    assert (hi - lo).days == 46000 - 45968
+
+    window = store.load(start=lo, end=lo + pd.Timedelta(days=1), columns=["customer", "Numbers"])
+    assert sorted(window["customer"]) == ["C1", "C2"]
+    assert list(window.columns) == ["customer", "Numbers"]
+    assert len(store._parts(start=lo, end=lo)) == 1
+
+    cube = store.cube(start=hi, end=hi)
+    assert int(cube["Units"].sum()) == 7
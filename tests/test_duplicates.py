@@ -0,0 +1,66 @@
+import pandas as pd
+
+
+def lines(**columns):
+    base = {
+        "UDI": "0100802526576331",
+        "LotNumber": "L1",
+        "SN": "S1",
+        "customer": "Clinic A",
+        "Numbers": 1,
+        "DeviceName": "Catheter 3.0 mm",
+        "licenseID": "MOHW-1234",
+        "deliverdate_dt": "2024-01-02",
+    }
+    size = len(next(iter(columns.values())))
+    frame = pd.DataFrame({name: columns.get(name, [value] * size) for name, value in base.items()})
+    frame["deliverdate_dt"] = pd.to_datetime(frame["deliverdate_dt"])
+    return frame
+
+
+def test_cluster_variants_merges_spellings_but_not_sizes(app):
+    values = pd.Series(["Catheter 3.0 mm", "catheter 3.0mm", "Cathetre 3.0 mm", "Catheter 3.5 mm", None], dtype=object)
+    clusters, table = app.cluster_variants(values, similarity=0.88, window=6, stats={})
+    assert clusters[0] == clusters[1] == clusters[2]
+    assert clusters[3] != clusters[0]
+    assert clusters[4] == -1
+    assert set(table["variant"]) == {"Catheter 3.0 mm", "catheter 3.0mm", "Cathetre 3.0 mm"}
+    assert table["canonical"].nunique() == 1
+
+
+def test_cluster_variants_counts_scored_pairs(app):
+    stats = {}
+    app.cluster_variants(pd.Series(["Alpha stent", "Alpha stnet", "Beta valve"]), 0.88, 6, stats)
+    assert stats["pairs_scored"] > 0
+
+
+def test_find_duplicates_separates_exact_and_near_groups(app):
+    df = lines(
+        SN=["S1", "S1", "S2", "S2", "S3"],
+        DeviceName=["Catheter 3.0 mm", "Catheter 3.0 mm", "Catheter 3.0 mm", "catheter 3.0mm", "Catheter 3.0 mm"],
+        deliverdate_dt=["2024-01-02", "2024-01-02", "2024-01-02", "2024-01-03", "2024-01-02"],
+    )
+    result = app.find_duplicates(df)
+    groups = result["groups"]
+    assert result["stats"]["groups"] == 2
+    assert result["stats"]["exact_groups"] == 1
+    assert result["stats"]["near_groups"] == 1
+    kinds = dict(zip(groups["SN"], groups["duplicate_kind"]))
+    assert kinds == {"S1": "exact", "S2": "near"}
+    assert (groups["group_size"] == 2).all()
+    assert "S3" not in set(groups["SN"])
+
+
+def test_find_duplicates_respects_the_date_tolerance(app):
+    df = lines(
+        SN=["S1", "S1"],
+        DeviceName=["Catheter 3.0 mm", "catheter 3.0mm"],
+        deliverdate_dt=["2024-01-02", "2024-01-10"],
+    )
+    assert app.find_duplicates(df, date_tolerance_days=1)["stats"]["groups"] == 0
+    assert app.find_duplicates(df, date_tolerance_days=10)["stats"]["groups"] == 1
+
+
+def test_find_duplicates_ignores_rows_without_identifiers(app):
+    df = lines(UDI=["", ""], LotNumber=[None, None], SN=[" ", " "])
+    assert app.find_duplicates(df)["stats"]["groups"] == 0
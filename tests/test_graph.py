@@ -0,0 +1,40 @@
+import json
+import re
+
+
+def test_highlight_patch_cannot_close_the_script_tag(app):
+    labels = {"</script><img src=x onerror=alert(1)>": "</script><img src=x onerror=alert(1)>", "C1": "Clinic"}
+    patch = app.highlight_patch_script(labels, "script")
+    assert patch.count("</script>") == 1 and patch.endswith("</script>")
+    assert "<img" not in patch
+    ids = json.loads(re.search(r"var ids=(\[.*?\]);", patch).group(1))
+    assert ids == ["</script><img src=x onerror=alert(1)>"]
+
+
+def test_highlight_patch_is_empty_without_matches(app):
+    assert app.highlight_patch_script({"C1": "Clinic"}, "") == ""
+    assert app.highlight_patch_script({"C1": "Clinic"}, "supplier") == ""
+
+
+def supply_graph(units):
+    import networkx as nx
+
+    G = nx.DiGraph()
+    for name, n in units.items():
+        G.add_node(name, type="supplier", units=n)
+    G.add_node("C1", type="customer", units=sum(units.values()))
+    G.add_edges_from((name, "C1", {"weight": n}) for name, n in units.items())
+    return G
+
+
+def test_layout_cache_sees_unit_changes(app):
+    before = supply_graph({"S1": 10, "S2": 5})
+    after = supply_graph({"S1": 5, "S2": 10})
+    assert app.graph_fingerprint(before) != app.graph_fingerprint(after)
+    assert app.graph_fingerprint(before) == app.graph_fingerprint(supply_graph({"S1": 10, "S2": 5}))
+
+    # Suppliers are ordered by units, so the swapped graph must not reuse the cached layout.
+    first = app.compute_graph_layout(before)
+    second = app.compute_graph_layout(after)
+    assert first["S1"][1] < first["S2"][1]
+    assert second["S2"][1] < second["S1"][1]
@@ -0,0 +1,10 @@
+from io import StringIO
+
+
+def test_ingest_reports_peak_rss_growth_not_the_process_peak(app):
+    df = app.ingest_packing_list(StringIO(app.SAMPLE_CSV))
+    stats = df.attrs["ingest_stats"]
+    assert stats["rows"] == len(df) > 0
+    assert "peak_rss_mb" not in stats
+    growth = stats["peak_rss_growth_mb"]
+    assert growth is None or 0 <= growth < app.peak_rss_mb()
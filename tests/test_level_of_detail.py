@@ -0,0 +1,67 @@
+import pandas as pd
+
+
+def edges_for(app, customers):
+    """One supplier and device shipping `units` to each customer."""
+    df = pd.DataFrame(
+        {
+            "Suppliername": "S1",
+            "DeviceName": "Stent",
+            "customer": list(customers),
+            "LotNumber": "L1",
+            "Numbers": list(customers.values()),
+        }
+    )
+    return app.aggregate_supply_chain_edges(df)
+
+
+CUSTOMERS = {"C1": 50, "C2": 30, "C3": 3, "C4": 2, "C5": 1}
+
+
+def test_top_mode_keeps_the_heaviest_nodes_only(app):
+    nodes, edges = app.apply_level_of_detail(edges_for(app, CUSTOMERS), max_nodes=4, max_edges=100, mode="top")
+    assert set(nodes["node"]) == {"S1", "Stent", "C1", "C2"}
+    assert not nodes["aggregate"].any()
+    assert edges.loc[edges["target_type"] == "customer", "weight"].sum() == 80
+
+
+def test_collapse_mode_folds_the_tail_without_losing_units(app):
+    nodes, edges = app.apply_level_of_detail(edges_for(app, CUSTOMERS), max_nodes=4, max_edges=100, mode="collapse")
+    other = app.aggregate_node_id("customer")
+    aggregate = nodes.set_index("node").loc[other]
+    assert aggregate["aggregate"] and aggregate["members"] == 3 and aggregate["weight"] == 6
+    assert aggregate["label"] == "Other customers (3)"
+    to_customers = edges[edges["target_type"] == "customer"].set_index("target")["weight"]
+    assert to_customers.to_dict() == {"C1": 50, "C2": 30, other: 6}
+    assert to_customers.sum() == sum(CUSTOMERS.values())
+
+
+def test_expanded_type_shows_its_tail_individually(app):
+    nodes, edges = app.apply_level_of_detail(
+        edges_for(app, CUSTOMERS), max_nodes=4, max_edges=100, mode="collapse", expanded=["customer"]
+    )
+    assert {"C3", "C4", "C5"} <= set(nodes["node"])
+    assert app.aggregate_node_id("customer") not in set(nodes["node"])
+    assert edges.loc[edges["target_type"] == "customer", "weight"].sum() == sum(CUSTOMERS.values())
+
+
+def test_same_name_in_two_types_is_not_merged(app):
+    df = pd.DataFrame(
+        {"Suppliername": ["X", "S1"], "DeviceName": ["Stent", "X"], "customer": ["C1", "C1"], "Numbers": [5, 1]}
+    )
+    nodes, edges = app.apply_level_of_detail(app.aggregate_supply_chain_edges(df), 3, 100, mode="collapse")
+    # The device "X" falls in the tail; the supplier "X" stays a node of its own.
+    assert ("X", "supplier") in set(zip(nodes["node"], nodes["type"]))
+    assert app.aggregate_node_id("device") in set(edges["source"])
+
+
+def test_max_edges_keeps_the_heaviest_edges(app):
+    _, edges = app.apply_level_of_detail(edges_for(app, CUSTOMERS), max_nodes=10, max_edges=2, mode="top")
+    assert list(edges["weight"]) == [86, 50]
+
+
+def test_no_edges_gives_an_empty_graph(app):
+    empty = app.aggregate_supply_chain_edges(pd.DataFrame({"customer": ["C1"]}))
+    for mode in app.GRAPH_LOD_MODES:
+        nodes, edges = app.apply_level_of_detail(empty, max_nodes=5, max_edges=5, mode=mode)
+        assert nodes.empty and edges.empty
@@ -0,0 +1,64 @@
+import pytest
+
+
+def node(agent="summary_analyst", depends_on=(), template="{input}"):
+    return {"agent": agent, "depends_on": list(depends_on), "input": template}
+
+
+def test_nodes_run_after_their_dependencies(app):
+    pipeline = app.AgentPipeline(
+        "review",
+        {
+            "nodes": {
+                "report": node(depends_on=["trends", "quality"], template="{trends}\n{quality}"),
+                "trends": node(),
+                "quality": node(),
+            }
+        },
+    )
+    assert pipeline.order.index("report") > max(pipeline.order.index("trends"), pipeline.order.index("quality"))
+    assert pipeline.sinks == ["report"]
+    outputs = {"trends": "T", "quality": "Q"}
+    assert pipeline.render_input("report", "question", outputs) == "T\nQ"
+    assert pipeline.render_input("trends", "question", outputs) == "question"
+    assert pipeline.final_output({**outputs, "report": "R"}) == "R"
+
+
+def test_several_sinks_are_joined_under_headings(app):
+    pipeline = app.AgentPipeline("fan", {"nodes": {"a": node(), "b": node()}})
+    assert pipeline.final_output({"a": "A", "b": "B"}) == "## a\n\nA\n\n## b\n\nB"
+
+
+@pytest.mark.parametrize(
+    "nodes, message",
+    [
+        ({"a": node(depends_on=["b"]), "b": node(depends_on=["a"])}, "dependency cycle"),
+        ({"a": node(depends_on=["a"])}, "dependency cycle"),
+        ({"a": node(depends_on=["missing"])}, "unknown dependencies"),
+        ({"a": {"input": "{input}"}}, "missing 'agent'"),
+        ({"input": node()}, "reserved"),
+        ({"a": node(), "b": node(template="{a}")}, "without depends_on"),
+        ({"a": node(), "b": node(depends_on=["a"], template="{a} {typo}")}, "without depends_on"),
+    ],
+)
+def test_invalid_pipelines_are_rejected_at_load(app, nodes, message):
+    with pytest.raises(app.PipelineConfigError, match=message):
+        app.AgentPipeline("bad", {"nodes": nodes})
+
+
+def test_invalid_pipeline_is_reported_next_to_the_valid_ones(app, tmp_path):
+    path = tmp_path / "pipelines.yaml"
+    path.write_text(
+        "pipelines:\n"
+        "  good:\n    nodes:\n      a: {agent: summary_analyst}\n"
+        "  bad:\n    nodes:\n      a: {agent: summary_analyst, input: '{b}'}\n",
+        encoding="utf-8",
+    )
+    pipelines, errors = app.load_pipelines(str(path))
+    assert list(pipelines) == ["good"]
+    assert len(errors) == 1 and "bad.a" in errors[0]
+
+
+def test_shipped_pipelines_load(app):
+    pipelines, errors = app.load_pipelines(app.PIPELINES_PATH)
+    assert pipelines and not errors
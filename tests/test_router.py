@@ -0,0 +1,45 @@
+import pytest
+
+# Queries the old keyword table routed, in English and Chinese.
+KEYWORD_QUERIES = {
+    "nlp_analyzer": ["analyze this text", "extract entities from the note"],
+    "anomaly_detector": ["detect anomalies in shipments", "異常偵測"],
+    "duplicate_checker": ["find duplicate devices", "重複的資料"],
+    "label_matcher": ["ocr the label", "標籤比對"],
+    "data_standardizer": ["standardize the data", "資料標準化"],
+    "adverse_event_linker": ["link adverse events", "不良事件連結"],
+    "recall_manager": ["track recall of devices", "產品回收追蹤"],
+    "eifu_manager": ["eifu instructions", "電子說明書"],
+    "customs_verifier": ["verify customs declaration", "海關查驗"],
+    "international_connector": ["sync with international databases", "國際同步"],
+}
+
+
+@pytest.fixture(scope="module")
+def router(app):
+    registry = app.get_agent_registry()
+    return app.SemanticRouter.build({name: agent.config for name, agent in registry.agents.items()})
+
+
+@pytest.mark.parametrize(
+    "agent, query", [(agent, query) for agent, queries in KEYWORD_QUERIES.items() for query in queries]
+)
+def test_keyword_covered_agents_still_route(router, agent, query):
+    result = router.route(query)
+    assert result["agent"] == agent
+    assert not result["fallback"]
+    assert result["confidence"] >= 0.05
+
+
+@pytest.mark.parametrize("query", ["hello", "hi there", "你好", "good morning"])
+def test_small_talk_falls_back_with_zero_confidence(app, router, query):
+    result = router.route(query)
+    assert result == {**result, "agent": app.ROUTER_DEFAULT_AGENT, "confidence": 0.0, "fallback": True}
+
+
+def test_fallback_lists_the_true_top_matches(router):
+    result = router.route("top customers by units")
+    assert result["fallback"]
+    scores = [score for _, score in result["alternatives"]]
+    assert result["alternatives"] and scores == sorted(scores, reverse=True)
+    assert result["alternatives"][0][0] == "customer_segmentation_analyst"
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+
+def frame():
+    return pd.DataFrame(
+        {
+            "customer": ["C2", "C1", "C2", None, "C1"],
+            "deliverdate_dt": pd.to_datetime(["2025-01-03", "2025-01-01", "2025-01-02", "2025-01-05", None]),
+            "Numbers": [1, 2, 3, 4, 5],
+            "UDI": ["a", "b", "c", "d", "e"],
+        }
+    )
+
+
+def test_select_combines_customer_and_date_filters(app):
+    df = frame()
+    index = app.PackingListIndex(df)
+    assert index.customers == ["C1", "C2"]
+    assert index.date_bounds() == (pd.Timestamp("2025-01-01").date(), pd.Timestamp("2025-01-05").date())
+
+    # Both customers still exclude the row without one.
+    assert list(index.select(["C1", "C2"], None)) == [0, 1, 2, 4]
+    assert list(index.select(["C2"], None)) == [0, 2]
+    lo, hi = pd.Timestamp("2025-01-02").date(), pd.Timestamp("2025-01-03").date()
+    assert list(index.select(["C1", "C2"], (lo, hi))) == [0, 2]
+    assert list(index.select(["C1"], (lo, hi))) == []
+
+
+def test_select_returns_none_when_every_row_matches(app):
+    df = frame().iloc[:3]
+    index = app.PackingListIndex(df)
+    assert index.select(index.customers, index.date_bounds()) is None
+
+
+def test_filtered_rows_schema_does_not_depend_on_the_filter(app):
+    df = frame()
+    columns = ["customer", "Numbers", "missing"]
+    unfiltered = app.filtered_rows(df, None, columns)
+    filtered = app.filtered_rows(df, np.array([0, 2]), columns)
+    assert list(unfiltered.columns) == list(filtered.columns) == ["customer", "Numbers"]
+    assert len(unfiltered) == 5 and list(filtered["Numbers"]) == [1, 3]
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def rows():
+    rng = np.random.default_rng(3)
+    n = 400
+    df = pd.DataFrame(
+        {
+            "deliverdate_dt": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 60, n), unit="D"),
+            "customer": rng.choice(["C1", "C2", "C3"], n),
+            "Suppliername": rng.choice(["S1", "S2"], n),
+            "DeviceName": rng.choice(["Stent", "Valve", None], n),
+            "ModelNum": rng.choice(["M1", "M2"], n),
+            "licenseID": "L1",
+            "Numbers": rng.integers(1, 20, n),
+        }
+    )
+    return df.astype({"customer": "category", "Suppliername": "category"})
+
+
+def test_rollups_match_the_rows(app, rows):
+    cube = app.build_summary_cube(rows)
+    assert len(cube) < len(rows)
+    assert cube["Units"].sum() == rows["Numbers"].sum()
+    assert cube["Lines"].sum() == len(rows)
+    for by in ("customer", ["Suppliername", "ModelNum"], "DeviceName"):
+        expected = rows.groupby(by, observed=True, dropna=False)["Numbers"].sum()
+        got = cube.groupby(by, observed=True, dropna=False)["Units"].sum()
+        pd.testing.assert_series_equal(got, expected, check_names=False)
+
+
+def test_filters_match_filtering_the_rows(app, rows):
+    cube = app.build_summary_cube(rows)
+    start, end = pd.Timestamp("2024-01-10").date(), pd.Timestamp("2024-01-20").date()
+    filtered = app.filter_summary_cube(cube, ["C1", "C3"], (start, end))
+    # The end date is inclusive, as in the dashboard's date picker.
+    day = rows["deliverdate_dt"].dt.normalize()
+    keep = rows["customer"].isin(["C1", "C3"]) & (day >= pd.Timestamp(start)) & (day <= pd.Timestamp(end))
+    assert filtered["Units"].sum() == rows.loc[keep, "Numbers"].sum()
+    assert filtered["Lines"].sum() == keep.sum()
+    assert len(app.filter_summary_cube(cube, [], None)) == len(cube)
+
+
+def test_rollup_is_sorted_by_units(app, rows):
+    top = app.rollup_cube(app.build_summary_cube(rows), "customer")
+    assert list(top.columns) == ["customer", "Total_Units"]
+    assert top["Total_Units"].is_monotonic_decreasing
+    assert top["Total_Units"].sum() == rows["Numbers"].sum()
+
+
+def test_lines_stand_in_for_units_without_quantities(app, rows):
+    cube = app.build_summary_cube(rows.drop(columns="Numbers"))
+    assert (cube["Units"] == cube["Lines"]).all()
+    assert cube["Units"].sum() == len(rows)
+
+
+def test_cube_is_built_once_per_dataset(app, rows):
+    first = app.get_summary_cube("cube-test", rows)
+    assert app.get_summary_cube("cube-test", rows.iloc[:0]) is first
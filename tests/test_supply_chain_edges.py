@@ -0,0 +1,56 @@
+import pandas as pd
+
+
+def packing_list(**overrides):
+    df = pd.DataFrame(
+        {
+            "Suppliername": ["S1", "S1 ", "S1", "S2", None],
+            "DeviceName": ["Stent", "Stent", "Valve", "Stent", "Stent"],
+            "customer": ["C1", "C1", "C2", "C1", "C3"],
+            "LotNumber": ["L1", "L2", "L1", "L3", "L4"],
+            "Numbers": [3, 2, 5, 7, 1],
+        }
+    )
+    return df.assign(**overrides)
+
+
+def edge(edges, source, target):
+    return edges[(edges["source"] == source) & (edges["target"] == target)].iloc[0]
+
+
+def test_edges_sum_every_row_of_a_pair(app):
+    edges = app.aggregate_supply_chain_edges(packing_list())
+    # "S1 " is the same supplier once stripped; the row without a supplier only feeds device → customer.
+    stent = edge(edges, "S1", "Stent")
+    assert (stent["weight"], stent["lines"], stent["lots"]) == (5, 2, 2)
+    assert edge(edges, "S2", "Stent")["weight"] == 7
+    to_c1 = edge(edges, "Stent", "C1")
+    assert (to_c1["weight"], to_c1["lines"], to_c1["lots"]) == (12, 3, 3)
+    assert edge(edges, "Stent", "C3")["weight"] == 1
+    assert set(zip(edges["source_type"], edges["target_type"])) == {("supplier", "device"), ("device", "customer")}
+    assert len(edges) == 6
+
+
+def test_units_are_conserved_per_layer(app):
+    df = packing_list()
+    edges = app.aggregate_supply_chain_edges(df)
+    assert edges.loc[edges["target_type"] == "customer", "weight"].sum() == df["Numbers"].sum()
+    supplied = df["Numbers"][df["Suppliername"].notna()].sum()
+    assert edges.loc[edges["source_type"] == "supplier", "weight"].sum() == supplied
+
+
+def test_categorical_columns_aggregate_like_strings(app):
+    plain = app.aggregate_supply_chain_edges(packing_list())
+    categorical = app.aggregate_supply_chain_edges(
+        packing_list().astype({"Suppliername": "category", "DeviceName": "category", "customer": "category"})
+    )
+    key = ["source", "target"]
+    pd.testing.assert_frame_equal(
+        plain.sort_values(key).reset_index(drop=True), categorical.sort_values(key).reset_index(drop=True)
+    )
+
+
+def test_missing_columns_give_an_empty_edge_table(app):
+    edges = app.aggregate_supply_chain_edges(pd.DataFrame({"customer": ["C1"]}))
+    assert edges.empty
+    assert list(edges.columns) == ["source", "target", "source_type", "target_type", "weight", "lines", "lots"]
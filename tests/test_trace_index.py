@@ -0,0 +1,56 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+CSV = """Suppliername,deliverdate,customer,licenseID,DeviceCategory,UDI,DeviceName,LotNumber,SN,ModelNum,Numbers,Unit
+B00079,45968,C05278,衛部醫器輸字第033951號,E.3610,00802526576331,英吉尼心臟節律器,890057,123456,L111,1,組
+B00079,45967,C06030,衛部醫器輸字第033951號,E.3610,00802526576331,英吉尼心臟節律器,872177,,L111,1,組
+B00079,45966,C00123,衛部醫器輸字第033951號,E.3610,00802526576331,英吉尼心臟節律器,889490,0012345,110,1,組
+"""
+
+
+def test_numeric_serial_is_traced_as_written(app, tmp_path):
+    df = app.ingest_packing_list(io.StringIO(CSV))
+    assert df["SN"].iloc[0] == "123456"
+    assert df["SN"].iloc[2] == "0012345"
+    assert df["ModelNum"].iloc[2] == "110"
+
+    index = app.TraceIndex(root=str(tmp_path))
+    assert index.add(df, "numeric-serials")
+    result = index.trace("SN", ["123456", "0012345"])
+    assert sorted(result["rows"]["SN"]) == ["0012345", "123456"]
+    assert result["unmatched"] == []
+
+
+def test_float_serials_normalize_without_decimal_suffix(app):
+    keys = app.normalize_trace_keys(pd.Series([123456.0, np.nan]))
+    assert list(keys) == ["123456", ""]
+
+
+def test_concurrent_writers_keep_each_others_segments(app, tmp_path):
+    import threading
+
+    df = app.ingest_packing_list(io.StringIO(CSV))
+    # Separate instances stand in for separate server processes sharing the directory.
+    writers = [app.TraceIndex(root=str(tmp_path)) for _ in range(6)]
+    threads = [threading.Thread(target=w.add, args=(df, f"file-{i}")) for i, w in enumerate(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    reader = app.TraceIndex(root=str(tmp_path))
+    assert sorted(s.dataset_key for s in reader.segments()) == [f"file-{i}" for i in range(6)]
+
+
+def test_stale_manifest_view_is_merged_not_overwritten(app, tmp_path):
+    df = app.ingest_packing_list(io.StringIO(CSV))
+    first, second = app.TraceIndex(root=str(tmp_path)), app.TraceIndex(root=str(tmp_path))
+    second.segments()
+    first.add(df, "first")
+    # As if both writes landed within the filesystem's mtime resolution.
+    second._manifest_mtime = app.file_mtime(first.manifest_path)
+    assert second.add(df, "second")
+    assert not second.add(df, "first")
+    keys = [s.dataset_key for s in app.TraceIndex(root=str(tmp_path)).segments()]
+    assert sorted(keys) == ["first", "second"]
@@ -0,0 +1,60 @@
+import pytest
+
+GTIN = "00802526576331"
+GS = "\x1d"
+
+
+def flags(app, *names):
+    return sum(app.UDI_QUALITY_FLAGS[name] for name in names)
+
+
+@pytest.mark.parametrize("udi", [GTIN, GTIN[1:], GTIN[2:]])
+def test_bare_gtin_is_padded_and_checked(app, udi):
+    parsed = app.parse_udi([udi]).iloc[0]
+    assert parsed["gtin"] == GTIN
+    assert parsed["udi_quality"] == 0
+
+
+def test_bracketed_element_string(app):
+    parsed = app.parse_udi([f"(01){GTIN}(17)261231(10)ABC(21)SN1"]).iloc[0]
+    assert (parsed["gtin"], parsed["expiry"], parsed["lot"], parsed["serial"]) == (GTIN, "261231", "ABC", "SN1")
+    assert parsed["udi_quality"] == 0
+
+
+@pytest.mark.parametrize(
+    "udi",
+    [
+        f"01{GTIN}17261231" f"10ABC{GS}21SN1",
+        f"01{GTIN}21SN1{GS}10ABC{GS}17261231",
+        f"01{GTIN}{GS}17261231" f"21SN1{GS}10ABC{GS}",
+    ],
+)
+def test_raw_element_string_in_any_ai_order(app, udi):
+    parsed = app.parse_udi([udi]).iloc[0]
+    assert (parsed["gtin"], parsed["lot"], parsed["serial"]) == (GTIN, "ABC", "SN1")
+    assert parsed["udi_quality"] == 0
+
+
+def test_raw_element_string_check_digit_is_verified(app):
+    parsed = app.parse_udi([f"0100802526576332" f"21SN1{GS}10ABC"]).iloc[0]
+    assert parsed["lot"] == "ABC"
+    assert parsed["udi_quality"] == flags(app, "bad_check_digit")
+
+
+@pytest.mark.parametrize(
+    "udi",
+    [
+        f"01{GTIN}99XYZ",  # unknown AI
+        f"01{GTIN}1726",  # truncated fixed-length date
+        f"01{GTIN}10{GS}21SN1",  # empty lot
+        f"01{GTIN}21A{GS}21B",  # repeated AI
+        f"(01){GTIN}(99)XYZ",
+    ],
+)
+def test_malformed_element_strings_are_ai_errors(app, udi):
+    assert app.parse_udi([udi]).iloc[0]["udi_quality"] & flags(app, "ai_error")
+
+
+def test_non_gs1_values(app):
+    parsed = app.parse_udi(["", "+H123ABC", "12345"])
+    assert list(parsed["udi_quality"]) == [flags(app, "missing"), flags(app, "not_gs1"), flags(app, "bad_length")]